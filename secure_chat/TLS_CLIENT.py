@@ -4,6 +4,8 @@ import socket, ssl
 # Configurazione dell'indirizzo e porta del server TLS
 HOST = '127.0.0.1'
 PORT = 65433
+# Riconnessione automatica, con ripresa della sessione TLS, se il server chiude
+RECONNECT = True
 
 def main():
     # 1) Configurazione del contesto TLS in modalità client
@@ -21,33 +23,53 @@ def main():
     # E mantenere la verifica del nome host e della catena di certificati attivata
 
     # 2) Apertura del socket TCP e wrapping con TLS
-    # Creiamo prima una connessione TCP standard
-    with socket.create_connection((HOST, PORT)) as sock:
-        # Avvolgiamo il socket con TLS, specificando il nome host atteso nel certificato
-        # Questo attiva l'handshake TLS e la crittografia automatica
-        with context.wrap_socket(sock, server_hostname='localhost') as ssock:
-            print(f"[+] TLS handshake completato con {HOST}:{PORT}")
-            
-            # 3) Loop echo cifrato
-            # I dati inviati/ricevuti sono automaticamente gestiti dal layer TLS
-            while True:
-                # Richiedi input dall'utente
-                msg = input(">> ").encode()
-                if not msg:
-                    # Esci se l'utente inserisce una stringa vuota
-                    break
+    # Alla prima connessione l'handshake è completo; se il server chiude la connessione
+    # ci riconnettiamo presentando la SSLSession ottenuta (ticket TLS 1.3):
+    # l'handshake abbreviato salta la firma RSA del server
+    session = None
+    while True:
+        # Creiamo prima una connessione TCP standard
+        with socket.create_connection((HOST, PORT)) as sock:
+            # Avvolgiamo il socket con TLS, specificando il nome host atteso nel certificato
+            # Questo attiva l'handshake TLS e la crittografia automatica
+            with context.wrap_socket(sock, server_hostname='localhost', session=session) as ssock:
+                resumed = " (sessione ripresa)" if ssock.session_reused else ""
+                print(f"[+] TLS handshake completato con {HOST}:{PORT}{resumed}")
                 
-                # Invia il messaggio al server (automaticamente cifrato)
-                ssock.sendall(msg)
-                
-                # Ricevi la risposta dal server (automaticamente decifrata)
-                data = ssock.recv(4096)
-                if not data:
-                    # Il server ha chiuso la connessione
-                    break
-                
-                # Mostra la risposta ricevuta
-                print(f"[Server] {data.decode()!r}")
+                # 3) Loop echo cifrato
+                # I dati inviati/ricevuti sono automaticamente gestiti dal layer TLS
+                if not chat(ssock):
+                    # Uscita richiesta dall'utente
+                    return
+                # In TLS 1.3 i ticket arrivano dopo l'handshake: la sessione è disponibile
+                # solo dopo aver letto almeno una risposta dal server
+                session = ssock.session
+        if not RECONNECT:
+            return
+        print("[*] Connessione chiusa dal server, riconnessione")
+
+def chat(ssock) -> bool:
+    """
+    Loop interattivo; restituisce True se è stato il server a chiudere la connessione.
+    """
+    while True:
+        # Richiedi input dall'utente
+        msg = input(">> ").encode()
+        if not msg:
+            # Esci se l'utente inserisce una stringa vuota
+            return False
+        
+        # Invia il messaggio al server (automaticamente cifrato)
+        ssock.sendall(msg)
+        
+        # Ricevi la risposta dal server (automaticamente decifrata)
+        data = ssock.recv(4096)
+        if not data:
+            # Il server ha chiuso la connessione
+            return True
+        
+        # Mostra la risposta ricevuta
+        print(f"[Server] {data.decode()!r}")
 
 # Punto di ingresso dello script
 if __name__ == '__main__':
@@ -1,11 +1,20 @@
 #!/usr/bin/env python3
-import socket, ssl
+import os, signal, socket, ssl, threading
 
 # Configurazione dell'indirizzo e porta del server
 HOST = '127.0.0.1'
 PORT = 65432
+# Processi worker che condividono la porta con SO_REUSEPORT (1 = un solo processo)
+WORKERS = os.cpu_count() or 1
+# Dimensione del buffer di ricezione riutilizzato per tutta la durata di una connessione
+BUFFER_SIZE = 64 * 1024
+# Ticket di sessione TLS 1.3 inviati dopo ogni handshake (0 disattiva la ripresa)
+NUM_TICKETS = 2
 
-def main():
+def make_context() -> ssl.SSLContext:
+    """
+    Contesto TLS lato server con ripresa di sessione tramite ticket.
+    """
     # 1) Configurazione del contesto TLS in modalità server
     # TLS (Transport Layer Security) è il successore di SSL e fornisce
     # comunicazione sicura su rete attraverso crittografia
@@ -16,42 +25,126 @@ def main():
     # La chiave privata (.key) deve rimanere segreta e viene usata per l'autenticazione
     context.load_cert_chain(certfile='server.crt', keyfile='server.key')
 
+    # Ripresa di sessione: dopo il primo handshake il client riceve dei ticket
+    # e alla riconnessione salta la firma RSA e la verifica del certificato.
+    # Le chiavi dei ticket sono generate da OpenSSL alla creazione del contesto:
+    # creandolo prima di fork() tutti i worker le condividono, quindi un ticket
+    # emesso da un worker viene accettato anche dagli altri
+    context.options &= ~ssl.OP_NO_TICKET
+    context.num_tickets = NUM_TICKETS
+    return context
+
+def listen_socket(reuse_port: bool = False) -> socket.socket:
+    """
+    Socket in ascolto su HOST:PORT; con reuse_port più processi possono legarsi alla stessa porta.
+    """
     # 2) Creazione del socket TCP non cifrato
     # Questo è un normale socket TCP che verrà successivamente "avvolto" con TLS
     bindsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+    bindsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # Il kernel distribuisce le nuove connessioni tra i socket dei worker
+        bindsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     bindsock.bind((HOST, PORT))
-    bindsock.listen(5)  # Accetta fino a 5 connessioni in coda
-    print(f"[+] TLS server in ascolto su {HOST}:{PORT}")
+    bindsock.listen(128)
+    return bindsock
+
+def handle(context: ssl.SSLContext, newsock: socket.socket, addr) -> None:
+    """
+    Handshake TLS ed echo di una singola connessione (gira su un thread dedicato).
+    """
+    ssock = None
+    # Le risposte sono piccole e immediate: senza TCP_NODELAY l'algoritmo di Nagle
+    # e l'ACK ritardato del client aggiungono decine di millisecondi per messaggio
+    newsock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    
+    # 3) Esecuzione dell'handshake TLS: wrap del socket
+    try:
+        # Avvolge il socket TCP con il contesto TLS
+        # server_side=True indica che questo è il lato server dell'handshake
+        ssock = context.wrap_socket(newsock, server_side=True)
+        resumed = " (sessione ripresa)" if ssock.session_reused else ""
+        print(f"[+] [pid {os.getpid()}] TLS handshake completato con {addr}{resumed}")
+        
+        # 4) Loop di echo cifrato
+        # I dati sono automaticamente cifrati/decifrati dal layer TLS
+        # recv_into riempie sempre lo stesso buffer: nessuna allocazione per messaggio
+        buf = bytearray(BUFFER_SIZE)
+        view = memoryview(buf)
+        while True:
+            count = ssock.recv_into(buf)
+            if not count:
+                # Connessione chiusa dal client
+                break
+            # Invia indietro gli stessi dati (echo)
+            ssock.sendall(view[:count])
+    except (ssl.SSLError, OSError) as e:
+        # Gestisce errori durante l'handshake o la comunicazione TLS
+        print(f"[!] Errore TLS: {e}")
+    finally:
+        # Garantisce che il socket venga chiuso anche in caso di errori
+        if ssock:
+            ssock.close()
+        else:
+            newsock.close()
 
-    # Loop principale del server
+def serve(context: ssl.SSLContext, bindsock: socket.socket) -> None:
+    """
+    Loop di accept di un worker: ogni connessione ha il proprio thread,
+    quindi un client lento non blocca gli altri.
+    """
     while True:
         # Accetta una nuova connessione TCP
         newsock, addr = bindsock.accept()
-        ssock = None
-        
-        # 3) Esecuzione dell'handshake TLS: wrap del socket
-        try:
-            # Avvolge il socket TCP con il contesto TLS
-            # server_side=True indica che questo è il lato server dell'handshake
-            ssock = context.wrap_socket(newsock, server_side=True)
-            print(f"[+] TLS handshake completato con {addr}")
-            
-            # 4) Loop di echo cifrato
-            # I dati sono automaticamente cifrati/decifrati dal layer TLS
-            while True:
-                data = ssock.recv(4096)
-                if not data:
-                    # Connessione chiusa dal client
-                    break
-                # Invia indietro gli stessi dati (echo)
-                ssock.sendall(data)
-        except ssl.SSLError as e:
-            # Gestisce errori durante l'handshake o la comunicazione TLS
-            print(f"[!] Errore TLS: {e}")
-        finally:
-            # Garantisce che il socket venga chiuso anche in caso di errori
-            if ssock:
-                ssock.close()
+        threading.Thread(target=handle, args=(context, newsock, addr), daemon=True).start()
+
+def main():
+    context = make_context()
+    workers = WORKERS if hasattr(socket, 'SO_REUSEPORT') and hasattr(os, 'fork') else 1
+    print(f"[+] TLS server in ascolto su {HOST}:{PORT} ({workers} worker)")
+
+    if workers <= 1:
+        # Un solo processo (anche dove SO_REUSEPORT o fork non esistono)
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        with listen_socket() as bindsock:
+            try:
+                serve(context, bindsock)
+            except KeyboardInterrupt:
+                pass
+        print("[!] TLS server terminato")
+        return
+
+    # 5) Worker multi-processo: ognuno ha il proprio socket in ascolto sulla stessa porta
+    # e il proprio GIL, e tutti ereditano il contesto (e le chiavi dei ticket) dal padre
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                serve(context, listen_socket(reuse_port=True))
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    # Il padre attende i worker; SIGTERM e CTRL+C li fermano tutti
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+    print("[!] TLS server terminato")
 
 # Punto di ingresso dello script
 if __name__ == '__main__':
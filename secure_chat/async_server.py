@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+import asyncio
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from common import server_suites, SUPPORTED_COMPRESSION
+from dh_params import get_parameters, KeyPool
+import metrics
+from protocol import Connection, AsyncConnection
+from room import Room
+from resumption import TicketStore
+
+# Configurazione del server asincrono (stesso protocollo di server.py)
+HOST = '127.0.0.1'
+PORT = 65432
+DH_SOURCE = 'ffdhe2048'
+# Numero massimo di sessioni contemporanee: le connessioni in eccesso vengono chiuse subito
+MAX_CONNECTIONS = 4096
+# Secondi di inattività dopo i quali una sessione viene chiusa
+IDLE_TIMEOUT = 300
+# Secondi concessi alle sessioni attive per terminare durante lo spegnimento
+SHUTDOWN_GRACE = 5
+# Thread dedicati alle operazioni crittografiche costose (exchange, HKDF)
+CRYPTO_WORKERS = 4
+# Chiavi private DH pre-generate in background
+KEY_POOL_SIZE = 64
+# Se True il server è una chat di gruppo: ogni messaggio va a tutti i membri connessi
+# (vedi room.py per code, politiche sui membri lenti e cifratura parallela) invece che al solo mittente
+ROOM_MODE = False
+# Suite AEAD in ordine di preferenza ('auto': micro-benchmark all'avvio, vedi common.server_suites)
+CIPHER_SUITES = 'auto'
+# Algoritmi di compressione accettati se il client li chiede (in modalità stanza non viene usata, vedi room.py)
+COMPRESSION = SUPPORTED_COMPRESSION
+
+
+class ChatServer:
+    """
+    Server echo cifrato che gestisce molte sessioni concorrenti su un unico event loop.
+    """
+
+    def __init__(self, host=HOST, port=PORT, max_connections=MAX_CONNECTIONS,
+                 idle_timeout=IDLE_TIMEOUT, dh_source=DH_SOURCE, suites=CIPHER_SUITES, room=ROOM_MODE,
+                 compression=COMPRESSION):
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        # 1) Parametri DH (modalità di ripiego) condivisi da tutte le sessioni; ogni sessione ha
+        # comunque la propria chiave privata effimera e le proprie chiavi AES
+        self.parameters = get_parameters(dh_source)
+        self.key_pool = KeyPool(self.parameters, size=KEY_POOL_SIZE)
+        # Ticket di ripresa: un client che si riconnette salta lo scambio di chiavi
+        self.tickets = TicketStore()
+        # Suite AEAD preferite, misurate una volta all'avvio e non per connessione
+        self.suites = server_suites(suites)
+        self.compression = compression
+        self.executor = ThreadPoolExecutor(max_workers=CRYPTO_WORKERS, thread_name_prefix='crypto')
+        self.sessions = set()
+        # Writer delle sessioni ferme in attesa di dati dal client (handshake o messaggio successivo):
+        # allo spegnimento vengono chiusi subito, le altre finiscono prima il messaggio in corso
+        self._waiting = set()
+        self.room = Room() if room else None
+        self._server = None
+        self._stopping = asyncio.Event()
+
+    async def _handshake(self, reader, writer, stats=None) -> AsyncConnection:
+        # 2) Negoziazione identica a server.py (stessa macchina a stati protocol.Connection):
+        # ripresa se il ticket è valido, altrimenti X25519 se offerto, altrimenti DH.
+        # Le chiavi private DH arrivano dal pool pre-generato
+        conn = Connection(server_side=True, suites=self.suites, parameters=self.parameters, tickets=self.tickets,
+                          generate_dh_key=self.key_pool.get, stats=stats, compression=self.compression)
+        # 3) exchange() e la derivazione HKDF sono CPU-bound: l'adattatore elabora i record
+        # di handshake sull'executor, così l'event loop e le altre sessioni non si bloccano
+        # (la misura di 'exchange' non include più l'attesa di un thread libero)
+        session = AsyncConnection(reader, writer, conn, self.executor)
+        await session.handshake()
+        return session
+
+    async def _handle(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        # 4) Limite di connessioni: rifiutiamo subito invece di accodare all'infinito
+        if len(self.sessions) >= self.max_connections:
+            print(f"[!] Limite di connessioni raggiunto, rifiuto {addr}")
+            writer.close()
+            return
+
+        task = asyncio.current_task()
+        self.sessions.add(task)
+        stats = metrics.connection(addr)
+        member = None
+        try:
+            start = time.perf_counter()
+            self._waiting.add(writer)
+            try:
+                session = await asyncio.wait_for(self._handshake(reader, writer, stats), self.idle_timeout)
+            finally:
+                self._waiting.discard(writer)
+            metrics.observe('handshake', time.perf_counter() - start, stats)
+            conn = session.conn
+            details = conn.suite if conn.compression is None else f"{conn.suite}, {conn.compression}"
+            print(f"[+] Sessione stabilita con {addr} ({details}, {len(self.sessions)} attive)")
+            if self.room is not None:
+                # In modalità stanza il cifrario di invio passa alla stanza, che lo usa dal proprio task
+                member = self.room.join(f"{addr[0]}:{addr[1]}", writer, session.conn.send_cipher)
+            # 5) Loop di echo (o di inoltro alla stanza): il timeout di inattività sostituisce settimeout(300)
+            while not self._stopping.is_set():
+                self._waiting.add(writer)
+                try:
+                    msg = await asyncio.wait_for(session.recv(), self.idle_timeout)
+                finally:
+                    self._waiting.discard(writer)
+                if member is None:
+                    await session.send(msg)
+                else:
+                    await self.room.broadcast(member, msg)
+        except (asyncio.IncompleteReadError, EOFError, ConnectionError):
+            pass
+        except asyncio.TimeoutError:
+            print(f"[!] Sessione {addr} chiusa per inattività")
+        except asyncio.CancelledError:
+            # Sessione cancellata allo scadere di SHUTDOWN_GRACE: la chiusura avviene qui sotto,
+            # senza propagare la cancellazione al callback di asyncio.start_server
+            pass
+        except Exception as e:
+            # Un errore in una sessione (es. tag GCM non valido) non deve fermare il server
+            print(f"[!] Errore nella sessione {addr}: {e!r}")
+        finally:
+            self.sessions.discard(task)
+            if member is not None:
+                self.room.leave(member)
+            metrics.close(stats)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, asyncio.CancelledError):
+                pass
+
+    async def serve(self):
+        """
+        Avvia il server e lo esegue fino alla richiesta di spegnimento.
+        """
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self._stopping.set)
+            except (NotImplementedError, RuntimeError):
+                # Su alcune piattaforme (es. Windows) i segnali non sono supportati dal loop
+                pass
+
+        self._server = await asyncio.start_server(
+            self._handle, self.host, self.port, backlog=min(self.max_connections, 4096))
+        print(f"[+] Server asincrono in ascolto su {self.host}:{self.port}")
+        metrics_server = None
+        if metrics.ENABLED:
+            # Endpoint delle metriche su un thread separato, fuori dall'event loop
+            metrics_server = metrics.serve(self.host, metrics.METRICS_PORT)
+            print(f"[+] Metriche su http://{self.host}:{metrics.METRICS_PORT}/metrics")
+        async with self._server:
+            await self._stopping.wait()
+            await self.shutdown()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+
+    async def shutdown(self):
+        """
+        Spegnimento ordinato: smette di accettare, chiude le sessioni inattive,
+        attende le altre (al massimo SHUTDOWN_GRACE secondi) e infine cancella quelle rimaste.
+        """
+        self._stopping.set()
+        self._server.close()
+        # Le sessioni in attesa di dati non vedrebbero _stopping fino al prossimo messaggio:
+        # chiudere il trasporto fa terminare la loro lettura con un EOF
+        for writer in list(self._waiting):
+            writer.close()
+        if self.sessions:
+            print(f"[*] Attendo la chiusura di {len(self.sessions)} sessioni")
+            _, pending = await asyncio.wait(set(self.sessions), timeout=SHUTDOWN_GRACE)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        # Solo ora: da Python 3.12.1 wait_closed attende anche tutte le connessioni aperte
+        await self._server.wait_closed()
+        self.key_pool.close()
+        if self.room is not None:
+            self.room.close()
+        self.executor.shutdown(wait=False)
+        print("[!] Server terminato")
+
+
+def main():
+    asyncio.run(ChatServer().serve())
+
+
+# Punto di ingresso dello script
+if __name__ == '__main__':
+    main()
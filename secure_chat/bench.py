@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+import argparse
+import base64
+import json
+import os
+import platform
+import socket
+import ssl
+import struct
+import subprocess
+import sys
+import threading
+import time
+import cryptography
+from common import send_encrypted, recv_decrypted, FrameReader, HANDSHAKE_MODES, SUPPORTED_SUITES
+from client import handshake
+from room import ROOM_SEND_TIMEOUT
+
+# Porte di loopback usate dal benchmark (diverse da quelle dei programmi interattivi)
+HOST = '127.0.0.1'
+CHAT_PORT = 56432
+TLS_PORT = 56433
+MITM_PORT = 56434
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Comandi per avviare i server in un processo separato, sovrascrivendo le porte
+CHAT_SERVER_CODE = (
+    "import asyncio, async_server as m\n"
+    "asyncio.run(m.ChatServer(host={host!r}, port={port}).serve())\n"
+)
+TLS_SERVER_CODE = "import TLS_SERVER as m\nm.HOST, m.PORT = {host!r}, {port}\nm.main()\n"
+ROOM_SERVER_CODE = (
+    "import asyncio, async_server as m\n"
+    "asyncio.run(m.ChatServer(host={host!r}, port={port}, room=True).serve())\n"
+)
+MITM_CODE = (
+    "import mitm_proxy as m\n"
+    "m.LISTEN_HOST, m.LISTEN_PORT = {host!r}, {port}\n"
+    "m.SERVER_HOST, m.SERVER_PORT = {host!r}, {server_port}\n"
+    "m.main()\n"
+)
+
+
+def start_process(code: str, port: int, ready_line: str = None, timeout: float = 10.0) -> subprocess.Popen:
+    """
+    Avvia uno dei programmi del progetto e attende che la porta accetti connessioni.
+    Con ready_line si attende invece quella riga sull'output: serve per mitm_proxy.py,
+    dove la prova di connessione aprirebbe una sessione intercettata (e un handshake fallito) a vuoto.
+    """
+    proc = subprocess.Popen(
+        [sys.executable, '-u', '-W', 'ignore', '-c', code], cwd=HERE,
+        stdout=subprocess.PIPE if ready_line else subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if ready_line:
+        ready = threading.Event()
+
+        def drain():
+            # Si continua a leggere l'output per non bloccare il processo a pipe piena
+            for line in proc.stdout:
+                if ready_line.encode() in line:
+                    ready.set()
+
+        threading.Thread(target=drain, daemon=True).start()
+        if ready.wait(timeout):
+            return proc
+        proc.kill()
+        raise RuntimeError(f"Timeout in attesa della porta {port}")
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"Il processo sulla porta {port} è terminato all'avvio")
+        try:
+            socket.create_connection((HOST, port), timeout=0.2).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError(f"Timeout in attesa della porta {port}")
+
+
+def stop_process(proc: subprocess.Popen) -> None:
+    proc.terminate()
+    try:
+        proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+def percentile(samples, q: float) -> float:
+    """
+    Percentile con metodo nearest-rank (q tra 0 e 100).
+    """
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(samples) -> dict:
+    # Tempi in millisecondi, arrotondati per risultati leggibili e facili da confrontare
+    return {
+        'count': len(samples),
+        'mean_ms': round(1000 * sum(samples) / len(samples), 4) if samples else 0.0,
+        'p50_ms': round(1000 * percentile(samples, 50), 4),
+        'p99_ms': round(1000 * percentile(samples, 99), 4),
+    }
+
+
+class ChatConnection:
+    """
+    Client non interattivo del protocollo DH/X25519 + AES-GCM di server.py/client.py.
+    """
+
+    def __init__(self, port: int, modes=HANDSHAKE_MODES, suites=SUPPORTED_SUITES):
+        self.sock = socket.create_connection((HOST, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # Niente ticket: ogni connessione misura un handshake completo
+        self.send_cipher, self.recv_cipher = handshake(self.sock, modes, ticket_file=None, verbose=False,
+                                                       suites=suites)
+        self.reader = FrameReader(self.sock)
+
+    def echo(self, payload: bytes) -> bytes:
+        send_encrypted(self.sock, self.send_cipher, payload)
+        return recv_decrypted(self.reader, self.recv_cipher)
+
+    def close(self) -> None:
+        self.sock.close()
+
+
+class TLSConnection:
+    """
+    Client non interattivo per la coppia TLS_SERVER.py/TLS_CLIENT.py.
+    """
+    context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+    # Certificato autofirmato di test, come in TLS_CLIENT.py
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+
+    def __init__(self, port: int):
+        raw = socket.create_connection((HOST, port))
+        raw.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = self.context.wrap_socket(raw, server_hostname='localhost')
+
+    def echo(self, payload: bytes) -> bytes:
+        self.sock.sendall(payload)
+        # Il server TLS rimanda a blocchi di al più TLS_SERVER.BUFFER_SIZE byte (64 KiB), e TCP può spezzarli
+        # ulteriormente: leggiamo fino alla dimensione inviata
+        data = bytearray()
+        while len(data) < len(payload):
+            chunk = self.sock.recv(len(payload) - len(data))
+            if not chunk:
+                raise EOFError("Connection closed")
+            data += chunk
+        return bytes(data)
+
+    def close(self) -> None:
+        self.sock.close()
+
+
+def run_scenario(connect, size: int, concurrency: int, messages: int) -> dict:
+    """
+    Apre concurrency connessioni in parallelo e invia messages echo da size byte su ciascuna.
+    """
+    # Testo casuale ASCII: mitm_proxy.py stampa i messaggi decodificati come UTF-8
+    payload = base64.b64encode(os.urandom(size))[:size]
+    handshakes, rtts, errors, phases = [], [], [], []
+    lock = threading.Lock()
+
+    def worker():
+        conn = None
+        local_rtts = []
+        try:
+            start = time.perf_counter()
+            conn = connect()
+            with lock:
+                handshakes.append(time.perf_counter() - start)
+            # Nessuna barriera tra le connessioni: ciascuna parte appena ha finito l'handshake.
+            # Tutti i server misurati le servono in parallelo (TLS_SERVER.py con worker in fork
+            # e un thread per connessione, async_server.py su un unico event loop)
+            phase_start = time.perf_counter()
+            for _ in range(messages):
+                start = time.perf_counter()
+                if conn.echo(payload) != payload:
+                    raise ValueError("Echo diverso dal messaggio inviato")
+                local_rtts.append(time.perf_counter() - start)
+            with lock:
+                phases.append((phase_start, time.perf_counter()))
+        except Exception as e:
+            with lock:
+                errors.append(repr(e))
+        finally:
+            with lock:
+                rtts.extend(local_rtts)
+            if conn is not None:
+                conn.close()
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # Il throughput considera solo la fase di echo, dal primo invio all'ultima risposta
+    wall = max(end for _, end in phases) - min(begin for begin, _ in phases) if phases else 0.0
+
+    return {
+        'size': size,
+        'concurrency': concurrency,
+        'messages_per_connection': messages,
+        'handshake': summarize(handshakes),
+        'rtt': summarize(rtts),
+        'throughput_msgs_per_s': round(len(rtts) / wall, 2) if wall else 0.0,
+        'throughput_mb_per_s': round(len(rtts) * size / wall / 1e6, 4) if wall else 0.0,
+        'errors': errors[:5],
+    }
+
+# Intestazione dei messaggi del benchmark della stanza: [istante di invio (perf_counter):8][mittente:4][numero:4]
+ROOM_BENCH_HEADER = struct.Struct('>dII')
+
+
+def room_bench(host: str, port: int, members: int, senders: int, messages: int, size: int, rate: float) -> None:
+    """
+    Collega members client alla stanza (async_server.py con ROOM_MODE); senders di loro inviano
+    messages messaggi ciascuno e tutti misurano la latenza di consegna di ogni messaggio ricevuto.
+    """
+    conns = []
+    for _ in range(members):
+        sock = socket.create_connection((host, port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        send_cipher, recv_cipher = handshake(sock, ticket_file=None, verbose=False)
+        conns.append((sock, send_cipher, recv_cipher))
+    expected = senders * messages
+    latencies = []
+    counts = []
+    lock = threading.Lock()
+
+    def receiver(sock, recv_cipher):
+        reader = FrameReader(sock)
+        local = []
+        try:
+            while len(local) < expected:
+                msg = recv_decrypted(reader, recv_cipher)
+                now = time.perf_counter()
+                sent_at, _, _ = ROOM_BENCH_HEADER.unpack_from(msg.partition(b': ')[2])
+                local.append(now - sent_at)
+        except (EOFError, OSError, ValueError):
+            pass
+        with lock:
+            latencies.extend(local)
+            counts.append(len(local))
+
+    def sender(index, sock, send_cipher):
+        padding = bytes(max(0, size - ROOM_BENCH_HEADER.size))
+        for n in range(messages):
+            send_encrypted(sock, send_cipher, ROOM_BENCH_HEADER.pack(time.perf_counter(), index, n) + padding)
+            if rate:
+                time.sleep(1 / rate)
+
+    receivers = [threading.Thread(target=receiver, args=(sock, recv), daemon=True) for sock, _, recv in conns]
+    for t in receivers:
+        t.start()
+    start = time.perf_counter()
+    senders_threads = [threading.Thread(target=sender, args=(i, sock, send), daemon=True)
+                       for i, (sock, send, _) in enumerate(conns[:senders])]
+    for t in senders_threads:
+        t.start()
+    for t in senders_threads:
+        t.join()
+    for t in receivers:
+        # Un membro espulso o che ha perso messaggi non arriva mai al totale atteso
+        t.join(timeout=max(10.0, ROOM_SEND_TIMEOUT * 2))
+    elapsed = time.perf_counter() - start
+    for sock, _, _ in conns:
+        sock.close()
+
+    delivered = len(latencies)
+    print(f"[*] {members} membri, {senders} mittenti, {expected} messaggi da {size} byte")
+    print(f"[*] {delivered}/{expected * members} consegne in {elapsed:.3f}s "
+          f"({delivered / elapsed if elapsed else 0:.1f} consegne/s), "
+          f"membri incompleti: {sum(1 for c in counts if c < expected) + members - len(counts)}")
+    print("[*] latenza di consegna " + ' '.join(
+        f"p{q:g}={1000 * percentile(latencies, q):.3f}ms" for q in (50, 90, 99)) +
+        (f" max={1000 * max(latencies):.3f}ms" if latencies else ''))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark su loopback: canale DH+AES-GCM contro TLS")
+    parser.add_argument('--targets', default='chat,tls', help="Elenco tra chat, tls, mitm")
+    parser.add_argument('--sizes', default='16,1024,16384,65536', help="Dimensioni dei messaggi in byte")
+    parser.add_argument('--concurrency', default='1,8', help="Numero di connessioni parallele")
+    parser.add_argument('--messages', type=int, default=200, help="Echo per connessione")
+    parser.add_argument('--modes', default=','.join(HANDSHAKE_MODES), help="Modalità offerte dal client chat")
+    parser.add_argument('--suites', default=','.join(SUPPORTED_SUITES),
+                        help="Suite AEAD offerte dal client chat (il server sceglie tra queste)")
+    parser.add_argument('--output', help="File JSON dei risultati (default: stdout)")
+    parser.add_argument('--room', action='store_true',
+                        help="Benchmark del fan-out della chat di gruppo (async_server.py con ROOM_MODE) "
+                             "invece del confronto con TLS; --messages sono i messaggi per mittente")
+    parser.add_argument('--room-server', metavar='HOST:PORT',
+                        help="Con --room usa una stanza già avviata invece di avviarne una in locale")
+    parser.add_argument('--members', type=int, default=50, help="Client collegati alla stanza (con --room)")
+    parser.add_argument('--senders', type=int, default=1, help="Membri che inviano messaggi (con --room)")
+    parser.add_argument('--rate', type=float, default=0,
+                        help="Messaggi al secondo per mittente, 0 = massimo (con --room)")
+    args = parser.parse_args()
+
+    sizes = [int(x) for x in args.sizes.split(',')]
+    if args.room:
+        senders = min(args.senders, args.members)
+        if args.room_server:
+            host, port = args.room_server.rsplit(':', 1)
+            for size in sizes:
+                room_bench(host, int(port), args.members, senders, args.messages, size, args.rate)
+            return
+        server = start_process(ROOM_SERVER_CODE.format(host=HOST, port=CHAT_PORT), CHAT_PORT)
+        try:
+            for size in sizes:
+                room_bench(HOST, CHAT_PORT, args.members, senders, args.messages, size, args.rate)
+        finally:
+            stop_process(server)
+        return
+
+    targets = args.targets.split(',')
+    levels = [int(x) for x in args.concurrency.split(',')]
+    modes = tuple(args.modes.split(','))
+    suites = tuple(args.suites.split(','))
+    if set(suites) - set(SUPPORTED_SUITES):
+        parser.error(f"--suites: suite disponibili {', '.join(SUPPORTED_SUITES)}")
+
+    results = []
+    servers = []
+    try:
+        if 'chat' in targets or 'mitm' in targets:
+            servers.append(start_process(CHAT_SERVER_CODE.format(host=HOST, port=CHAT_PORT), CHAT_PORT))
+        if 'tls' in targets:
+            servers.append(start_process(TLS_SERVER_CODE.format(host=HOST, port=TLS_PORT), TLS_PORT))
+        if 'mitm' in targets:
+            # Il proxy davanti al server chat; si attende la riga di avvio per non
+            # aprire una sessione intercettata a vuoto con la prova di connessione
+            servers.append(start_process(
+                MITM_CODE.format(host=HOST, port=MITM_PORT, server_port=CHAT_PORT), MITM_PORT,
+                ready_line='MITM in ascolto'))
+
+        for target in targets:
+            for concurrency in levels:
+                for size in sizes:
+                    if target == 'chat':
+                        connect = lambda: ChatConnection(CHAT_PORT, modes, suites)
+                    elif target == 'tls':
+                        connect = lambda: TLSConnection(TLS_PORT)
+                    elif target == 'mitm':
+                        connect = lambda: ChatConnection(MITM_PORT, modes, suites)
+                    else:
+                        raise SystemExit(f"Target sconosciuto: {target}")
+                    result = run_scenario(connect, size, concurrency, args.messages)
+                    result['target'] = target
+                    results.append(result)
+                    print(f"[*] {target:5} size={size:<6} conn={concurrency:<3} "
+                          f"hs_p50={result['handshake']['p50_ms']}ms rtt_p50={result['rtt']['p50_ms']}ms "
+                          f"rtt_p99={result['rtt']['p99_ms']}ms {result['throughput_msgs_per_s']} msg/s",
+                          file=sys.stderr)
+    finally:
+        for proc in servers:
+            stop_process(proc)
+
+    # Risultati leggibili da macchina, con abbastanza contesto per confrontare versioni diverse
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'cryptography': cryptography.__version__,
+            'openssl': ssl.OPENSSL_VERSION,
+            'platform': platform.platform(),
+            'modes': list(modes),
+            'suites': list(suites),
+            'messages_per_connection': args.messages,
+        },
+        'results': results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+# Punto di ingresso dello script
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+import mmap
+import os
+import struct
+import threading
+import time
+from common import MODE_IDS, MODE_NAMES, SUITE_IDS, SUITE_NAMES, DEFAULT_SUITE, HANDSHAKE_VERSION
+
+# Formato del file di cattura (solo in append):
+#   intestazione  MAGIC
+#   record        [tipo:1][sessione:4][direzione:1][timestamp_ns:8][lunghezza:4][payload]
+# Il file indice (percorso + '.idx') contiene una voce a dimensione fissa per record
+#   [offset:8][sessione:4][tipo:1][direzione:1][riservato:2]
+# così il lettore trova i record di una sessione senza scandire tutto il file.
+# L'ultimo byte di MAGIC è la versione dell'handshake: entra nella derivazione HKDF (common.derive_key),
+# quindi i segreti di una cattura fatta con un'altra versione non producono più le stesse chiavi.
+MAGIC_PREFIX = b'SCCAP\x00\x02'
+MAGIC = MAGIC_PREFIX + bytes([HANDSHAKE_VERSION])
+RECORD_HEADER = struct.Struct('>BIBQI')
+INDEX_ENTRY = struct.Struct('>QIBBH')
+
+# Tipi di record
+REC_SESSION = 1   # inizio sessione: modalità e, se richiesto, segreti condivisi
+REC_FRAME = 2     # frame cifrato così come ricevuto (senza prefisso di lunghezza)
+REC_END = 3       # fine sessione
+REC_KEY_UPDATE = 4   # frame di aggiornamento chiavi (vedi common.key_update_segments)
+
+# Direzioni dei frame
+CLIENT_TO_SERVER = 0
+SERVER_TO_CLIENT = 1
+DIRECTION_NAMES = {CLIENT_TO_SERVER: 'Client -> Server', SERVER_TO_CLIENT: 'Server -> Client'}
+
+
+def encode_session_keys(client_mode: str, client_shared: bytes, server_mode: str, server_shared: bytes,
+                        client_suite: str = DEFAULT_SUITE, server_suite: str = DEFAULT_SUITE) -> bytes:
+    """
+    Payload di REC_SESSION: [modo_client:1][modo_server:1][len:2][segreto client][len:2][segreto server]
+    [suite_client:1][suite_server:1].
+    """
+    return (bytes([MODE_IDS[client_mode], MODE_IDS[server_mode]])
+            + struct.pack('>H', len(client_shared)) + client_shared
+            + struct.pack('>H', len(server_shared)) + server_shared
+            + bytes([SUITE_IDS[client_suite], SUITE_IDS[server_suite]]))
+
+
+def decode_session_keys(payload):
+    """
+    Decodifica encode_session_keys e restituisce
+    (client_mode, client_shared, server_mode, server_shared, client_suite, server_suite).
+    I segreti sono vuoti se la cattura è stata fatta senza chiavi.
+    """
+    payload = bytes(payload)
+    client_mode, server_mode = MODE_NAMES[payload[0]], MODE_NAMES[payload[1]]
+    (length,) = struct.unpack_from('>H', payload, 2)
+    client_shared = payload[4:4 + length]
+    offset = 4 + length
+    (length,) = struct.unpack_from('>H', payload, offset)
+    server_shared = payload[offset + 2:offset + 2 + length]
+    client_suite, server_suite = SUITE_NAMES[payload[offset + 2 + length]], SUITE_NAMES[payload[offset + 3 + length]]
+    return client_mode, client_shared, server_mode, server_shared, client_suite, server_suite
+
+
+def check_magic(header: bytes) -> None:
+    """
+    Verifica l'intestazione di una cattura; ValueError se il formato o la versione non sono quelli attuali.
+    """
+    if header == MAGIC:
+        return
+    if header[:len(MAGIC_PREFIX)] == MAGIC_PREFIX:
+        raise ValueError(f"Cattura della versione {header[-1]} dell'handshake, questa è la {HANDSHAKE_VERSION}: "
+                         f"le chiavi non sono più derivabili")
+    if header[:len(MAGIC_PREFIX) - 1] == MAGIC_PREFIX[:-1]:
+        raise ValueError("Cattura in un formato precedente (senza versione dell'handshake): non più supportata")
+    raise ValueError("Non è un file di cattura (intestazione non valida)")
+
+
+class CaptureWriter:
+    """
+    Scrittura in append dei frame intercettati e del relativo indice.
+    Con keys=True salva anche i segreti di sessione, necessari per decifrare e ri-iniettare.
+    """
+
+    def __init__(self, path: str, keys: bool = False):
+        self.path = path
+        self.keys = keys
+        self._lock = threading.Lock()
+        # Mai aggiungere record a una cattura in un altro formato (o di un'altra versione dell'handshake)
+        if os.path.exists(path) and os.path.getsize(path):
+            with open(path, 'rb') as f:
+                check_magic(f.read(len(MAGIC)))
+        # Il file può contenere segreti di sessione: leggibile solo dall'utente corrente
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        self._data = os.fdopen(fd, 'ab')
+        fd = os.open(path + '.idx', os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o600)
+        self._index = os.fdopen(fd, 'a+b')
+        self._offset = self._data.seek(0, os.SEEK_END)
+        if self._offset == 0:
+            self._data.write(MAGIC)
+            self._offset = len(MAGIC)
+        # Le sessioni di esecuzioni precedenti restano nel file: si riparte dall'ultimo numero usato
+        self._next_session = 1
+        self._index.seek(0)
+        entries = self._index.read()
+        for (_, session, _, _, _) in INDEX_ENTRY.iter_unpack(entries[:len(entries) - len(entries) % INDEX_ENTRY.size]):
+            self._next_session = max(self._next_session, session + 1)
+
+    def _append(self, rec_type: int, session: int, direction: int, payload) -> None:
+        header = RECORD_HEADER.pack(rec_type, session, direction, time.time_ns(), len(payload))
+        with self._lock:
+            self._data.write(header)
+            self._data.write(payload)
+            self._index.write(INDEX_ENTRY.pack(self._offset, session, rec_type, direction, 0))
+            self._offset += len(header) + len(payload)
+
+    def start_session(self, client_mode: str, client_shared: bytes, server_mode: str, server_shared: bytes,
+                      client_suite: str = DEFAULT_SUITE, server_suite: str = DEFAULT_SUITE) -> int:
+        """
+        Registra una nuova sessione e restituisce il suo numero nel file di cattura.
+        """
+        if not self.keys:
+            # Solo le modalità: il file resta analizzabile (tempi, dimensioni) ma non decifrabile
+            client_shared = server_shared = b''
+        with self._lock:
+            session = self._next_session
+            self._next_session += 1
+        self._append(REC_SESSION, session, 0, encode_session_keys(
+            client_mode, client_shared, server_mode, server_shared, client_suite, server_suite))
+        return session
+
+    def frame(self, session: int, direction: int, blob, key_update: bool = False) -> None:
+        """
+        Registra un frame cifrato così come è arrivato dalla rete.
+        """
+        self._append(REC_KEY_UPDATE if key_update else REC_FRAME, session, direction, blob)
+
+    def end_session(self, session: int) -> None:
+        self._append(REC_END, session, 0, b'')
+
+    def flush(self) -> None:
+        with self._lock:
+            self._data.flush()
+            self._index.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._data.close()
+            self._index.close()
+
+
+class CaptureRecord:
+    """
+    Record letto da una cattura; payload è una vista sulla mmap, valida finché il lettore è aperto.
+    """
+    __slots__ = ('type', 'session', 'direction', 'timestamp_ns', 'payload')
+
+    def __init__(self, rec_type, session, direction, timestamp_ns, payload):
+        self.type = rec_type
+        self.session = session
+        self.direction = direction
+        self.timestamp_ns = timestamp_ns
+        self.payload = payload
+
+
+class CaptureReader:
+    """
+    Lettura di una cattura tramite mmap: i payload non vengono copiati in memoria.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        if size < len(MAGIC):
+            raise ValueError("File di cattura vuoto o troncato")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        try:
+            check_magic(self._map[:len(MAGIC)])
+        except ValueError:
+            self.close()
+            raise
+        self._offsets = self._load_index()
+
+    def _load_index(self):
+        # L'indice è facoltativo: se manca o è incompleto i record vengono trovati scandendo il file
+        try:
+            with open(self.path + '.idx', 'rb') as f:
+                entries = f.read()
+        except OSError:
+            entries = b''
+        entries = entries[:len(entries) - len(entries) % INDEX_ENTRY.size]
+        offsets = [(offset, session) for offset, session, _, _, _ in INDEX_ENTRY.iter_unpack(entries)
+                   if offset + RECORD_HEADER.size <= len(self._map)]
+        if offsets:
+            return offsets
+        offsets = []
+        offset = len(MAGIC)
+        while offset + RECORD_HEADER.size <= len(self._map):
+            _, session, _, _, length = RECORD_HEADER.unpack_from(self._map, offset)
+            offsets.append((offset, session))
+            offset += RECORD_HEADER.size + length
+        return offsets
+
+    def _record_at(self, offset: int):
+        rec_type, session, direction, timestamp_ns, length = RECORD_HEADER.unpack_from(self._map, offset)
+        start = offset + RECORD_HEADER.size
+        if start + length > len(self._map):
+            # Ultimo record scritto a metà (es. proxy interrotto): lo ignoriamo
+            return None
+        return CaptureRecord(rec_type, session, direction, timestamp_ns, self._view[start:start + length])
+
+    def records(self, sessions=None):
+        """
+        Itera sui record in ordine di scrittura, eventualmente solo per le sessioni indicate.
+        """
+        for offset, session in self._offsets:
+            if sessions is not None and session not in sessions:
+                continue
+            record = self._record_at(offset)
+            if record is not None:
+                yield record
+
+    def sessions(self) -> dict:
+        """
+        Restituisce {sessione: (client_mode, client_shared, server_mode, server_shared, client_suite, server_suite)}.
+        """
+        return {record.session: decode_session_keys(record.payload)
+                for record in self.records() if record.type == REC_SESSION}
+
+    def close(self) -> None:
+        self._view.release()
+        try:
+            self._map.close()
+        except BufferError:
+            # Qualche record è ancora referenziato (es. chiusura durante un'eccezione):
+            # la mappa verrà liberata dal garbage collector insieme a lui
+            pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,13 +1,84 @@
 #!/usr/bin/env python3
+import os
 import socket
-from cryptography.hazmat.primitives.asymmetric import dh
-from common import derive_key, send_encrypted, recv_decrypted
-from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+import threading
+import time
+from cryptography.exceptions import InvalidTag
+from common import send_encrypted, recv_decrypted, FrameReader, HANDSHAKE_MODES, SUPPORTED_SUITES
+import metrics
+from protocol import Connection, BlockingConnection
+from resumption import ClientTicket
 
 # Configurazione dell'indirizzo e porta del server a cui connettersi
 HOST = '127.0.0.1'
 # Utilizziamo la porta 65433, assicurandoci che corrisponda a quella su cui ascolta il server
 PORT = 65433
+# File in cui conservare il ticket di ripresa tra un'esecuzione e l'altra
+# (accanto a questo modulo, qualunque sia la directory da cui si avvia il client)
+TICKET_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'session.ticket')
+# Suite AEAD offerte al server (la scelta finale spetta a lui)
+CIPHER_SUITES = SUPPORTED_SUITES
+# Compressione offerta al server, es. ('zlib',). Vuota di default: la dimensione dei frame
+# compressi rivela informazioni sul contenuto (vedi common.COMPRESSION_IDS), attivarla solo
+# se nei messaggi non si mescolano segreti e testo scelto da altri
+COMPRESSION = ()
+# True per una chat di gruppo (async_server.py con ROOM_MODE): i messaggi degli altri membri
+# arrivano in qualunque momento e vengono stampati da un thread separato
+ROOM_MODE = False
+
+def handshake(sock: socket.socket, modes=HANDSHAKE_MODES, ticket_file=TICKET_FILE, verbose: bool = True,
+              stats=None, suites=CIPHER_SUITES, compression=None):
+    """
+    Esegue l'handshake lato client su un socket connesso e restituisce (send_cipher, recv_cipher).
+    Con ticket_file=None non offre né salva ticket di ripresa; con verbose=False non stampa nulla.
+    suites sono le suite AEAD offerte al server, compression gli algoritmi di compressione
+    (None: quelli di COMPRESSION).
+    stats (metrics.ConnectionStats) riceve le latenze dell'handshake e viene collegato ai cifrari.
+    """
+    log = print if verbose else (lambda *args: None)
+    start = time.perf_counter()
+
+    # 2) Offerta delle modalità di scambio chiavi (X25519, poi DH) e delle suite AEAD,
+    # con l'eventuale ticket di una sessione precedente per saltare lo scambio di chiavi.
+    # I messaggi dell'handshake sono quelli della macchina a stati protocol.Connection,
+    # qui eseguita sul socket dall'adattatore bloccante
+    ticket = ClientTicket.load(ticket_file) if ticket_file else None
+    conn = Connection(server_side=False, modes=modes, suites=suites, ticket=ticket, stats=stats,
+                      compression=COMPRESSION if compression is None else compression)
+    log(f"[>] ClientHello: modalità {', '.join(modes)}{', ticket di ripresa' if ticket else ''}")
+
+    # 3-6) ServerHello, scambio delle chiavi pubbliche (o ripresa), segreto condiviso,
+    # derivazione con HKDF di chiave e sale per ciascuna direzione
+    result = BlockingConnection(sock, conn).handshake()
+    log(f"[<] Modalità scelta dal server: {result.mode}, suite {result.suite}"
+        + (f", compressione {result.compression}" if result.compression else ''))
+    log("[*] Sessione ripresa dal ticket" if result.resumed else "[*] Shared key derivata")
+
+    # 7) Salvataggio del nuovo ticket (un ticket vale una sola volta)
+    if result.ticket and ticket_file:
+        result.ticket.save(ticket_file)
+    metrics.observe('handshake', time.perf_counter() - start, stats)
+    return conn.send_cipher, conn.recv_cipher
+
+def print_incoming(reader: FrameReader, recv_cipher, sock: socket.socket) -> None:
+    """
+    Stampa i messaggi della stanza man mano che arrivano (gira su un thread separato).
+    Alla fine chiude il socket in entrambe le direzioni, così anche il loop di invio termina.
+    """
+    try:
+        while True:
+            msg = recv_decrypted(reader, recv_cipher)
+            print(f"\n[Stanza] {msg.decode(errors='replace')}")
+    except (EOFError, OSError):
+        print("\n[!] Connessione terminata")
+    except (ValueError, InvalidTag) as e:
+        # Frame manomesso o fuori sequenza: il canale non è più affidabile
+        print(f"\n[!] Connessione chiusa per errore di protocollo: {e!r}")
+    finally:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
 def main():
     # 1) Configurazione della connessione TCP
@@ -18,48 +89,17 @@ def main():
         s.connect((HOST, PORT))
         print(f"[+] Connesso a {HOST}:{PORT}")
 
-        # 2) Ricezione parametri Diffie-Hellman dal server
-        # Il server invia i parametri necessari (p, g) e la sua chiave pubblica
-        data = s.recv(8192).decode()
-        p_str, g_str, server_pub_str = data.split(',')
-        # Convertiamo le stringhe ricevute nei rispettivi valori interi
-        p, g = int(p_str), int(g_str)
-        server_pub_int = int(server_pub_str)
-        print("[<] Ricevuti p, g e g^b mod p dal server")
-
-        # 3) Ricostruzione parametri e generazione chiavi
-        # Ricostruiamo gli oggetti dei parametri DH usando i valori ricevuti
-        params_nums = dh.DHParameterNumbers(p, g)
-        parameters = params_nums.parameters()
-        # Generiamo la chiave privata del client (a)
-        client_priv = parameters.generate_private_key()
-        # Calcoliamo la chiave pubblica del client (g^a mod p)
-        client_pub  = client_priv.public_key().public_numbers().y
-
-        # 4) Invio della chiave pubblica al server
-        # Il server ha bisogno della nostra chiave pubblica per calcolare il segreto condiviso
-        s.sendall(str(client_pub).encode())
-        print("[>] Inviato g^a mod p al server")
-
-        # 5) Calcolo del segreto condiviso
-        # Ricostruiamo l'oggetto della chiave pubblica del server
-        server_pub_nums = dh.DHPublicNumbers(server_pub_int, params_nums)
-        server_pub_key  = server_pub_nums.public_key()
-        # Calcoliamo il segreto condiviso: (g^b)^a mod p = g^(ab) mod p
-        # DH permette ad entrambe le parti di calcolare lo stesso segreto
-        # senza mai trasmetterlo in chiaro sul canale
-        shared_key = client_priv.exchange(server_pub_key)
-        print("[*] Shared key derivata")
+        # 2-7) Handshake: negoziazione, scambio di chiavi (o ripresa) e ticket
+        stats = metrics.connection((HOST, PORT))
+        send_cipher, recv_cipher = handshake(s, stats=stats)
 
-        # 6) Derivazione chiave AES e setup del cifrario
-        # La shared_key non è utilizzabile direttamente per la crittografia
-        # Deriviamo una chiave adatta usando una KDF (Key Derivation Function)
-        key = derive_key(shared_key)
-        # Inizializziamo l'algoritmo AES-GCM che fornisce
-        # sia confidenzialità che autenticità dei messaggi
-        aesgcm = AESGCM(key)
+        # Lettore di frame con buffer riutilizzabile per le risposte del server
+        reader = FrameReader(s)
+        reader.stats = stats
+        if ROOM_MODE:
+            threading.Thread(target=print_incoming, args=(reader, recv_cipher, s), daemon=True).start()
 
-        # 7) Loop di chat cifrata
+        # 8) Loop di chat cifrata
         # Il client invia messaggi cifrati al server e riceve risposte
         try:
             while True:
@@ -69,19 +109,31 @@ def main():
                 if not text:
                     break
                 # Cifriamo e inviamo il messaggio al server
-                # La funzione gestisce la generazione del nonce e la cifratura
-                send_encrypted(s, aesgcm, text)
+                # Il nonce è ricavato dal contatore di sequenza del client
+                send_encrypted(s, send_cipher, text)
+                if ROOM_MODE:
+                    # La copia del messaggio arriva dalla stanza, insieme a quelli degli altri
+                    continue
                 # Riceviamo e decifriamo la risposta del server
-                # recv_decrypted gestisce l'estrazione del nonce e la verifica dell'integrità
-                resp = recv_decrypted(s, aesgcm)
+                # recv_decrypted verifica integrità e numero di sequenza
+                resp = recv_decrypted(reader, recv_cipher)
                 # Visualizziamo la risposta ricevuta
                 print(f"[Server] {resp.decode()!r}")
-        except (EOFError, socket.timeout):
-            # Gestione della terminazione della connessione o timeout
+        except (EOFError, OSError):
+            # Gestione della terminazione della connessione o timeout (socket.timeout è un OSError)
             print("[!] Connessione terminata")
+        except (ValueError, InvalidTag) as e:
+            # Frame oltre MAX_FRAME_SIZE, nonce fuori sequenza o tag non valido:
+            # la risposta è malformata o manomessa, chiudiamo la connessione
+            print(f"[!] Connessione chiusa per errore di protocollo: {e!r}")
         finally:
             # Garantisce la chiusura della connessione in ogni caso
             s.close()
+            if stats is not None:
+                # Con le metriche attive, un riepilogo per fase a fine sessione
+                for phase, summary in metrics.snapshot()['phases'].items():
+                    print(f"[metrics] {phase}: {summary}")
+                metrics.close(stats)
 
 # Punto di ingresso dello script
 if __name__ == '__main__':
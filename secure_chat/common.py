@@ -1,13 +1,184 @@
 import socket
 import os
 import struct
+import threading
+import time
+import zlib
+from cryptography.exceptions import InvalidTag, UnsupportedAlgorithm
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCMSIV
+except ImportError:
+    # AES-GCM-SIV richiede cryptography >= 42 (e un OpenSSL che lo implementi)
+    AESGCMSIV = None
+try:
+    import lzma
+except ImportError:
+    # Python compilato senza liblzma: resta disponibile solo zlib
+    lzma = None
+import metrics
 
-def derive_key(shared_key: bytes) -> bytes:
+# Versione del protocollo di handshake e modalità di scambio chiavi supportate,
+# in ordine di preferenza: X25519 (ECDH, chiavi da 32 byte) e poi DH classico
+# (versione 2: il ServerHello indica anche la suite AEAD scelta;
+# versione 3: e l'algoritmo di compressione, 0 se nessuno)
+HANDSHAKE_VERSION = 3
+HANDSHAKE_MODES = ('x25519', 'dh')
+# Identificativi a un byte delle modalità nei messaggi di handshake binari
+# ('resume' non viene mai offerta: il server la sceglie se accetta un ticket di ripresa)
+MODE_IDS = {'x25519': 1, 'dh': 2, 'resume': 3}
+MODE_NAMES = {v: k for k, v in MODE_IDS.items()}
+# Estensioni del ClientHello
+EXT_RESUME = 1    # client_random(32) || ticket di ripresa
+EXT_SUITES = 2    # suite_id(1) * n: suite AEAD supportate dal client
+EXT_COMPRESSION = 3   # compression_id(1) * n: algoritmi di compressione accettati dal client
+# Suite AEAD negoziabili: tutte con chiave da 32 byte, nonce da 12 e tag da 16 byte,
+# quindi formato dei frame, nonce a contatore e derivazione delle chiavi restano identici
+SUITE_IDS = {'aes256gcm': 1, 'chacha20poly1305': 2, 'aes256gcmsiv': 3}
+SUITE_NAMES = {v: k for k, v in SUITE_IDS.items()}
+AEAD_CLASSES = {'aes256gcm': AESGCM, 'chacha20poly1305': ChaCha20Poly1305}
+if AESGCMSIV is not None:
+    AEAD_CLASSES['aes256gcmsiv'] = AESGCMSIV
+# Suite usata se il client non ne offre nessuna
+DEFAULT_SUITE = 'aes256gcm'
+# Durata complessiva del micro-benchmark di ciascuna suite (secondi) e dimensioni dei messaggi
+SUITE_BENCH_TIME = 0.05
+SUITE_BENCH_SIZES = (64, 1024, 16384)
+# Compressione prima della cifratura, negoziata nell'handshake (0 nel ServerHello = nessuna).
+# ATTENZIONE: la lunghezza del testo compresso dipende dal contenuto. Se nello stesso frame
+# (o nello stesso contesto di compressione) finiscono un segreto e dati scelti da un attaccante,
+# chi osserva le dimensioni dei frame può ricostruire il segreto un byte alla volta (attacchi
+# CRIME/BREACH). Per questo i client non la offrono di default e i frame che mescolano dati
+# di più parti (es. la stanza di room.py) non vengono compressi (encrypt_segments(compress=False))
+COMPRESSION_IDS = {'zlib': 1, 'lzma': 2}
+COMPRESSION_NAMES = {v: k for k, v in COMPRESSION_IDS.items()}
+SUPPORTED_COMPRESSION = tuple(name for name in COMPRESSION_IDS if name != 'lzma' or lzma is not None)
+DECOMPRESSION_ERRORS = (zlib.error, EOFError) + ((lzma.LZMAError,) if lzma is not None else ())
+# Messaggi più corti di così vengono cifrati senza comprimerli: il guadagno sarebbe nullo
+COMPRESSION_THRESHOLD = 256
+# Livello di zlib (1 veloce ... 9 compatto) e preset di lzma (0 ... 9)
+COMPRESSION_LEVEL = 6
+LZMA_PRESET = 6
+# Finestra di lzma: con il default del preset (8 MiB) preparare il codificatore costerebbe
+# più della compressione stessa di un messaggio, che qui avviene frame per frame
+LZMA_DICT_SIZE = 1 << 16
+# Dizionario iniziale di zlib (testo tipico della chat): deve essere identico sulle due parti.
+# None per partire da un contesto vuoto
+COMPRESSION_DICTIONARY = None
+# Il secondo bit più alto della lunghezza marca un frame compresso; il flag è anche
+# nei dati associati, quindi chi lo altera fa fallire il tag invece di cambiare il contenuto
+FRAME_COMPRESSED = 0x40000000
+COMPRESSED_AAD = b'compressed'
+# Dimensione massima accettata per un singolo frame (handshake o messaggio cifrato)
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+# Se True il nonce di 12 byte viaggia in ogni frame (utile per il debug); altrimenti
+# entrambe le parti lo ricavano dal proprio contatore di sequenza
+EXPLICIT_NONCE = False
+# Aggiornamento delle chiavi in sessione: il mittente ricava una nuova chiave con HKDF
+# dopo REKEY_MESSAGES messaggi o REKEY_BYTES byte, ben prima dei limiti d'uso di AES-GCM
+# (RFC 8446 §5.5 indica circa 2^24.5 record per chiave)
+REKEY_MESSAGES = 1 << 24
+REKEY_BYTES = 1 << 36
+# Il bit più alto della lunghezza nell'header marca un frame di controllo di aggiornamento
+# chiavi: le lunghezze reali non superano MAX_FRAME_SIZE e non usano mai i due bit alti
+FRAME_KEY_UPDATE = 0x80000000
+FRAME_LENGTH_MASK = 0x3FFFFFFF
+# Dati associati del frame di aggiornamento: non può essere scambiato per un messaggio
+KEY_UPDATE_AAD = b'key update'
+
+def choose_mode(offered, supported=HANDSHAKE_MODES) -> str:
+    """
+    Sceglie la prima modalità offerta dal client che sia supportata localmente.
+    """
+    for mode in offered:
+        if mode in supported:
+            return mode
+    raise ValueError(f"Nessuna modalità di handshake in comune: {offered!r}")
+
+def _suite_available(suite: str) -> bool:
+    # Alcune build di OpenSSL espongono la classe ma rifiutano l'algoritmo alla creazione
+    try:
+        AEAD_CLASSES[suite](bytes(32))
+    except UnsupportedAlgorithm:
+        return False
+    return True
+
+# Suite utilizzabili con la libreria installata, nell'ordine di SUITE_IDS
+SUPPORTED_SUITES = tuple(suite for suite in SUITE_IDS if suite in AEAD_CLASSES and _suite_available(suite))
+
+def choose_suite(offered, preference=SUPPORTED_SUITES) -> str:
+    """
+    Sceglie la suite AEAD: la prima, nell'ordine di preferenza del server, offerta dal client.
+    Se il client non ne offre nessuna (offered None) si usa DEFAULT_SUITE.
+    """
+    if offered is None:
+        offered = (DEFAULT_SUITE,)
+    for suite in preference:
+        if suite in offered:
+            return suite
+    raise ValueError(f"Nessuna suite AEAD in comune: {offered!r}")
+
+def choose_compression(offered, accepted=SUPPORTED_COMPRESSION):
+    """
+    Sceglie l'algoritmo di compressione: il primo, nell'ordine del client, accettato dal server.
+    Restituisce None (nessuna compressione) se non ce n'è uno in comune.
+    """
+    for algorithm in offered or ():
+        if algorithm in accepted:
+            return algorithm
+    return None
+
+def rank_suites(suites=None, duration: float = SUITE_BENCH_TIME, sizes=SUITE_BENCH_SIZES) -> list:
+    """
+    Micro-benchmark di cifratura e decifratura sulla CPU locale.
+    Restituisce [(suite, MB/s)] dalla più veloce alla più lenta.
+    """
+    # Senza istruzioni AES hardware (o in VM che non le espongono) ChaCha20-Poly1305
+    # è di solito molto più veloce di AES-GCM; con AES-NI vale il contrario
+    results = []
+    for suite in suites or SUPPORTED_SUITES:
+        # Chiave usa e getta: qui il riuso del nonce non ha conseguenze
+        aead = AEAD_CLASSES[suite](os.urandom(32))
+        nonce = bytes(12)
+        elapsed = 0.0
+        for size in sizes:
+            data = os.urandom(size)
+            count = 0
+            start = time.perf_counter()
+            deadline = start + duration / len(sizes)
+            while True:
+                aead.decrypt(nonce, aead.encrypt(nonce, data, None), None)
+                count += 1
+                now = time.perf_counter()
+                if now >= deadline:
+                    break
+            # Tempo medio per un messaggio di questa dimensione
+            elapsed += (now - start) / count
+        # Throughput su un messaggio per ciascuna dimensione: conta sia il costo fisso che quello per byte
+        results.append((suite, sum(sizes) / elapsed / 1e6))
+    return sorted(results, key=lambda result: result[1], reverse=True)
+
+def server_suites(preference='auto', log=print) -> tuple:
+    """
+    Ordine di preferenza delle suite lato server: 'auto' lo ricava da rank_suites,
+    altrimenti preference è un elenco di suite (quelle non disponibili vengono ignorate).
+    """
+    if preference != 'auto':
+        suites = tuple(suite for suite in preference if suite in SUPPORTED_SUITES)
+        if not suites:
+            raise ValueError(f"Nessuna delle suite richieste è disponibile: {preference!r}")
+        return suites
+    ranking = rank_suites()
+    log("[*] Suite AEAD per velocità su questa CPU: "
+        + ', '.join(f"{suite} ({speed:.0f} MB/s)" for suite, speed in ranking))
+    return tuple(suite for suite, _ in ranking)
+
+def derive_key(shared_key: bytes, algorithm: str = 'dh', length: int = 32, suite: str = DEFAULT_SUITE) -> bytes:
     """
-    Deriva una chiave AES-256 da raw shared_key usando HKDF-SHA256.
+    Deriva materiale chiave (di default una chiave da 256 bit) da raw shared_key usando HKDF-SHA256.
+    L'algoritmo di scambio e la suite AEAD negoziati vengono legati alla chiave tramite il campo info.
     """
     # 1) Derivazione della chiave crittografica
     # HKDF (HMAC-based Key Derivation Function) è un algoritmo di derivazione 
@@ -16,12 +187,219 @@ def derive_key(shared_key: bytes) -> bytes:
     # Usiamo SHA-256 come algoritmo di hash interno per sicurezza adeguata
     hkdf = HKDF(
         algorithm=hashes.SHA256(),  # Algoritmo di hash sicuro
-        length=32,                  # 256 bit (32 byte) per AES-256
+        length=length,              # 256 bit (32 byte) per AES-256, o più per chiavi e sali
         salt=None,                  # Nessun sale aggiuntivo 
-        info=b'handshake data',     # Contesto specifico dell'applicazione
+        # Contesto specifico dell'applicazione: includere versione, suite e algoritmo
+        # impedisce che una chiave derivata con una modalità (o per un cifrario) valga anche per l'altra
+        info=b'handshake data|' + f"v{HANDSHAKE_VERSION}|{suite}|{algorithm}".encode(),
     )
     # Deriviamo la chiave effettiva dalla chiave condivisa DH
-    return hkdf.derive(shared_key)
+    if not metrics.ENABLED:
+        return hkdf.derive(shared_key)
+    start = time.perf_counter()
+    key = hkdf.derive(shared_key)
+    metrics.observe('derive_key', time.perf_counter() - start)
+    return key
+
+class CipherState:
+    """
+    Stato di cifratura di una direzione: chiave AEAD della suite negoziata, sale fisso e contatore a 64 bit.
+    Il nonce è sale(4 byte) || contatore(8 byte): unico senza os.urandom né limiti del compleanno.
+    Con ratchet() chiave e sale vengono sostituiti da una derivazione HKDF dei precedenti.
+    """
+
+    def __init__(self, key: bytes, salt: bytes, explicit_nonce: bool = None,
+                 rekey_messages: int = None, rekey_bytes: int = None, suite: str = DEFAULT_SUITE):
+        self._key = key
+        self.suite = suite
+        self.aead = AEAD_CLASSES[suite](key)
+        self.salt = salt
+        self.seq = 0
+        # Soglie di aggiornamento lato mittente e byte cifrati con la chiave corrente
+        self.rekey_messages = REKEY_MESSAGES if rekey_messages is None else rekey_messages
+        self.rekey_bytes = REKEY_BYTES if rekey_bytes is None else rekey_bytes
+        self.bytes = 0
+        # Numero di aggiornamenti di chiave avvenuti (0 = chiavi dell'handshake)
+        self.generation = 0
+        # Con il nonce implicito il frame non contiene il nonce (12 byte in meno):
+        # il ricevitore usa il proprio contatore e un replay o un riordino fa fallire il tag
+        self.explicit_nonce = EXPLICIT_NONCE if explicit_nonce is None else explicit_nonce
+        # Metriche della connessione (metrics.ConnectionStats), assegnate da chi la gestisce
+        self.stats = None
+        # Compressor (invio) o Decompressor (ricezione) se la compressione è stata negoziata
+        self.compression = None
+
+    def _next_nonce(self) -> bytes:
+        if self.seq >= 2 ** 64 - 1:
+            # Non deve mai succedere: riusare un nonce con la stessa chiave romperebbe AES-GCM
+            raise OverflowError("Numero di sequenza esaurito per questa chiave")
+        nonce = self.salt + self.seq.to_bytes(8, 'big')
+        self.seq += 1
+        return nonce
+
+    def seal(self, plaintext: bytes, aad: bytes = None) -> list:
+        """
+        Cifra il messaggio successivo e restituisce i segmenti del blob ([nonce,] ciphertext).
+        """
+        nonce = self._next_nonce()
+        self.bytes += len(plaintext)
+        if metrics.ENABLED:
+            # Misura solo se attiva: a metriche spente il costo è questo controllo
+            start = time.perf_counter()
+            ct = self.aead.encrypt(nonce, plaintext, aad)
+            metrics.observe('encrypt', time.perf_counter() - start, self.stats)
+            if self.stats is not None:
+                self.stats.count('frames_sent')
+                self.stats.count('bytes_sent', len(plaintext))
+        else:
+            ct = self.aead.encrypt(nonce, plaintext, aad)
+        return [nonce, ct] if self.explicit_nonce else [ct]
+
+    def open(self, blob, aad: bytes = None) -> bytes:
+        """
+        Decifra il blob successivo verificando che abbia il numero di sequenza atteso.
+        """
+        expected = self.salt + self.seq.to_bytes(8, 'big')
+        if self.explicit_nonce:
+            blob = memoryview(blob)
+            if blob[:12] != expected:
+                # Nonce fuori sequenza: messaggio ripetuto, riordinato o perso
+                raise ValueError("Numero di sequenza inatteso (replay o riordino)")
+            blob = blob[12:]
+        if metrics.ENABLED:
+            plaintext = self._open_measured(expected, blob, aad)
+        else:
+            plaintext = self.aead.decrypt(expected, blob, aad)
+        # Il contatore avanza solo dopo un messaggio autentico
+        self.seq += 1
+        return plaintext
+
+    def _open_measured(self, nonce: bytes, blob, aad: bytes) -> bytes:
+        start = time.perf_counter()
+        try:
+            plaintext = self.aead.decrypt(nonce, blob, aad)
+        except InvalidTag:
+            # Tag non valido: messaggio manomesso, ripetuto o chiave sbagliata
+            if self.stats is not None:
+                self.stats.count('auth_failures')
+            raise
+        metrics.observe('decrypt', time.perf_counter() - start, self.stats)
+        if self.stats is not None:
+            self.stats.count('frames_received')
+            self.stats.count('bytes_received', len(plaintext))
+        return plaintext
+
+    def needs_rekey(self) -> bool:
+        """
+        True quando la chiave di invio ha raggiunto una delle soglie di aggiornamento.
+        """
+        return self.seq >= self.rekey_messages or self.bytes >= self.rekey_bytes
+
+    def ratchet(self) -> None:
+        """
+        Passa alla generazione di chiavi successiva: HKDF della chiave e del sale correnti.
+        La chiave precedente non è ricavabile da quella nuova (forward secrecy tra generazioni).
+        """
+        # Una sola derivazione HKDF: costa microsecondi, contro i millisecondi di un nuovo DH
+        material = derive_key(self._key + self.salt, 'key update', length=32 + 4, suite=self.suite)
+        self._key = material[:32]
+        self.aead = AEAD_CLASSES[self.suite](self._key)
+        self.salt = material[32:]
+        # Nonce di nuovo da zero: con una chiave nuova non c'è riuso
+        self.seq = 0
+        self.bytes = 0
+        self.generation += 1
+
+def derive_session(shared_key: bytes, algorithm: str, server_side: bool, suite: str = DEFAULT_SUITE):
+    """
+    Deriva con derive_key chiavi e sali distinti per le due direzioni.
+    Restituisce (send_state, recv_state) dal punto di vista di chi chiama.
+    """
+    # Chiave (32) e sale (4) per client->server, poi per server->client
+    material = derive_key(shared_key, algorithm, length=2 * (32 + 4), suite=suite)
+    c2s = CipherState(material[0:32], material[32:36], suite=suite)
+    s2c = CipherState(material[36:68], material[68:72], suite=suite)
+    return (s2c, c2s) if server_side else (c2s, s2c)
+
+class Compressor:
+    """
+    Compressione dei messaggi in uscita di una direzione.
+    Con zlib il contesto dura per tutta la sessione: ogni messaggio sfrutta anche le ripetizioni
+    dei precedenti (ogni frame termina con un flush di sincronizzazione, quindi si decomprime da solo).
+    Con lzma ogni messaggio è compresso separatamente (rapporto migliore sui messaggi lunghi).
+    """
+
+    def __init__(self, algorithm: str, threshold: int = None, dictionary: bytes = None):
+        self.algorithm = algorithm
+        self.threshold = COMPRESSION_THRESHOLD if threshold is None else threshold
+        if algorithm == 'zlib':
+            # wbits negativo: deflate senza intestazione né checksum, l'integrità la garantisce l'AEAD
+            dictionary = COMPRESSION_DICTIONARY if dictionary is None else dictionary
+            self._zlib = (zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -15, zdict=dictionary)
+                          if dictionary else zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -15))
+        elif algorithm != 'lzma' or lzma is None:
+            raise ValueError(f"Algoritmo di compressione non supportato: {algorithm!r}")
+        # Byte prima e dopo la compressione, per misurare il guadagno
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def compress(self, data) -> bytes:
+        if self.algorithm == 'zlib':
+            # Il flush di sincronizzazione termina sempre con 00 00 FF FF: non lo trasmettiamo
+            # e il ricevitore lo riaggiunge (come fa permessage-deflate di WebSocket)
+            out = self._zlib.compress(data) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+            out = out[:-4]
+        else:
+            out = lzma.compress(data, format=lzma.FORMAT_RAW, filters=_lzma_filters())
+        self.bytes_in += len(data)
+        self.bytes_out += len(out)
+        return out
+
+class Decompressor:
+    """
+    Decompressione dei messaggi in arrivo, speculare a Compressor.
+    L'uscita è limitata a max_size byte: un frame piccolo non può espandersi fino a esaurire la memoria.
+    """
+
+    def __init__(self, algorithm: str, max_size: int = None, dictionary: bytes = None):
+        self.algorithm = algorithm
+        self.max_size = MAX_FRAME_SIZE if max_size is None else max_size
+        if algorithm == 'zlib':
+            dictionary = COMPRESSION_DICTIONARY if dictionary is None else dictionary
+            self._zlib = zlib.decompressobj(-15, zdict=dictionary) if dictionary else zlib.decompressobj(-15)
+        elif algorithm != 'lzma' or lzma is None:
+            raise ValueError(f"Algoritmo di compressione non supportato: {algorithm!r}")
+
+    def decompress(self, data) -> bytes:
+        try:
+            if self.algorithm == 'zlib':
+                # Un byte oltre il limite basta a capire se il messaggio lo supera
+                out = self._zlib.decompress(bytes(data) + b'\x00\x00\xff\xff', self.max_size + 1)
+                if len(out) > self.max_size or self._zlib.unconsumed_tail or self._zlib.eof:
+                    raise ValueError(f"Messaggio compresso oltre il limite di {self.max_size} byte")
+            else:
+                decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_RAW, filters=_lzma_filters())
+                out = decompressor.decompress(data, self.max_size)
+                if not decompressor.eof:
+                    raise ValueError("Messaggio compresso troncato o oltre il limite")
+        except DECOMPRESSION_ERRORS as e:
+            # Dati corrotti dopo un tag valido: il peer usa un contesto o un dizionario diverso
+            raise ValueError(f"Messaggio compresso non valido: {e}") from None
+        return out
+
+def _lzma_filters():
+    # Formato grezzo: niente intestazione .xz (decine di byte) in ogni frame
+    return [{'id': lzma.FILTER_LZMA2, 'preset': LZMA_PRESET, 'dict_size': LZMA_DICT_SIZE}]
+
+def enable_compression(send_cipher: CipherState, recv_cipher: CipherState, algorithm: str) -> None:
+    """
+    Collega ai cifrari di una sessione l'algoritmo di compressione negoziato (None: nessuno).
+    """
+    if algorithm is None:
+        send_cipher.compression = recv_cipher.compression = None
+        return
+    send_cipher.compression = Compressor(algorithm)
+    recv_cipher.compression = Decompressor(algorithm)
 
 def recvn(conn: socket.socket, n: int) -> bytes:
     """
@@ -30,59 +408,409 @@ def recvn(conn: socket.socket, n: int) -> bytes:
     # 2) Funzione di utilità per ricevere un numero esatto di byte
     # Questa funzione è necessaria perché socket.recv() potrebbe 
     # restituire meno byte di quelli richiesti in una singola chiamata
-    data = b''
-    while len(data) < n:
+    # Il buffer è allocato una sola volta e riempito con recv_into:
+    # accumulare con data += packet costerebbe O(n^2) con molte letture parziali
+    data = bytearray(n)
+    view = memoryview(data)
+    received = 0
+    while received < n:
         # Richiedi solo i byte rimanenti ad ogni iterazione
-        packet = conn.recv(n - len(data))
+        count = conn.recv_into(view[received:], n - received)
         # Se non riceviamo dati, la connessione è stata chiusa
-        if not packet:
+        if not count:
             raise EOFError("Connection closed")
-        # Accumula i byte ricevuti
-        data += packet
-    return data
+        received += count
+    return bytes(data)
 
-def send_encrypted(conn: socket.socket, aesgcm: AESGCM, plaintext: bytes) -> None:
+class FrameReader:
     """
-    Cifra e invia [4-byte big-endian length][nonce||ciphertext] usando AES-GCM.
+    Lettore di frame [4-byte length][payload] con buffer riutilizzabile per connessione.
+    I frame restituiti sono memoryview sul buffer interno, valide fino alla lettura successiva.
     """
-    # 3) Funzione per cifrare e inviare messaggi in modo sicuro
-    # Genera un nonce (numero usato una sola volta) di 12 byte
-    # IMPORTANTE: ogni nonce deve essere unico per ogni messaggio con la stessa chiave
-    nonce = os.urandom(12)
-    
-    # Cifra il messaggio usando AES-GCM con il nonce generato
+
+    def __init__(self, conn: socket.socket, max_frame_size: int = None, buffer_size: int = 65536):
+        self.conn = conn
+        self.max_frame_size = MAX_FRAME_SIZE if max_frame_size is None else max_frame_size
+        # Buffer circolare linearizzato: i byte validi stanno in [_start, _end)
+        self._buffer_size = buffer_size
+        self._buf = bytearray(buffer_size)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+        # Metriche della connessione: tempo passato in attesa di dati dal socket
+        self.stats = None
+
+    def _fill(self, needed: int) -> None:
+        # Garantisce che almeno needed byte siano disponibili a partire da _start
+        if self._start + needed > len(self._buf):
+            pending = self._end - self._start
+            if needed > len(self._buf):
+                # Frame più grande del buffer: lo ingrandiamo (fino alla lettura che lo segue, vedi read_frame_flags)
+                self._resize(max(needed, 2 * len(self._buf)))
+            else:
+                # Compattazione: spostiamo in testa solo i pochi byte del frame parziale
+                self._view[:pending] = self._view[self._start:self._end]
+            self._start, self._end = 0, pending
+
+        while self._end - self._start < needed:
+            # Leggiamo quanto il kernel ha già disponibile, non solo il minimo necessario:
+            # più frame piccoli arrivano così con una sola chiamata di sistema
+            if metrics.ENABLED:
+                start = time.perf_counter()
+                count = self.conn.recv_into(self._view[self._end:])
+                metrics.observe('recv_wait', time.perf_counter() - start, self.stats)
+            else:
+                count = self.conn.recv_into(self._view[self._end:])
+            if not count:
+                raise EOFError("Connection closed")
+            self._end += count
+
+    def _resize(self, size: int) -> None:
+        # Nuovo buffer con in testa i byte non ancora letti; le memoryview già restituite
+        # tengono in vita il vecchio buffer finché servono
+        pending = self._end - self._start
+        new_buf = bytearray(size)
+        new_buf[:pending] = self._view[self._start:self._end]
+        self._buf = new_buf
+        self._view = memoryview(self._buf)
+        self._start, self._end = 0, pending
+
+    def read_frame(self) -> memoryview:
+        """
+        Restituisce il payload del frame successivo senza copiarlo.
+        """
+        return self.read_frame_flags()[1]
+
+    def read_frame_flags(self):
+        """
+        Come read_frame, ma restituisce (flag dell'header, payload).
+        """
+        if len(self._buf) > self._buffer_size and self._end - self._start <= self._buffer_size:
+            # Il frame grande precedente è stato consumato: torniamo alla dimensione iniziale,
+            # altrimenti ogni connessione terrebbe allocato il frame più grande visto (fino a MAX_FRAME_SIZE)
+            self._resize(self._buffer_size)
+        self._fill(4)
+        (header,) = struct.unpack_from('>I', self._buf, self._start)
+        flags, length = header & ~FRAME_LENGTH_MASK, header & FRAME_LENGTH_MASK
+        # Un peer non deve poterci far allocare fino a 4 GiB annunciando una lunghezza enorme
+        if length > self.max_frame_size:
+            raise ValueError(f"Frame di {length} byte oltre il limite di {self.max_frame_size}")
+        self._fill(4 + length)
+        frame = self._view[self._start + 4:self._start + 4 + length]
+        self._start += 4 + length
+        if self._start == self._end:
+            # Buffer vuoto: ripartiamo dall'inizio senza spostare nulla
+            self._start = self._end = 0
+        return flags, frame
+
+def read_frame(source) -> bytes:
+    """
+    Legge un frame [4-byte length][payload] da un socket o da un FrameReader.
+    """
+    return read_frame_flags(source)[1]
+
+def read_frame_flags(source):
+    """
+    Come read_frame, ma restituisce (flag dell'header, payload).
+    """
+    if isinstance(source, FrameReader):
+        return source.read_frame_flags()
+    (header,) = struct.unpack('>I', recvn(source, 4))
+    length = header & FRAME_LENGTH_MASK
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame di {length} byte oltre il limite di {MAX_FRAME_SIZE}")
+    return header & ~FRAME_LENGTH_MASK, recvn(source, length)
+
+# Numero massimo di segmenti per una singola sendmsg (limite IOV_MAX del kernel)
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+def send_segments(conn: socket.socket, segments) -> None:
+    """
+    Invia una lista di buffer con una scrittura scatter-gather (sendmsg), senza concatenarli.
+    """
+    # sendmsg esiste solo sui socket POSIX non TLS: altrimenti una sola sendall del blob unito
+    if type(conn) is not socket.socket or not hasattr(conn, 'sendmsg'):
+        conn.sendall(b''.join(segments))
+        return
+    views = [memoryview(seg) for seg in segments if len(seg)]
+    first = 0
+    while first < len(views):
+        sent = conn.sendmsg(views[first:first + IOV_MAX])
+        # sendmsg può inviare solo una parte: scartiamo i segmenti completi
+        # e ripartiamo dal punto esatto in cui si è fermato il kernel
+        while first < len(views) and sent >= len(views[first]):
+            sent -= len(views[first])
+            first += 1
+        if sent:
+            views[first] = views[first][sent:]
+
+def encrypt_segments(cipher: CipherState, plaintext: bytes, compress: bool = True) -> list:
+    """
+    Cifra un messaggio e restituisce i segmenti [header, ([nonce,] ciphertext)] del frame.
+    Se la compressione è negoziata i messaggi oltre la soglia vengono compressi prima di cifrarli;
+    compress=False la esclude per i frame che uniscono segreti e dati scelti da altri (CRIME).
+    """
+    # Il nonce è derivato dal contatore della direzione: unico per ogni messaggio
+    # con la stessa chiave senza bisogno di una chiamata di sistema
     # AES-GCM è un AEAD (Authenticated Encryption with Associated Data)
     # che fornisce sia confidenzialità che autenticità
-    ct = aesgcm.encrypt(nonce, plaintext, None)
+    flags = 0
+    compressor = cipher.compression
+    if compress and compressor is not None and len(plaintext) >= compressor.threshold:
+        plaintext = compressor.compress(plaintext)
+        flags = FRAME_COMPRESSED
+    body = cipher.seal(plaintext, COMPRESSED_AAD if flags else None)
     
-    # Combina nonce e testo cifrato in un unico blob
-    # Il nonce deve essere trasmesso insieme al testo cifrato
-    # per consentire la decifratura, ma non deve essere segreto
-    blob = nonce + ct
-    
-    # Prepara un header che indica la lunghezza del messaggio (4 byte, big-endian)
+    # Prepara un header che indica la lunghezza del blob (4 byte, big-endian)
     # Questo permette al ricevitore di sapere quanti byte aspettarsi
-    header = struct.pack('>I', len(blob))
-    
-    # Invia l'header seguito dal blob contenente nonce e testo cifrato
-    conn.sendall(header + blob)
+    header = struct.pack('>I', flags | sum(len(seg) for seg in body))
+    if not cipher.needs_rekey():
+        return [header] + body
+    # Soglia raggiunta: il frame di aggiornamento segue il messaggio nello stesso invio
+    return [header] + body + key_update_segments(cipher)
+
+def key_update_segments(cipher: CipherState) -> list:
+    """
+    Frame di aggiornamento chiavi, autenticato con la chiave corrente; poi avanza il ratchet.
+    """
+    # Il ricevitore lo decifra con la chiave vecchia e solo allora passa a quella nuova:
+    # un aggiornamento falsificato o ripetuto fallisce la verifica del tag
+    body = cipher.seal(b'', KEY_UPDATE_AAD)
+    header = struct.pack('>I', FRAME_KEY_UPDATE | sum(len(seg) for seg in body))
+    cipher.ratchet()
+    return [header] + body
+
+def open_frame(cipher: CipherState, flags: int, blob, aad: bytes = None):
+    """
+    Decifra un frame ricevuto; per un frame di aggiornamento chiavi applica il ratchet
+    e restituisce None. I frame compressi vengono decompressi dopo la verifica del tag.
+    """
+    if flags & FRAME_KEY_UPDATE:
+        cipher.open(blob, KEY_UPDATE_AAD)
+        cipher.ratchet()
+        return None
+    if flags & FRAME_COMPRESSED:
+        if cipher.compression is None:
+            raise ValueError("Frame compresso senza compressione negoziata")
+        return cipher.compression.decompress(cipher.open(blob, COMPRESSED_AAD))
+    return cipher.open(blob, aad)
+
+def send_encrypted(conn: socket.socket, cipher: CipherState, plaintext: bytes, compress: bool = True) -> None:
+    """
+    Cifra e invia [4-byte big-endian length][[nonce||]ciphertext] usando AES-GCM.
+    compress=False non comprime il messaggio anche se la compressione è negoziata.
+    """
+    # 3) Funzione per cifrare e inviare messaggi in modo sicuro
+    # Header, nonce e testo cifrato vengono passati al kernel come segmenti
+    # separati: nessuna concatenazione (e quindi nessuna copia) del messaggio
+    send_segments(conn, encrypt_segments(cipher, plaintext, compress))
+
+def send_many(conn: socket.socket, cipher: CipherState, messages) -> None:
+    """
+    Cifra una lista di messaggi e li invia con un'unica scrittura scatter-gather.
+    """
+    # Una sola chiamata di sistema (ogni IOV_MAX segmenti) per tutto il lotto
+    segments = []
+    for plaintext in messages:
+        segments.extend(encrypt_segments(cipher, plaintext))
+    send_segments(conn, segments)
+
+class CoalescingSender:
+    """
+    Invio con accorpamento in stile Nagle: i messaggi cifrati si accumulano per al massimo
+    delay secondi (o max_bytes) e partono insieme con una sola send_segments.
+    """
+
+    def __init__(self, conn: socket.socket, cipher: CipherState, delay: float = 0.002, max_bytes: int = 65536):
+        self.conn = conn
+        self.cipher = cipher
+        self.delay = delay
+        self.max_bytes = max_bytes
+        self._segments = []
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def send(self, plaintext: bytes) -> None:
+        """
+        Cifra subito il messaggio e lo accoda; l'invio avviene alla scadenza della finestra.
+        """
+        with self._lock:
+            # La cifratura avviene sotto lock: l'ordine dei frame deve seguire i numeri di sequenza
+            segments = encrypt_segments(self.cipher, plaintext)
+            self._segments.extend(segments)
+            self._pending += sum(len(seg) for seg in segments)
+            if self._pending >= self.max_bytes:
+                # Abbastanza dati per riempire i segmenti TCP: inutile aspettare
+                self._flush_locked()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self) -> None:
+        """
+        Invia subito tutti i messaggi accodati.
+        """
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._segments:
+            segments, self._segments, self._pending = self._segments, [], 0
+            send_segments(self.conn, segments)
 
-def recv_decrypted(conn: socket.socket, aesgcm: AESGCM) -> bytes:
+    def close(self) -> None:
+        """
+        Svuota la coda; da chiamare prima di chiudere il socket.
+        """
+        self.flush()
+
+def recv_decrypted(conn, cipher: CipherState) -> bytes:
     """
     Riceve e decifra un messaggio strutturato come in send_encrypted.
+    conn può essere un socket o un FrameReader (percorso senza copie).
     """
     # 4) Funzione per ricevere e decifrare messaggi
-    # Legge prima i 4 byte dell'header che contengono la lunghezza
-    raw_len = recvn(conn, 4)
-    (msg_len,) = struct.unpack('>I', raw_len)
-    
-    # Riceve esattamente msg_len byte (il blob completo)
-    blob = recvn(conn, msg_len)
-    
-    # Estrae il nonce (primi 12 byte) e il testo cifrato (resto del blob)
-    nonce, ct = blob[:12], blob[12:]
-    
-    # Decifra il messaggio usando AES-GCM
+    # Legge l'header con la lunghezza e poi esattamente msg_len byte (il blob completo)
+    # Con un FrameReader il blob è una vista sul buffer di ricezione: nessuna copia
+    # Decifra il messaggio usando AES-GCM con il nonce atteso dal contatore
     # La decifratura verificherà automaticamente l'autenticità del messaggio
-    # Se il messaggio è stato manomesso o corrotto, solleverà un'eccezione
-    return aesgcm.decrypt(nonce, ct, None)
+    # Se il messaggio è stato manomesso, ripetuto o riordinato, solleverà un'eccezione
+    # I frame di aggiornamento chiavi vengono applicati e saltati
+    while True:
+        flags, blob = read_frame_flags(conn)
+        plaintext = open_frame(cipher, flags, blob)
+        if plaintext is not None:
+            return plaintext
+
+async def recv_frame_flags_async(reader) -> tuple:
+    """
+    Versione asincrona di read_frame_flags su un asyncio.StreamReader: restituisce (flag dell'header, payload).
+    """
+    (header,) = struct.unpack('>I', await reader.readexactly(4))
+    length = header & FRAME_LENGTH_MASK
+    # Stesso limite del percorso bloccante: niente buffer enormi su richiesta del peer
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame di {length} byte oltre il limite di {MAX_FRAME_SIZE}")
+    return header & ~FRAME_LENGTH_MASK, await reader.readexactly(length)
+
+async def send_encrypted_async(writer, cipher: CipherState, plaintext: bytes) -> None:
+    """
+    Versione asincrona di send_encrypted su un asyncio.StreamWriter: scrive il frame e attende il drain.
+    """
+    # writelines passa i segmenti al trasporto senza concatenarli
+    writer.writelines(encrypt_segments(cipher, plaintext))
+    # drain applica la contropressione se il peer legge lentamente
+    await writer.drain()
+
+def int_to_bytes(value: int, width: int) -> bytes:
+    """
+    Codifica un intero in big-endian a larghezza fissa.
+    """
+    return value.to_bytes(width, 'big')
+
+def encode_client_hello(modes=HANDSHAKE_MODES, extensions=None) -> bytes:
+    """
+    ClientHello: [version:1][n:1][mode_id:1]*n, modalità in ordine di preferenza,
+    seguito da estensioni opzionali [type:1][len:2][value].
+    """
+    # 6) Messaggi di handshake binari: pochi byte invece di testo decimale
+    data = bytes([HANDSHAKE_VERSION, len(modes)]) + bytes(MODE_IDS[m] for m in modes)
+    for ext_type, value in (extensions or {}).items():
+        data += struct.pack('>BH', ext_type, len(value)) + value
+    return data
+
+def decode_client_hello(data: bytes):
+    """
+    Decodifica un ClientHello e restituisce (modalità offerte, dizionario delle estensioni).
+    """
+    if len(data) < 2 or data[0] != HANDSHAKE_VERSION:
+        raise ValueError("ClientHello non valido o versione non supportata")
+    count = data[1]
+    if len(data) < 2 + count:
+        raise ValueError("ClientHello troncato")
+    modes = [MODE_NAMES[i] for i in data[2:2 + count] if i in MODE_NAMES]
+
+    # Le estensioni sconosciute vengono ignorate: un client più recente resta compatibile
+    extensions = {}
+    offset = 2 + count
+    while offset < len(data):
+        if offset + 3 > len(data):
+            raise ValueError("Estensione del ClientHello troncata")
+        ext_type, length = struct.unpack_from('>BH', data, offset)
+        offset += 3
+        if offset + length > len(data):
+            raise ValueError("Estensione del ClientHello troncata")
+        extensions[ext_type] = data[offset:offset + length]
+        offset += length
+    return modes, extensions
+
+def encode_suites(suites) -> bytes:
+    """
+    Valore dell'estensione EXT_SUITES: un byte per suite, in ordine di preferenza.
+    """
+    return bytes(SUITE_IDS[suite] for suite in suites)
+
+def decode_suites(data: bytes) -> list:
+    """
+    Decodifica encode_suites ignorando le suite sconosciute.
+    """
+    return [SUITE_NAMES[i] for i in data if i in SUITE_NAMES]
+
+def encode_compression(algorithms) -> bytes:
+    """
+    Valore dell'estensione EXT_COMPRESSION: un byte per algoritmo, in ordine di preferenza.
+    """
+    return bytes(COMPRESSION_IDS[algorithm] for algorithm in algorithms)
+
+def decode_compression(data: bytes) -> list:
+    """
+    Decodifica encode_compression ignorando gli algoritmi sconosciuti.
+    """
+    return [COMPRESSION_NAMES[i] for i in data if i in COMPRESSION_NAMES]
+
+def encode_server_hello(mode: str, key_share: bytes, suite: str = DEFAULT_SUITE, compression: str = None) -> bytes:
+    """
+    ServerHello: [version:1][mode_id:1][suite_id:1][compression_id:1][key_share]
+    (compression_id 0: nessuna compressione).
+    """
+    return bytes([HANDSHAKE_VERSION, MODE_IDS[mode], SUITE_IDS[suite],
+                  COMPRESSION_IDS[compression] if compression else 0]) + key_share
+
+def decode_server_hello(data: bytes):
+    """
+    Decodifica un ServerHello e restituisce (mode, suite, compression, key_share).
+    """
+    if (len(data) < 4 or data[0] != HANDSHAKE_VERSION or data[1] not in MODE_NAMES or data[2] not in SUITE_NAMES
+            or (data[3] and data[3] not in COMPRESSION_NAMES)):
+        raise ValueError("ServerHello non valido o versione non supportata")
+    return MODE_NAMES[data[1]], SUITE_NAMES[data[2]], COMPRESSION_NAMES.get(data[3]), data[4:]
+
+def encode_dh_share(p: int, g: int, y: int) -> bytes:
+    """
+    Codifica p, g e la chiave pubblica y come [width:2][p][g][y], tutti a larghezza width.
+    """
+    width = (p.bit_length() + 7) // 8
+    return (struct.pack('>H', width) + int_to_bytes(p, width)
+            + int_to_bytes(g, width) + int_to_bytes(y, width))
+
+def decode_dh_share(data: bytes):
+    """
+    Decodifica encode_dh_share e restituisce (p, g, y).
+    """
+    if len(data) < 2:
+        raise ValueError("Parametri DH troncati")
+    (width,) = struct.unpack('>H', data[:2])
+    if len(data) != 2 + 3 * width:
+        raise ValueError("Parametri DH con lunghezza non valida")
+    p = int.from_bytes(data[2:2 + width], 'big')
+    g = int.from_bytes(data[2 + width:2 + 2 * width], 'big')
+    y = int.from_bytes(data[2 + 2 * width:], 'big')
+    return p, g, y
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+import os
+import queue
+import threading
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import dh
+import metrics
+
+# 1) Gruppi Diffie-Hellman standard
+# Generare un primo sicuro da 2048 bit richiede da alcuni secondi a minuti:
+# i gruppi pubblicati negli RFC sono già verificati e possono essere
+# riutilizzati senza perdita di sicurezza (la segretezza sta nelle chiavi private)
+
+# RFC 7919 - ffdhe2048 (gruppo "Finite Field DHE" pensato per TLS)
+FFDHE2048_P = int(
+    "FFFFFFFFFFFFFFFFADF85458A2BB4A9AAFDC5620273D3CF1D8B9C583CE2D3695"
+    "A9E13641146433FBCC939DCE249B3EF97D2FE363630C75D8F681B202AEC4617A"
+    "D3DF1ED5D5FD65612433F51F5F066ED0856365553DED1AF3B557135E7F57C935"
+    "984F0C70E0E68B77E2A689DAF3EFE8721DF158A136ADE73530ACCA4F483A797A"
+    "BC0AB182B324FB61D108A94BB2C8E3FBB96ADAB760D7F4681D4F42A3DE394DF4"
+    "AE56EDE76372BB190B07A7C8EE0A6D709E02FCE1CDF7E2ECC03404CD28342F61"
+    "9172FE9CE98583FF8E4F1232EEF28183C3FE3B1B4C6FAD733BB5FCBC2EC22005"
+    "C58EF1837D1683B2C6F34A26C1B2EFFA886B423861285C97FFFFFFFFFFFFFFFF",
+    16,
+)
+
+# RFC 3526 - gruppo MODP 14 (2048 bit)
+MODP2048_P = int(
+    "FFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74"
+    "020BBEA63B139B22514A08798E3404DDEF9519B3CD3A431B302B0A6DF25F1437"
+    "4FE1356D6D51C245E485B576625E7EC6F44C42E9A637ED6B0BFF5CB6F406B7ED"
+    "EE386BFB5A899FA5AE9F24117C4B1FE649286651ECE45B3DC2007CB8A163BF05"
+    "98DA48361C55D39A69163FA8FD24CF5F83655D23DCA3AD961C62F356208552BB"
+    "9ED529077096966D670C354E4ABC9804F1746C08CA18217C32905E462E36CE3B"
+    "E39E772C180E86039B2783A2EC07A28FB5C55DF06F4C52C9DE2BCBF695581718"
+    "3995497CEA956AE515D2261898FA051015728E5A8AACAA68FFFFFFFFFFFFFFFF",
+    16,
+)
+
+# Entrambi i gruppi usano il generatore g=2
+STANDARD_GROUPS = {
+    'ffdhe2048': FFDHE2048_P,
+    'modp2048': MODP2048_P,
+}
+
+# File di cache per i parametri generati localmente (formato PEM PKCS#3)
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dh_params.pem')
+
+
+def standard_parameters(name: str = 'ffdhe2048') -> dh.DHParameters:
+    """
+    Restituisce i parametri DH di un gruppo standard (RFC 7919 / RFC 3526).
+    """
+    if name not in STANDARD_GROUPS:
+        raise ValueError(f"Gruppo DH sconosciuto: {name!r}")
+    return dh.DHParameterNumbers(STANDARD_GROUPS[name], 2).parameters()
+
+
+def load_or_generate(path: str = DEFAULT_CACHE_PATH, key_size: int = 2048) -> dh.DHParameters:
+    """
+    Carica i parametri DH dalla cache su disco; se assente li genera una sola volta e li salva.
+    """
+    # 2) Cache su disco: la generazione costosa viene pagata solo al primo avvio
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return serialization.load_pem_parameters(f.read())
+
+    parameters = dh.generate_parameters(generator=2, key_size=key_size)
+    pem = parameters.parameter_bytes(
+        serialization.Encoding.PEM,
+        serialization.ParameterFormat.PKCS3,
+    )
+    # Scrittura atomica: un avvio concorrente non legge mai un file parziale
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(pem)
+    os.replace(tmp_path, path)
+    return parameters
+
+
+def get_parameters(source: str = 'ffdhe2048', cache_path: str = DEFAULT_CACHE_PATH) -> dh.DHParameters:
+    """
+    Punto di accesso unico: source è il nome di un gruppo standard, 'cache' o 'generate'.
+    """
+    with metrics.timed('dh_params'):
+        if source == 'cache':
+            return load_or_generate(cache_path)
+        if source == 'generate':
+            # Comportamento originale: parametri nuovi ad ogni avvio (lento)
+            return dh.generate_parameters(generator=2, key_size=2048)
+        return standard_parameters(source)
+
+
+class KeyPool:
+    """
+    Pool di chiavi private DH effimere pre-generate da un thread in background.
+    """
+
+    def __init__(self, parameters: dh.DHParameters, size: int = 32):
+        # 3) Ogni chiave viene consegnata una sola volta (resta effimera),
+        # ma il costo della sua generazione è spostato fuori dall'handshake
+        self.parameters = parameters
+        self._keys = queue.Queue(maxsize=size)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._fill, name='dh-keypool', daemon=True)
+        self._thread.start()
+
+    def _fill(self):
+        # Il thread riempie la coda e si blocca quando è piena
+        while not self._stop.is_set():
+            key = self.parameters.generate_private_key()
+            while not self._stop.is_set():
+                try:
+                    self._keys.put(key, timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+
+    def get(self) -> dh.DHPrivateKey:
+        """
+        Restituisce una chiave pre-generata; se il pool è vuoto la genera sul momento.
+        """
+        try:
+            return self._keys.get_nowait()
+        except queue.Empty:
+            return self.parameters.generate_private_key()
+
+    def close(self):
+        """
+        Ferma il thread di riempimento.
+        """
+        self._stop.set()
+        self._thread.join(timeout=1)
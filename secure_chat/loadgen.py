@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+import argparse
+import base64
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+from bench import percentile
+from client import handshake
+from common import FrameReader, CoalescingSender, send_many, recv_decrypted, HANDSHAKE_MODES, SUPPORTED_SUITES, SUPPORTED_COMPRESSION
+
+# Server da caricare: di default async_server.py (server.py accetta una sola connessione)
+HOST = '127.0.0.1'
+PORT = 65432
+# Timeout delle operazioni sul socket: un server bloccato non deve bloccare il generatore
+SOCKET_TIMEOUT = 30
+# Stack ridotto per i thread: con molte connessioni ne servono due per ciascuna
+THREAD_STACK_SIZE = 256 * 1024
+# Percentili riportati per la latenza
+PERCENTILES = (50, 90, 99, 99.9)
+# Ogni messaggio inizia con il suo numero di sequenza, che il server rimanda nell'echo
+SEQUENCE = struct.Struct('>Q')
+
+
+class LoadConnection:
+    """
+    Una connessione del generatore: un thread invia tenendo al massimo window messaggi
+    in volo, il thread chiamante riceve gli echo e misura la latenza di ciascuno.
+    """
+
+    def __init__(self, host: str, port: int, modes=HANDSHAKE_MODES, suites=SUPPORTED_SUITES, compression=()):
+        start = time.perf_counter()
+        self.sock = socket.create_connection((host, port), timeout=SOCKET_TIMEOUT)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # Niente ticket: ogni connessione esegue un handshake completo, come un client nuovo
+        self.send_cipher, self.recv_cipher = handshake(self.sock, modes, ticket_file=None, verbose=False,
+                                                       suites=suites, compression=compression)
+        self.handshake_time = time.perf_counter() - start
+        self.reader = FrameReader(self.sock)
+        self.latencies = []
+        self.sent = 0
+        self.received = 0
+        self.error = None
+
+    def run(self, payload: bytes, window: int, messages: int, deadline: float = None,
+            coalesce: float = None) -> None:
+        """
+        Invia fino a messages messaggi (o fino a deadline) e attende tutti gli echo.
+        Con coalesce (secondi) ogni messaggio viene inviato da solo, come farebbe un'applicazione
+        che scrive un messaggio alla volta, e common.CoalescingSender li accorpa in quella finestra.
+        """
+        # 1) Finestra di pipelining: un permesso per ogni messaggio in volo
+        slots = threading.Semaphore(window)
+        # Istante di invio per numero di sequenza; il ricevitore lo rimuove all'arrivo dell'echo
+        in_flight = {}
+        finished = threading.Event()
+        coalescer = CoalescingSender(self.sock, self.send_cipher, delay=coalesce) if coalesce else None
+
+        def sender():
+            try:
+                while self.sent < messages:
+                    if deadline is not None and time.perf_counter() >= deadline:
+                        break
+                    if not slots.acquire(timeout=SOCKET_TIMEOUT):
+                        raise TimeoutError("Nessun echo ricevuto entro il timeout")
+                    if finished.is_set():
+                        return
+                    # 2) I permessi liberi al momento partono insieme con una sola scrittura
+                    batch = 1
+                    while self.sent + batch < messages and slots.acquire(blocking=False):
+                        batch += 1
+                    now = time.perf_counter()
+                    frames = []
+                    for seq in range(self.sent, self.sent + batch):
+                        in_flight[seq] = now
+                        frames.append(SEQUENCE.pack(seq) + payload)
+                    if coalescer is not None:
+                        for frame in frames:
+                            coalescer.send(frame)
+                    else:
+                        send_many(self.sock, self.send_cipher, frames)
+                    self.sent += batch
+            except Exception as e:
+                self.error = self.error or e
+            finally:
+                finished.set()
+                if coalescer is not None:
+                    # I messaggi ancora nella finestra partono prima della chiusura in scrittura
+                    try:
+                        coalescer.close()
+                    except OSError:
+                        pass
+                # Fine del carico: il server rimanda gli echo ancora in coda e poi chiude,
+                # così il ricevitore non resta in attesa di messaggi mai inviati
+                try:
+                    self.sock.shutdown(socket.SHUT_WR)
+                except OSError:
+                    pass
+
+        thread = threading.Thread(target=sender, daemon=True)
+        thread.start()
+        try:
+            # 3) Ricezione: il server rimanda i messaggi in ordine, quindi ogni echo
+            # deve portare esattamente il numero di sequenza successivo
+            while not (finished.is_set() and self.received >= self.sent):
+                try:
+                    msg = recv_decrypted(self.reader, self.recv_cipher)
+                except EOFError:
+                    if finished.is_set() and self.received >= self.sent:
+                        break
+                    raise
+                now = time.perf_counter()
+                (seq,) = SEQUENCE.unpack_from(msg)
+                if seq != self.received:
+                    raise ValueError(f"Echo fuori ordine: atteso {self.received}, ricevuto {seq}")
+                if len(msg) != SEQUENCE.size + len(payload):
+                    raise ValueError(f"Echo di {len(msg)} byte invece di {SEQUENCE.size + len(payload)}")
+                self.latencies.append(now - in_flight.pop(seq))
+                self.received += 1
+                slots.release()
+        except Exception as e:
+            self.error = self.error or e
+            finished.set()
+            # Sblocca il mittente in attesa di un permesso
+            slots.release()
+        thread.join()
+
+    def close(self) -> None:
+        self.sock.close()
+
+
+def run_load(host: str, port: int, connections: int, window: int, size: int, messages: int,
+             duration: float = None, modes=HANDSHAKE_MODES, suites=SUPPORTED_SUITES, compression=(),
+             coalesce: float = None) -> dict:
+    """
+    Apre connections connessioni in parallelo e le carica tutte insieme.
+    """
+    payload = base64.b64encode(os.urandom(size))[:size]
+    opened = []
+    errors = []
+    lock = threading.Lock()
+    # Tutte le connessioni iniziano a inviare insieme, a handshake completati
+    ready = threading.Barrier(connections + 1)
+    phases = []
+
+    def worker():
+        conn = None
+        try:
+            conn = LoadConnection(host, port, modes, suites, compression)
+        except Exception as e:
+            with lock:
+                errors.append(repr(e))
+        finally:
+            with lock:
+                if conn is not None:
+                    opened.append(conn)
+            ready.wait()
+        if conn is None:
+            return
+        try:
+            start = time.perf_counter()
+            deadline = start + duration if duration else None
+            conn.run(payload, window, messages, deadline, coalesce)
+            with lock:
+                phases.append((start, time.perf_counter()))
+                if conn.error is not None:
+                    errors.append(repr(conn.error))
+        finally:
+            conn.close()
+
+    threading.stack_size(THREAD_STACK_SIZE)
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(connections)]
+    for t in threads:
+        t.start()
+    connect_start = time.perf_counter()
+    ready.wait()
+    connect_time = time.perf_counter() - connect_start
+    for t in threads:
+        t.join()
+
+    latencies = [x for conn in opened for x in conn.latencies]
+    handshakes = [conn.handshake_time for conn in opened]
+    received = sum(conn.received for conn in opened)
+    # Throughput sulla sola fase di carico, dal primo invio all'ultimo echo
+    wall = max(end for _, end in phases) - min(begin for begin, _ in phases) if phases else 0.0
+    # Byte inviati prima e dopo la compressione (solo i messaggi oltre la soglia vengono compressi)
+    compressors = [conn.send_cipher.compression for conn in opened if conn.send_cipher.compression is not None]
+    compressed_in = sum(c.bytes_in for c in compressors)
+    return {
+        'connections': connections,
+        'connections_opened': len(opened),
+        'window': window,
+        'coalesce_ms': round(1000 * coalesce, 4) if coalesce else None,
+        'size': size,
+        'suites': sorted({conn.send_cipher.suite for conn in opened}),
+        'compression': sorted({c.algorithm for c in compressors}),
+        'compression_ratio': round(sum(c.bytes_out for c in compressors) / compressed_in, 4) if compressed_in else None,
+        'connect_s': round(connect_time, 4),
+        'handshake_ms': {f'p{q:g}': round(1000 * percentile(handshakes, q), 4) for q in (50, 99)},
+        'messages_sent': sum(conn.sent for conn in opened),
+        'messages_received': received,
+        'elapsed_s': round(wall, 4),
+        'throughput_msgs_per_s': round(received / wall, 2) if wall else 0.0,
+        'throughput_mb_per_s': round(received * size / wall / 1e6, 4) if wall else 0.0,
+        'latency_ms': dict(
+            {f'p{q:g}': round(1000 * percentile(latencies, q), 4) for q in PERCENTILES},
+            mean=round(1000 * sum(latencies) / len(latencies), 4) if latencies else 0.0,
+            max=round(1000 * max(latencies), 4) if latencies else 0.0),
+        'errors': errors[:5],
+        'error_count': len(errors),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generatore di carico per server.py/async_server.py")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('-c', '--connections', type=int, default=16, help="Connessioni parallele")
+    parser.add_argument('-w', '--window', type=int, default=8, help="Messaggi in volo per connessione")
+    parser.add_argument('-s', '--size', type=int, default=64, help="Byte di payload per messaggio")
+    parser.add_argument('-n', '--messages', type=int,
+                        help="Messaggi per connessione (default 1000, nessun limite con --duration)")
+    parser.add_argument('-d', '--duration', type=float, help="Durata massima del carico in secondi")
+    parser.add_argument('--modes', default=','.join(HANDSHAKE_MODES), help="Modalità di handshake offerte")
+    parser.add_argument('--suites', default=','.join(SUPPORTED_SUITES), help="Suite AEAD offerte")
+    parser.add_argument('--compression', default='',
+                        help="Compressione offerta (es. zlib); vuota di default, vedi common.COMPRESSION_IDS")
+    parser.add_argument('--coalesce', type=float, metavar='MS',
+                        help="Invia un messaggio alla volta accorpandoli in finestre di MS millisecondi "
+                             "(common.CoalescingSender) invece di un lotto per finestra")
+    parser.add_argument('--json', action='store_true', help="Stampa il risultato in JSON")
+    args = parser.parse_args()
+    if args.window < 1 or args.connections < 1:
+        parser.error("--window e --connections devono essere almeno 1")
+    if args.coalesce is not None and args.coalesce <= 0:
+        parser.error("--coalesce deve essere maggiore di 0")
+    if set(args.suites.split(',')) - set(SUPPORTED_SUITES):
+        parser.error(f"--suites: suite disponibili {', '.join(SUPPORTED_SUITES)}")
+    compression = tuple(args.compression.split(',')) if args.compression else ()
+    if set(compression) - set(SUPPORTED_COMPRESSION):
+        parser.error(f"--compression: algoritmi disponibili {', '.join(SUPPORTED_COMPRESSION)}")
+
+    # Con --duration e senza --messages il limite è solo il tempo
+    messages = args.messages or (sys.maxsize if args.duration else 1000)
+    result = run_load(args.host, args.port, args.connections, args.window, args.size, messages,
+                      args.duration, tuple(args.modes.split(',')), tuple(args.suites.split(',')), compression,
+                      args.coalesce / 1000 if args.coalesce else None)
+    if args.json:
+        print(json.dumps(result, indent=2, sort_keys=True))
+        return
+    latency = result['latency_ms']
+    print(f"[*] {result['connections_opened']}/{result['connections']} connessioni in {result['connect_s']}s, "
+          f"suite {'/'.join(result['suites'])} "
+          f"(handshake p50={result['handshake_ms']['p50']}ms p99={result['handshake_ms']['p99']}ms)")
+    print(f"[*] {result['messages_received']}/{result['messages_sent']} echo in {result['elapsed_s']}s: "
+          f"{result['throughput_msgs_per_s']} msg/s, {result['throughput_mb_per_s']} MB/s")
+    if result['compression_ratio'] is not None:
+        print(f"[*] compressione {'/'.join(result['compression'])}: "
+              f"{100 * result['compression_ratio']:.1f}% dei byte originali")
+    print("[*] latenza " + ' '.join(f"{name}={value}ms" for name, value in latency.items()))
+    for error in result['errors']:
+        print(f"[!] {error}")
+    if result['error_count'] > len(result['errors']):
+        print(f"[!] ... altri {result['error_count'] - len(result['errors'])} errori")
+
+
+# Punto di ingresso dello script
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Strumentazione disattivata di default: i punti di misura nel percorso critico
+# si riducono al controllo di questo flag. Si attiva con SECURE_CHAT_METRICS=1 o enable()
+ENABLED = os.environ.get('SECURE_CHAT_METRICS', '') not in ('', '0')
+# Porta dell'endpoint testuale (solo su loopback, vedi serve())
+METRICS_PORT = 9464
+# Contatori tenuti per ogni connessione
+COUNTERS = ('bytes_sent', 'bytes_received', 'frames_sent', 'frames_received', 'auth_failures')
+# Istogrammi a bucket esponenziali: il bucket i contiene le durate fino a 2^i microsecondi
+# (da 1 µs a circa 33 s), l'ultimo raccoglie tutto il resto
+HISTOGRAM_BUCKETS = 26
+
+
+def enable(flag: bool = True) -> None:
+    """
+    Attiva o disattiva la raccolta delle metriche per tutto il processo.
+    """
+    global ENABLED
+    ENABLED = flag
+
+
+class Histogram:
+    """
+    Istogramma di latenze a bucket potenze di due (in microsecondi).
+    """
+
+    def __init__(self):
+        self.counts = [0] * (HISTOGRAM_BUCKETS + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        # bit_length dà direttamente l'indice del bucket, senza ricerche né logaritmi
+        index = min(int(seconds * 1e6).bit_length(), HISTOGRAM_BUCKETS)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q: float) -> float:
+        """
+        Stima del quantile q (tra 0 e 1): limite superiore del bucket che lo contiene.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(2 ** i / 1e6, self.max)
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {
+            'count': self.count,
+            'sum_ms': round(1000 * self.total, 4),
+            'max_ms': round(1000 * self.max, 4),
+            'p50_ms': round(1000 * self.quantile(0.50), 4),
+            'p99_ms': round(1000 * self.quantile(0.99), 4),
+        }
+
+
+class ConnectionStats:
+    """
+    Contatori e istogrammi per fase di una singola connessione.
+    """
+
+    def __init__(self, peer):
+        self.peer = peer
+        self.opened = time.time()
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.phases = {}
+        # Lock della sola connessione: i contatori sono nel percorso critico di invio e ricezione,
+        # e con il lock globale tutte le connessioni (e il pool del fan-out) si contenderebbero un mutex.
+        # Le due direzioni possono girare su thread diversi, quindi un lock serve comunque
+        self._lock = threading.Lock()
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.counters[name] += n
+
+    def read_counters(self) -> dict:
+        """
+        Copia coerente dei contatori.
+        """
+        with self._lock:
+            return dict(self.counters)
+
+    def snapshot(self) -> dict:
+        return {
+            'peer': str(self.peer),
+            'age_s': round(time.time() - self.opened, 3),
+            'counters': self.read_counters(),
+            'phases': {name: h.snapshot() for name, h in sorted(self.phases.items())},
+        }
+
+
+# Registro globale del processo: istogrammi per fase, connessioni aperte e totali di quelle chiuse
+# (_lock protegge solo il registro, mai i contatori delle singole connessioni)
+_lock = threading.Lock()
+_phases = {}
+_connections = {}
+_closed = dict.fromkeys(COUNTERS, 0)
+_closed_count = 0
+
+
+def observe(phase: str, seconds: float, stats: ConnectionStats = None) -> None:
+    """
+    Registra la durata di una fase nell'istogramma globale e, se indicata, in quello della connessione.
+    """
+    if not ENABLED:
+        return
+    with _lock:
+        histogram = _phases.get(phase)
+        if histogram is None:
+            histogram = _phases[phase] = Histogram()
+        histogram.observe(seconds)
+        if stats is not None:
+            histogram = stats.phases.get(phase)
+            if histogram is None:
+                histogram = stats.phases[phase] = Histogram()
+            histogram.observe(seconds)
+
+
+@contextmanager
+def timed(phase: str, stats: ConnectionStats = None):
+    """
+    Misura la durata del blocco with (per le fasi fuori dal percorso critico, es. handshake).
+    """
+    if not ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(phase, time.perf_counter() - start, stats)
+
+
+def connection(peer):
+    """
+    Registra una nuova connessione e restituisce il suo ConnectionStats (None se disattivato).
+    """
+    if not ENABLED:
+        return None
+    stats = ConnectionStats(peer)
+    with _lock:
+        _connections[id(stats)] = stats
+    return stats
+
+
+def close(stats: ConnectionStats) -> None:
+    """
+    Rimuove una connessione chiusa, sommandone i contatori ai totali del processo.
+    """
+    global _closed_count
+    if stats is None:
+        return
+    with _lock:
+        if _connections.pop(id(stats), None) is None:
+            return
+        for name, value in stats.read_counters().items():
+            _closed[name] += value
+        _closed_count += 1
+        # Le latenze restano comunque negli istogrammi globali
+
+
+def snapshot() -> dict:
+    """
+    Fotografia delle metriche correnti come dizionario serializzabile in JSON.
+    """
+    with _lock:
+        totals = dict(_closed)
+        open_stats = list(_connections.values())
+        for stats in open_stats:
+            for name, value in stats.read_counters().items():
+                totals[name] += value
+        return {
+            'enabled': ENABLED,
+            'connections_open': len(open_stats),
+            'connections_closed': _closed_count,
+            'totals': totals,
+            'phases': {name: h.snapshot() for name, h in sorted(_phases.items())},
+            'connections': [stats.snapshot() for stats in open_stats],
+        }
+
+
+def render_text() -> str:
+    """
+    Metriche in formato testuale compatibile con Prometheus.
+    """
+    with _lock:
+        phases = {name: (list(h.counts), h.count, h.total) for name, h in sorted(_phases.items())}
+    data = snapshot()
+    lines = [
+        f"secure_chat_connections_open {data['connections_open']}",
+        f"secure_chat_connections_closed_total {data['connections_closed']}",
+    ]
+    for name, value in data['totals'].items():
+        lines.append(f"secure_chat_{name}_total {value}")
+    for name, (counts, count, total) in phases.items():
+        cumulative = 0
+        for i, n in enumerate(counts[:-1]):
+            cumulative += n
+            lines.append(f'secure_chat_phase_seconds_bucket{{phase="{name}",le="{2 ** i / 1e6:g}"}} {cumulative}')
+        lines.append(f'secure_chat_phase_seconds_bucket{{phase="{name}",le="+Inf"}} {count}')
+        lines.append(f'secure_chat_phase_seconds_sum{{phase="{name}"}} {total:.9f}')
+        lines.append(f'secure_chat_phase_seconds_count{{phase="{name}"}} {count}')
+    for stats in data['connections']:
+        for name, value in stats['counters'].items():
+            lines.append(f'secure_chat_connection_{name}{{peer="{stats["peer"]}"}} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            body, content_type = render_text().encode(), 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body, content_type = json.dumps(snapshot(), indent=2).encode(), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Nessun log per richiesta: l'endpoint viene interrogato di frequente
+        pass
+
+
+def serve(host: str = '127.0.0.1', port: int = METRICS_PORT) -> ThreadingHTTPServer:
+    """
+    Espone /metrics (testo) e /metrics.json su un thread in background.
+    L'endpoint non è autenticato: va lasciato su loopback.
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
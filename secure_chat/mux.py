@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+import argparse
+import base64
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+from collections import deque
+from client import handshake as client_handshake
+from common import (CipherState, FrameReader, read_frame_flags, send_segments, key_update_segments, open_frame,
+                    HANDSHAKE_MODES, FRAME_KEY_UPDATE)
+from dh_params import get_parameters
+from resumption import TicketStore
+from server import handshake as server_handshake, DH_SOURCE
+
+# Tipi di frame del multiplexer
+MUX_OPEN = 1     # apertura di un canale
+MUX_DATA = 2     # dati del canale
+MUX_CLOSE = 3    # il mittente non invierà più dati sul canale (chiusura a metà)
+MUX_WINDOW = 4   # credito di flusso: il mittente può inviare altri n byte
+MUX_RESET = 5    # canale rifiutato o interrotto
+# Intestazione in chiaro dentro il frame cifrato: [tipo:1][canale:4], legata al tag come AAD
+MUX_HEADER = struct.Struct('>BI')
+WINDOW_INCREMENT = struct.Struct('>I')
+# Finestra di controllo di flusso per canale e direzione (byte non ancora letti dall'applicazione):
+# un canale lento non può riempire la memoria del peer né bloccare gli altri canali
+STREAM_WINDOW = 256 * 1024
+# Dimensione massima dei dati in un singolo frame: canali diversi si alternano sul socket
+MAX_DATA_FRAME = 16 * 1024
+# Canali aperti contemporaneamente dal peer; quelli in eccesso ricevono MUX_RESET
+MAX_STREAMS = 1024
+
+
+class StreamReset(ConnectionError):
+    """
+    Il canale è stato rifiutato o interrotto dal peer, oppure la connessione è caduta.
+    """
+
+
+class MuxStream:
+    """
+    Canale logico bidirezionale: send/recv come su un socket, con chiusura a metà.
+    """
+
+    def __init__(self, mux: 'Multiplexer', stream_id: int):
+        self.mux = mux
+        self.id = stream_id
+        self._cond = threading.Condition(mux._lock)
+        self._buffer = deque()
+        # Credito di invio concesso dal peer e credito di ricezione concesso al peer
+        self._send_window = STREAM_WINDOW
+        self._recv_window = STREAM_WINDOW
+        # Byte letti dall'applicazione e non ancora restituiti al peer come credito
+        self._consumed = 0
+        self.local_closed = False
+        self.remote_closed = False
+        self.reset = False
+
+    def send(self, data) -> None:
+        """
+        Invia data sul canale; blocca finché il peer non concede credito sufficiente.
+        """
+        view = memoryview(data)
+        while view:
+            with self._cond:
+                # 1) Controllo di flusso: si invia solo entro la finestra concessa dal peer
+                while self._send_window == 0 and not self.reset:
+                    self._cond.wait()
+                if self.reset:
+                    raise StreamReset(f"Canale {self.id} interrotto")
+                if self.local_closed:
+                    raise ValueError(f"Canale {self.id} già chiuso in invio")
+                size = min(len(view), self._send_window, MAX_DATA_FRAME)
+                self._send_window -= size
+            self.mux._send_frame(MUX_DATA, self.id, view[:size])
+            view = view[size:]
+
+    def recv(self) -> bytes:
+        """
+        Restituisce il prossimo blocco di dati ricevuto, b'' quando il peer ha chiuso il canale.
+        """
+        with self._cond:
+            while not self._buffer and not self.remote_closed and not self.reset:
+                self._cond.wait()
+            if self._buffer:
+                data = self._buffer.popleft()
+            elif self.reset:
+                raise StreamReset(f"Canale {self.id} interrotto")
+            else:
+                return b''
+            # 2) Il credito torna al peer a blocchi di mezza finestra, non a ogni lettura
+            self._consumed += len(data)
+            increment = 0
+            if self._consumed >= STREAM_WINDOW // 2 and not self.remote_closed:
+                increment, self._consumed = self._consumed, 0
+                self._recv_window += increment
+        if increment:
+            self.mux._send_frame(MUX_WINDOW, self.id, WINDOW_INCREMENT.pack(increment))
+        return data
+
+    def close(self) -> None:
+        """
+        Chiusura a metà: niente più invii, ma si possono ancora ricevere i dati del peer.
+        """
+        with self._cond:
+            if self.local_closed or self.reset or self.mux.closed:
+                self.local_closed = True
+                return
+            self.local_closed = True
+        self.mux._send_frame(MUX_CLOSE, self.id, b'')
+        self.mux._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Multiplexer:
+    """
+    Molti canali logici su una sola connessione cifrata: un solo handshake e un solo socket.
+    Ogni frame è [intestazione][ciphertext] con tipo e numero di canale come dati associati AEAD.
+    """
+
+    def __init__(self, conn: socket.socket, send_cipher: CipherState, recv_cipher: CipherState,
+                 server_side: bool, reader: FrameReader = None):
+        self.conn = conn
+        self.send_cipher = send_cipher
+        self.recv_cipher = recv_cipher
+        self.reader = reader or FrameReader(conn)
+        # Un solo lock per lo stato dei canali; l'invio ha il suo, perché l'ordine dei frame
+        # sul socket deve seguire i numeri di sequenza del cifrario
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._streams = {}
+        # Canali dispari aperti dal client, pari dal server: nessuna collisione tra i due lati
+        self._next_id = 2 if server_side else 1
+        self._incoming = queue.Queue()
+        self.closed = False
+        self.error = None
+        self._thread = threading.Thread(target=self._receive_loop, name='mux', daemon=True)
+        self._thread.start()
+
+    def open_stream(self) -> MuxStream:
+        """
+        Apre un nuovo canale verso il peer (nessun round trip: i dati possono seguire subito).
+        """
+        with self._lock:
+            if self.closed:
+                raise StreamReset("Connessione chiusa")
+            stream = MuxStream(self, self._next_id)
+            self._streams[stream.id] = stream
+            self._next_id += 2
+        self._send_frame(MUX_OPEN, stream.id, b'')
+        return stream
+
+    def accept(self, timeout: float = None) -> MuxStream:
+        """
+        Attende un canale aperto dal peer; restituisce None se la connessione si chiude.
+        """
+        return self._incoming.get(timeout=timeout)
+
+    def _send_frame(self, frame_type: int, stream_id: int, payload) -> None:
+        header = MUX_HEADER.pack(frame_type, stream_id)
+        with self._send_lock:
+            # Il numero di canale è nei dati associati: un frame spostato su un altro canale
+            # (o con il tipo cambiato) non supera la verifica del tag
+            body = self.send_cipher.seal(payload, header)
+            segments = [struct.pack('>I', len(header) + sum(len(seg) for seg in body)), header] + body
+            if self.send_cipher.needs_rekey():
+                segments += key_update_segments(self.send_cipher)
+            send_segments(self.conn, segments)
+
+    def _release(self, stream: MuxStream) -> None:
+        # Il canale viene dimenticato quando entrambe le direzioni sono chiuse
+        with self._lock:
+            if (stream.local_closed and stream.remote_closed) or stream.reset:
+                self._streams.pop(stream.id, None)
+
+    def _receive_loop(self) -> None:
+        try:
+            while True:
+                flags, frame = read_frame_flags(self.reader)
+                if flags == FRAME_KEY_UPDATE:
+                    # Aggiornamento delle chiavi tra due frame: non appartiene a nessun canale
+                    open_frame(self.recv_cipher, flags, frame)
+                    continue
+                if flags:
+                    # _send_frame non comprime mai: qualunque altro flag è un frame estraneo al multiplexer
+                    raise ValueError(f"Frame con flag {flags:#x} inatteso nel multiplexer")
+                if len(frame) < MUX_HEADER.size:
+                    raise ValueError("Frame del multiplexer troncato")
+                header = bytes(frame[:MUX_HEADER.size])
+                payload = self.recv_cipher.open(frame[MUX_HEADER.size:], header)
+                self._dispatch(*MUX_HEADER.unpack(header), payload)
+        except Exception as e:
+            # EOF, errore di rete o frame non autentico: la connessione intera è compromessa
+            if not isinstance(e, (EOFError, OSError)):
+                self.error = e
+        finally:
+            self._shutdown()
+
+    def _dispatch(self, frame_type: int, stream_id: int, payload: bytes) -> None:
+        with self._lock:
+            stream = self._streams.get(stream_id)
+            if frame_type == MUX_OPEN:
+                # 3) I canali del peer hanno la parità opposta alla nostra
+                if stream is not None or stream_id % 2 == self._next_id % 2:
+                    raise ValueError(f"Apertura non valida del canale {stream_id}")
+                if sum(1 for s in self._streams.values() if s.id % 2 != self._next_id % 2) >= MAX_STREAMS:
+                    refuse = True
+                else:
+                    refuse = False
+                    stream = self._streams[stream_id] = MuxStream(self, stream_id)
+            elif stream is None:
+                # Canale già chiuso o interrotto da noi: i frame ancora in volo si scartano
+                return
+            elif frame_type == MUX_DATA:
+                if stream.remote_closed:
+                    raise ValueError(f"Dati sul canale {stream_id} dopo la chiusura")
+                if len(payload) > stream._recv_window:
+                    # Il peer ha ignorato la finestra: violazione del protocollo
+                    raise ValueError(f"Finestra del canale {stream_id} superata")
+                stream._recv_window -= len(payload)
+                if payload:
+                    stream._buffer.append(payload)
+                stream._cond.notify_all()
+            elif frame_type == MUX_WINDOW:
+                (increment,) = WINDOW_INCREMENT.unpack(payload)
+                stream._send_window += increment
+                stream._cond.notify_all()
+            elif frame_type == MUX_CLOSE:
+                stream.remote_closed = True
+                stream._cond.notify_all()
+            elif frame_type == MUX_RESET:
+                stream.reset = True
+                stream._cond.notify_all()
+            else:
+                raise ValueError(f"Tipo di frame del multiplexer sconosciuto: {frame_type}")
+
+        if frame_type == MUX_OPEN:
+            if refuse:
+                self._send_frame(MUX_RESET, stream_id, b'')
+            else:
+                self._incoming.put(stream)
+        elif frame_type in (MUX_CLOSE, MUX_RESET):
+            self._release(stream)
+
+    def _shutdown(self) -> None:
+        with self._lock:
+            self.closed = True
+            streams = list(self._streams.values())
+            self._streams.clear()
+            for stream in streams:
+                # Chi era in attesa su un canale riceve StreamReset invece di bloccarsi
+                # (i dati già ricevuti restano comunque leggibili)
+                if not stream.remote_closed:
+                    stream.reset = True
+                stream._cond.notify_all()
+        self._incoming.put(None)
+
+    def close(self) -> None:
+        """
+        Chiude la connessione e tutti i canali.
+        """
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._thread.join()
+        self.conn.close()
+
+
+# Porta della demo (diversa da quelle di server.py e async_server.py)
+HOST = '127.0.0.1'
+PORT = 65435
+
+
+def serve(host: str = HOST, port: int = PORT) -> None:
+    """
+    Server echo multiplexato: un thread per connessione e uno per canale.
+    """
+    parameters = get_parameters(DH_SOURCE)
+    tickets = TicketStore()
+
+    def echo(stream):
+        try:
+            with stream:
+                while data := stream.recv():
+                    stream.send(data)
+        except ConnectionError:
+            # Canale interrotto o connessione caduta: il multiplexer ne registra la causa
+            pass
+
+    def session(conn, addr):
+        with conn:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            send_cipher, recv_cipher = server_handshake(conn, parameters, tickets, verbose=False)
+            mux = Multiplexer(conn, send_cipher, recv_cipher, server_side=True)
+            count = 0
+            while (stream := mux.accept()) is not None:
+                threading.Thread(target=echo, args=(stream,), daemon=True).start()
+                count += 1
+            print(f"[*] {addr}: {count} canali su una connessione"
+                  + (f" ({mux.error!r})" if mux.error else ""))
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((host, port))
+        s.listen(128)
+        print(f"[+] Server multiplexato in ascolto su {host}:{port}", flush=True)
+        while True:
+            conn, addr = s.accept()
+            threading.Thread(target=session, args=(conn, addr), daemon=True).start()
+
+
+def demo_client(host: str, port: int, streams: int, messages: int, size: int) -> None:
+    """
+    Apre streams canali su una sola connessione e li usa in parallelo.
+    """
+    payload = base64.b64encode(os.urandom(size))[:size]
+    with socket.create_connection((host, port)) as sock:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        start = time.perf_counter()
+        send_cipher, recv_cipher = client_handshake(sock, HANDSHAKE_MODES, ticket_file=None, verbose=False)
+        print(f"[*] Handshake in {1000 * (time.perf_counter() - start):.2f}ms, una volta per {streams} canali")
+        mux = Multiplexer(sock, send_cipher, recv_cipher, server_side=False)
+        errors = []
+
+        def run():
+            stream = mux.open_stream()
+            expected = memoryview(payload * messages)
+
+            def writer():
+                # Invio e ricezione in parallelo: con messaggi più grandi della finestra un client
+                # che legge solo dopo aver scritto si bloccherebbe insieme al server
+                try:
+                    for _ in range(messages):
+                        stream.send(payload)
+                finally:
+                    stream.close()
+
+            sender = threading.Thread(target=writer)
+            sender.start()
+            try:
+                # Il canale è un flusso di byte: l'echo può arrivare in blocchi di qualunque misura
+                offset = 0
+                while data := stream.recv():
+                    if expected[offset:offset + len(data)] != data:
+                        raise ValueError(f"Echo diverso sul canale {stream.id}")
+                    offset += len(data)
+                if offset != len(expected):
+                    raise EOFError(f"Canale {stream.id} chiuso dopo {offset} byte su {len(expected)}")
+            except Exception as e:
+                errors.append(e)
+            sender.join()
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=run) for _ in range(streams)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        mux.close()
+    total = streams * messages - len(errors) * messages
+    print(f"[*] {streams} canali, {total} echo da {size} byte in {elapsed:.3f}s "
+          f"({total / elapsed if elapsed else 0:.1f} msg/s)")
+    for error in errors[:5]:
+        print(f"[!] {error!r}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Canali multipli su una connessione cifrata (demo echo)")
+    parser.add_argument('role', choices=('server', 'client'))
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--streams', type=int, default=16, help="Canali aperti dal client")
+    parser.add_argument('--messages', type=int, default=100, help="Echo per canale")
+    parser.add_argument('--size', type=int, default=1024, help="Byte per messaggio")
+    args = parser.parse_args()
+    if args.role == 'server':
+        serve(args.host, args.port)
+    else:
+        demo_client(args.host, args.port, args.streams, args.messages, args.size)
+
+
+# Punto di ingresso dello script
+if __name__ == '__main__':
+    main()
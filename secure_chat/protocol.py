@@ -0,0 +1,632 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import os
+import random
+import struct
+import time
+from collections import deque
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.asymmetric import dh, x25519
+from common import (MAX_FRAME_SIZE, FRAME_LENGTH_MASK, HANDSHAKE_MODES, SUPPORTED_SUITES, SUPPORTED_COMPRESSION,
+                    EXT_RESUME, EXT_SUITES, EXT_COMPRESSION, derive_session, choose_mode, choose_suite,
+                    choose_compression, enable_compression, encrypt_segments, open_frame, recvn, send_segments,
+                    int_to_bytes, encode_client_hello, decode_client_hello, encode_server_hello, decode_server_hello,
+                    encode_dh_share, decode_dh_share, encode_suites, decode_suites, encode_compression,
+                    decode_compression)
+from dh_params import get_parameters
+import metrics
+from resumption import ClientTicket, TicketStore, resumption_secret, resume_session, RANDOM_SIZE
+
+# Protocollo "sans-IO": Connection non legge né scrive mai su un socket.
+# Riceve i byte arrivati dalla rete (receive_data), restituisce gli eventi che ne derivano
+# e accumula i byte da inviare (data_to_send). Chi la usa decide come fare I/O:
+# socket bloccanti (BlockingConnection), asyncio (AsyncConnection) o semplici buffer in memoria.
+
+# Stati della macchina
+STATE_START = 'start'                  # client: ClientHello non ancora inviato (vedi initiate)
+STATE_CLIENT_HELLO = 'client_hello'    # server: in attesa del ClientHello
+STATE_SERVER_HELLO = 'server_hello'    # client: in attesa del ServerHello
+STATE_KEY_SHARE = 'key_share'          # server: in attesa della chiave pubblica del client
+STATE_TICKET = 'ticket'                # client: in attesa del ticket che chiude l'handshake
+STATE_ESTABLISHED = 'established'      # messaggi cifrati in entrambe le direzioni
+STATE_CLOSED = 'closed'                # errore di protocollo o fine dei dati: nessun altro evento
+# Byte già elaborati oltre i quali il buffer di ricezione viene compattato
+COMPACT_THRESHOLD = 65536
+# Dimensione delle letture degli adattatori dopo l'handshake
+RECEIVE_BUFFER_SIZE = 65536
+# Errori attesi su input malformati o manomessi (tutto il resto è un bug della macchina)
+PROTOCOL_ERRORS = (ValueError, EOFError, InvalidTag)
+
+
+class HandshakeComplete:
+    """
+    Evento: handshake concluso, cifrari pronti.
+    compression è l'algoritmo di compressione negoziato (None se nessuno).
+    ticket è il nuovo resumption.ClientTicket ricevuto dal client (None sul server o se assente).
+    """
+    __slots__ = ('mode', 'suite', 'compression', 'resumed', 'ticket')
+
+    def __init__(self, mode, suite, compression, resumed, ticket=None):
+        self.mode = mode
+        self.suite = suite
+        self.compression = compression
+        self.resumed = resumed
+        self.ticket = ticket
+
+
+class MessageReceived:
+    """
+    Evento: messaggio decifrato e autenticato.
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+
+class KeyUpdated:
+    """
+    Evento: il peer è passato alla generazione di chiavi successiva (vedi common.key_update_segments).
+    """
+    __slots__ = ('generation',)
+
+    def __init__(self, generation):
+        self.generation = generation
+
+
+class Connection:
+    """
+    Macchina a stati del protocollo (handshake, cifratura e framing) senza I/O.
+    Lato server servono parameters (parametri DH, None per accettare solo X25519) e,
+    per la ripresa, tickets (TicketStore; con None si invia un ticket vuoto).
+    Lato client ticket è un eventuale resumption.ClientTicket da offrire.
+    generate_dh_key sostituisce parameters.generate_private_key (es. dh_params.KeyPool.get).
+    compression sono gli algoritmi di compressione offerti (client, di default nessuno)
+    o accettati (server, di default tutti quelli disponibili).
+    """
+
+    def __init__(self, server_side: bool, modes=HANDSHAKE_MODES, suites=SUPPORTED_SUITES, parameters=None,
+                 tickets: TicketStore = None, ticket: ClientTicket = None, generate_dh_key=None, stats=None,
+                 max_frame_size: int = None, compression=None):
+        self.server_side = server_side
+        self.modes = tuple(modes)
+        self.suites = tuple(suites)
+        if compression is None:
+            # Il client deve chiederla esplicitamente (vedi common.COMPRESSION_IDS sui rischi)
+            compression = SUPPORTED_COMPRESSION if server_side else ()
+        self.offered_compression = tuple(compression)
+        self.parameters = parameters
+        self.tickets = tickets
+        self.ticket = ticket
+        self.generate_dh_key = generate_dh_key
+        self.stats = stats
+        self.max_frame_size = MAX_FRAME_SIZE if max_frame_size is None else max_frame_size
+        self.state = STATE_CLIENT_HELLO if server_side else STATE_START
+        # Esito della negoziazione, valorizzato durante l'handshake
+        self.mode = None
+        self.suite = None
+        self.compression = None
+        self.resumed = False
+        # Segreto dello scambio di chiavi (solo handshake completo): serve al MITM per le catture
+        self.shared_key = None
+        self.send_cipher = None
+        self.recv_cipher = None
+        self._private = None
+        self._client_random = None
+        self._next_secret = None
+        # Byte ricevuti non ancora elaborati: i validi stanno in _inbuf[_start:]
+        self._inbuf = bytearray()
+        self._start = 0
+        self._outgoing = []
+
+    @property
+    def established(self) -> bool:
+        return self.state == STATE_ESTABLISHED
+
+    def initiate(self) -> None:
+        """
+        Lato client: prepara il ClientHello (da inviare con data_to_send).
+        """
+        if self.server_side or self.state != STATE_START:
+            raise ValueError("initiate() va chiamato una sola volta, dal client")
+        # 1) Offerta delle modalità di scambio chiavi in ordine di preferenza
+        # (X25519 è molto più veloce del DH a 2048 bit) e delle suite AEAD supportate.
+        # Se abbiamo un ticket di una sessione precedente lo offriamo con un valore casuale fresco:
+        # in caso di successo l'intero scambio di chiavi viene saltato
+        self._client_random = os.urandom(RANDOM_SIZE)
+        extensions = {EXT_SUITES: encode_suites(self.suites)}
+        if self.offered_compression:
+            extensions[EXT_COMPRESSION] = encode_compression(self.offered_compression)
+        if self.ticket is not None:
+            extensions[EXT_RESUME] = self._client_random + self.ticket.ticket
+        self._send_record(encode_client_hello(self.modes, extensions))
+        self.state = STATE_SERVER_HELLO
+
+    def bytes_needed(self) -> int:
+        """
+        Byte che mancano per completare il frame in arrivo (almeno 1).
+        Gli adattatori leggono esattamente questi byte durante l'handshake, così nessun
+        messaggio cifrato successivo resta nel buffer di Connection.
+        """
+        available = len(self._inbuf) - self._start
+        if available < 4:
+            return 4 - available
+        (header,) = struct.unpack_from('>I', self._inbuf, self._start)
+        return max(1, 4 + (header & FRAME_LENGTH_MASK) - available)
+
+    def receive_data(self, data) -> list:
+        """
+        Elabora i byte ricevuti e restituisce gli eventi generati, in ordine.
+        data vuoto indica la chiusura della connessione da parte del peer (EOFError).
+        """
+        if self.state == STATE_CLOSED:
+            raise ValueError("Connessione chiusa")
+        if not data:
+            self.state = STATE_CLOSED
+            raise EOFError("Connection closed")
+        self._inbuf += data
+        events = []
+        try:
+            # 2) Framing: [4-byte length][payload], con i bit alti della lunghezza come flag
+            while len(self._inbuf) - self._start >= 4:
+                (header,) = struct.unpack_from('>I', self._inbuf, self._start)
+                flags, length = header & ~FRAME_LENGTH_MASK, header & FRAME_LENGTH_MASK
+                # Un peer non deve poterci far accumulare fino a 1 GiB annunciando una lunghezza enorme
+                if length > self.max_frame_size:
+                    raise ValueError(f"Frame di {length} byte oltre il limite di {self.max_frame_size}")
+                end = self._start + 4 + length
+                if end > len(self._inbuf):
+                    break
+                with memoryview(self._inbuf) as view:
+                    event = self._handle_frame(flags, view[self._start + 4:end])
+                self._start = end
+                if event is not None:
+                    events.append(event)
+        except BaseException:
+            # Dopo un frame malformato o non autentico lo stato non è più affidabile
+            self.state = STATE_CLOSED
+            raise
+        if self._start == len(self._inbuf):
+            self._inbuf.clear()
+            self._start = 0
+        elif self._start >= COMPACT_THRESHOLD:
+            # Si spostano solo i byte del frame parziale, non a ogni frame
+            del self._inbuf[:self._start]
+            self._start = 0
+        return events
+
+    def send(self, plaintext: bytes, compress: bool = True) -> None:
+        """
+        Cifra un messaggio e ne accoda i segmenti per data_to_send.
+        compress=False per i messaggi che uniscono segreti e dati scelti da altri.
+        """
+        if self.state != STATE_ESTABLISHED:
+            raise ValueError("Handshake non completato")
+        self._outgoing.extend(encrypt_segments(self.send_cipher, plaintext, compress))
+
+    def data_to_send(self) -> list:
+        """
+        Restituisce (e svuota) i segmenti in attesa di invio, da passare a send_segments o writelines.
+        """
+        segments, self._outgoing = self._outgoing, []
+        return segments
+
+    def _send_record(self, payload: bytes) -> None:
+        # Record di handshake in chiaro, con lo stesso framing dei messaggi cifrati
+        self._outgoing += [struct.pack('>I', len(payload)), payload]
+
+    def _handle_frame(self, flags: int, payload):
+        if self.state == STATE_ESTABLISHED:
+            # 3) Messaggi cifrati: il nonce è il contatore atteso, quindi un frame ripetuto,
+            # riordinato o manomesso fa fallire il tag; i frame di aggiornamento chiavi avanzano il ratchet
+            plaintext = open_frame(self.recv_cipher, flags, payload)
+            if plaintext is None:
+                return KeyUpdated(self.recv_cipher.generation)
+            return MessageReceived(plaintext)
+        if flags:
+            raise ValueError("Frame di controllo durante l'handshake")
+        # I record di handshake sono piccoli: una copia indipendente dal buffer
+        record = bytes(payload)
+        if self.state == STATE_CLIENT_HELLO:
+            return self._on_client_hello(record)
+        if self.state == STATE_KEY_SHARE:
+            return self._on_key_share(record)
+        if self.state == STATE_SERVER_HELLO:
+            return self._on_server_hello(record)
+        if self.state == STATE_TICKET:
+            return self._on_ticket(record)
+        raise ValueError(f"Record inatteso nello stato {self.state!r}")
+
+    def _on_client_hello(self, record: bytes):
+        # 4) Server: scelta di ripresa, modalità e suite
+        # Se il ClientHello contiene un ticket valido l'handshake viene abbreviato
+        offered, extensions = decode_client_hello(record)
+        secret = None
+        if EXT_RESUME in extensions and self.tickets is not None:
+            # Il client presenta un ticket di una sessione precedente insieme a un valore casuale fresco
+            client_random = extensions[EXT_RESUME][:RANDOM_SIZE]
+            secret = self.tickets.redeem(extensions[EXT_RESUME][RANDOM_SIZE:])
+        # La suite AEAD è scelta dal server tra quelle offerte, secondo la propria preferenza
+        self.suite = choose_suite(decode_suites(extensions[EXT_SUITES]) if EXT_SUITES in extensions else None,
+                                  self.suites)
+        # La compressione si usa solo se il client la chiede e il server la accetta
+        self.compression = choose_compression(decode_compression(extensions.get(EXT_COMPRESSION, b'')),
+                                              self.offered_compression)
+
+        if secret is not None:
+            # 4a) Ripresa di sessione: ticket valido, niente scambio di chiavi pubbliche.
+            # Le chiavi di traffico derivano dal segreto di ripresa e dai valori casuali
+            server_random = os.urandom(RANDOM_SIZE)
+            self.mode = 'resume'
+            self.resumed = True
+            self._send_record(encode_server_hello(self.mode, server_random, self.suite, self.compression))
+            self.send_cipher, self.recv_cipher, next_secret = resume_session(
+                secret, client_random, server_random, server_side=True, suite=self.suite)
+            return self._issue_ticket(next_secret)
+
+        # Senza parametri DH il server accetta solo X25519
+        supported = self.modes if self.parameters is not None else tuple(m for m in self.modes if m != 'dh')
+        self.mode = choose_mode(offered, supported)
+        if self.mode == 'x25519':
+            # 4b) X25519: chiave privata a 32 byte e chiave pubblica a 32 byte inviata così com'è
+            self._private = x25519.X25519PrivateKey.generate()
+            share = self._private.public_key().public_bytes_raw()
+        else:
+            # 4c) DH: p, g e la chiave pubblica del server come interi big-endian a larghezza fissa;
+            # il client ha bisogno di questi valori per calcolare lo stesso segreto condiviso
+            params = self.parameters.parameter_numbers()
+            self._private = (self.generate_dh_key or self.parameters.generate_private_key)()
+            share = encode_dh_share(params.p, params.g, self._private.public_key().public_numbers().y)
+        self._send_record(encode_server_hello(self.mode, share, self.suite, self.compression))
+        self.state = STATE_KEY_SHARE
+        return None
+
+    def _on_key_share(self, record: bytes):
+        # 5) Server: chiave pubblica del client (32 byte grezzi, oppure g^a mod p largo quanto p)
+        if self.mode == 'x25519':
+            peer_key = x25519.X25519PublicKey.from_public_bytes(record)
+        else:
+            peer_key = dh.DHPublicNumbers(int.from_bytes(record, 'big'),
+                                          self.parameters.parameter_numbers()).public_key()
+        self._exchange(peer_key)
+        return self._issue_ticket(resumption_secret(self.shared_key, self.mode))
+
+    def _issue_ticket(self, next_secret: bytes):
+        # 6) Server: nuovo ticket monouso per la prossima connessione (vuoto se non gestiamo la ripresa)
+        self._send_record(self.tickets.issue(next_secret) if self.tickets is not None else b'')
+        return self._complete()
+
+    def _on_server_hello(self, record: bytes):
+        # 4) Client: modalità e suite scelte dal server, e la sua parte dello scambio
+        self.mode, self.suite, self.compression, payload = decode_server_hello(record)
+        if self.suite not in self.suites:
+            raise ValueError(f"Il server ha scelto una suite non offerta: {self.suite}")
+        if self.compression is not None and self.compression not in self.offered_compression:
+            raise ValueError(f"Il server ha scelto una compressione non offerta: {self.compression}")
+        if self.mode == 'resume':
+            # 4a) Ripresa accettata: il server ha inviato solo il suo valore casuale,
+            # nessuno scambio di chiavi pubbliche e nessuna esponenziazione modulare
+            if self.ticket is None:
+                raise ValueError("Il server ha scelto la ripresa senza che fosse offerta")
+            self.resumed = True
+            self.send_cipher, self.recv_cipher, self._next_secret = resume_session(
+                self.ticket.secret, self._client_random, payload, server_side=False, suite=self.suite)
+        else:
+            if self.mode not in self.modes:
+                raise ValueError(f"Il server ha scelto una modalità non offerta: {self.mode}")
+            if self.mode == 'x25519':
+                # 4b) X25519: la chiave pubblica del server sono 32 byte grezzi
+                peer_key = x25519.X25519PublicKey.from_public_bytes(payload)
+                self._private = x25519.X25519PrivateKey.generate()
+                self._send_record(self._private.public_key().public_bytes_raw())
+            else:
+                # 4c) DH: ricostruiamo i parametri inviati dal server e generiamo la chiave privata (a);
+                # il server ha bisogno di g^a mod p per calcolare il segreto condiviso
+                p, g, server_pub = decode_dh_share(payload)
+                params = dh.DHParameterNumbers(p, g)
+                peer_key = dh.DHPublicNumbers(server_pub, params).public_key()
+                self._private = params.parameters().generate_private_key()
+                self._send_record(int_to_bytes(self._private.public_key().public_numbers().y,
+                                               (p.bit_length() + 7) // 8))
+            self._exchange(peer_key)
+            # Segreto di ripresa da associare al ticket che il server invierà
+            self._next_secret = resumption_secret(self.shared_key, self.mode)
+        self.state = STATE_TICKET
+        return None
+
+    def _on_ticket(self, record: bytes):
+        # 6) Client: il ticket chiude l'handshake (un ticket vale una sola volta)
+        ticket = ClientTicket(record, self._next_secret) if record else None
+        self._next_secret = None
+        return self._complete(ticket)
+
+    def _exchange(self, peer_key) -> None:
+        # 5) Calcolo del segreto condiviso: (g^b)^a mod p = g^(ab) mod p oppure a*b*G sulla curva,
+        # mai trasmesso sul canale. Il segreto non si usa direttamente: HKDF ne ricava, legate
+        # anche a modalità e suite, una chiave AEAD e un sale per ciascuna direzione
+        with metrics.timed('exchange', self.stats):
+            self.shared_key = self._private.exchange(peer_key)
+        self._private = None
+        self.send_cipher, self.recv_cipher = derive_session(self.shared_key, self.mode, self.server_side, self.suite)
+
+    def _complete(self, ticket: ClientTicket = None) -> HandshakeComplete:
+        self.state = STATE_ESTABLISHED
+        self.send_cipher.stats = self.recv_cipher.stats = self.stats
+        # Contesti di compressione nuovi per ogni sessione, anche ripresa
+        enable_compression(self.send_cipher, self.recv_cipher, self.compression)
+        return HandshakeComplete(self.mode, self.suite, self.compression, self.resumed, ticket)
+
+
+class BlockingConnection:
+    """
+    Adattatore bloccante: esegue una Connection su un socket connesso.
+    """
+
+    def __init__(self, sock, conn: Connection):
+        self.sock = sock
+        self.conn = conn
+        self._buf = bytearray(RECEIVE_BUFFER_SIZE)
+        self._view = memoryview(self._buf)
+        self._messages = deque()
+
+    def handshake(self) -> HandshakeComplete:
+        if not self.conn.server_side:
+            self.conn.initiate()
+        self._flush()
+        while True:
+            # Durante l'handshake si legge esattamente il record atteso: i messaggi cifrati
+            # che il peer invia subito dopo restano nel socket per chi lo userà (es. FrameReader)
+            events = self.conn.receive_data(recvn(self.sock, self.conn.bytes_needed()))
+            self._flush()
+            for event in events:
+                if isinstance(event, HandshakeComplete):
+                    return event
+
+    def send(self, plaintext: bytes, compress: bool = True) -> None:
+        self.conn.send(plaintext, compress)
+        self._flush()
+
+    def recv(self) -> bytes:
+        """
+        Restituisce il messaggio successivo; solleva EOFError se il peer chiude.
+        """
+        while not self._messages:
+            count = self.sock.recv_into(self._view)
+            for event in self.conn.receive_data(self._view[:count]):
+                if isinstance(event, MessageReceived):
+                    self._messages.append(event.data)
+        return self._messages.popleft()
+
+    def _flush(self) -> None:
+        segments = self.conn.data_to_send()
+        if segments:
+            send_segments(self.sock, segments)
+
+
+class AsyncConnection:
+    """
+    Adattatore asyncio: esegue una Connection su una coppia StreamReader/StreamWriter.
+    Con executor l'elaborazione dei record di handshake (exchange, HKDF) gira fuori dall'event loop.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, conn: Connection,
+                 executor=None):
+        self.reader = reader
+        self.writer = writer
+        self.conn = conn
+        self.executor = executor
+        self._messages = deque()
+
+    async def handshake(self) -> HandshakeComplete:
+        loop = asyncio.get_running_loop()
+        if not self.conn.server_side:
+            self.conn.initiate()
+        await self._flush()
+        while True:
+            data = await self.reader.readexactly(self.conn.bytes_needed())
+            if self.executor is None:
+                events = self.conn.receive_data(data)
+            else:
+                # Connection non fa I/O: può girare su un altro thread senza altri accorgimenti
+                events = await loop.run_in_executor(self.executor, self.conn.receive_data, data)
+            await self._flush()
+            for event in events:
+                if isinstance(event, HandshakeComplete):
+                    return event
+
+    async def send(self, plaintext: bytes, compress: bool = True) -> None:
+        self.conn.send(plaintext, compress)
+        await self._flush()
+
+    async def recv(self) -> bytes:
+        """
+        Restituisce il messaggio successivo; solleva EOFError se il peer chiude.
+        """
+        while not self._messages:
+            # Una lettura può portare molti frame: vengono decifrati tutti insieme
+            for event in self.conn.receive_data(await self.reader.read(RECEIVE_BUFFER_SIZE)):
+                if isinstance(event, MessageReceived):
+                    self._messages.append(event.data)
+        return self._messages.popleft()
+
+    async def _flush(self) -> None:
+        segments = self.conn.data_to_send()
+        if segments:
+            # writelines passa i segmenti al trasporto senza concatenarli
+            self.writer.writelines(segments)
+            await self.writer.drain()
+
+
+# Strumenti in memoria: handshake e messaggi tra due Connection senza socket
+
+def pump(source: Connection, destination: Connection, chunk: int = None) -> list:
+    """
+    Consegna a destination i byte in uscita da source (eventualmente a pezzi di chunk byte)
+    e restituisce gli eventi generati.
+    """
+    data = b''.join(source.data_to_send())
+    events = []
+    step = chunk or len(data)
+    for offset in range(0, len(data), step):
+        events += destination.receive_data(data[offset:offset + step])
+    return events
+
+
+def connected_pair(mode: str = 'x25519', suite: str = None, parameters=None, tickets=None, ticket=None,
+                   compression=()):
+    """
+    Esegue in memoria l'handshake tra un client e un server e restituisce (client, server, esito del client).
+    """
+    suites = (suite,) if suite else SUPPORTED_SUITES
+    server = Connection(True, suites=suites, parameters=parameters, tickets=tickets)
+    client = Connection(False, modes=(mode,), suites=suites, ticket=ticket, compression=compression)
+    client.initiate()
+    while not client.established:
+        pump(client, server)
+        events = pump(server, client)
+    return client, server, events[-1]
+
+
+def bench(handshakes: int, messages: int, size: int, mode: str, suite: str, compression=()) -> None:
+    """
+    Velocità del solo protocollo, senza rete né chiamate di sistema.
+    """
+    parameters = get_parameters() if mode == 'dh' else None
+    tickets = TicketStore()
+    start = time.perf_counter()
+    for _ in range(handshakes):
+        client, server, result = connected_pair(mode, suite, parameters, tickets, compression=compression)
+    elapsed = time.perf_counter() - start
+    print(f"[*] {handshakes} handshake {mode}: {1000 * elapsed / handshakes:.3f} ms ciascuno "
+          f"({handshakes / elapsed:.1f}/s)")
+
+    start = time.perf_counter()
+    for _ in range(handshakes):
+        client, server, result = connected_pair(mode, suite, parameters, tickets, result.ticket, compression)
+    elapsed = time.perf_counter() - start
+    print(f"[*] {handshakes} riprese: {1000 * elapsed / handshakes:.3f} ms ciascuna ({handshakes / elapsed:.1f}/s)")
+
+    # Con la compressione un testo ripetitivo, come quello di una chat; altrimenti byte casuali
+    payload = (b'ciao, come va? tutto bene, grazie. ' * (size // 35 + 1))[:size] if compression else os.urandom(size)
+    batch = 64
+    received = 0
+    wire = 0
+    start = time.perf_counter()
+    for sent in range(0, messages, batch):
+        for _ in range(min(batch, messages - sent)):
+            client.send(payload)
+        data = b''.join(client.data_to_send())
+        wire += len(data)
+        received += len(server.receive_data(data))
+    elapsed = time.perf_counter() - start
+    print(f"[*] {received} messaggi da {size} byte ({client.suite}"
+          f"{', ' + client.compression if client.compression else ''}): {received / elapsed:.0f} msg/s, "
+          f"{received * size / elapsed / 1e6:.1f} MB/s, {wire / received:.1f} byte in rete per messaggio")
+
+
+def _mutate(rng: random.Random, data: bytes) -> bytes:
+    # Byte alterati, troncati o inseriti in posizioni casuali
+    data = bytearray(data)
+    for _ in range(rng.randrange(1, 4)):
+        position = rng.randrange(len(data))
+        action = rng.randrange(3)
+        if action == 0:
+            data[position] ^= 1 << rng.randrange(8)
+        elif action == 1:
+            del data[position:]
+        else:
+            data[position:position] = os.urandom(rng.randrange(1, 8))
+        if not data:
+            break
+    return bytes(data)
+
+
+def _deliver(rng: random.Random, source: Connection, destination: Connection, tamper: bool) -> list:
+    # Come pump, ma a pezzi di dimensione casuale e, con tamper, con una probabilità di manomissione
+    data = b''.join(source.data_to_send())
+    if tamper and data and rng.random() < 0.5:
+        data = _mutate(rng, data)
+    events = []
+    offset = 0
+    while offset < len(data):
+        step = rng.randrange(1, 64)
+        events += destination.receive_data(data[offset:offset + step])
+        offset += step
+    return events
+
+
+def fuzz(iterations: int, seed: int) -> None:
+    """
+    Alimenta la macchina con scambi validi spezzati a caso (gli eventi devono restare identici)
+    e con scambi manomessi (sono ammessi solo gli errori di PROTOCOL_ERRORS).
+    """
+    rng = random.Random(seed)
+    tickets = TicketStore()
+    parameters = get_parameters()
+    ticket = None
+    rejected = stalled = 0
+    for i in range(iterations):
+        # Un'iterazione su due è manomessa; metà delle connessioni tenta la ripresa
+        # e una su quattro usa DH (più lento) invece di X25519; la compressione varia a caso
+        tamper = i % 2 == 1
+        modes = ('dh',) if i % 8 >= 6 else HANDSHAKE_MODES
+        compression = rng.choice(((),) + tuple((algorithm,) for algorithm in SUPPORTED_COMPRESSION))
+        client = Connection(False, modes=modes, ticket=ticket if rng.random() < 0.5 else None, compression=compression)
+        server = Connection(True, tickets=tickets, parameters=parameters)
+        # Messaggi casuali o ripetitivi, sotto e sopra la soglia di compressione
+        messages = [os.urandom(rng.randrange(0, 1024)) if rng.random() < 0.5 else b'abc' * rng.randrange(0, 400)
+                    for _ in range(rng.randrange(1, 8))]
+        try:
+            client.initiate()
+            # 1) Handshake: al massimo due andate e ritorni; un input troncato lascia il server in attesa
+            for _ in range(2):
+                _deliver(rng, client, server, tamper)
+                for event in _deliver(rng, server, client, tamper):
+                    if isinstance(event, HandshakeComplete) and not tamper:
+                        ticket = event.ticket
+            if not (client.established and server.established):
+                if not tamper:
+                    raise AssertionError(f"Handshake incompleto con input valido (iterazione {i})")
+                stalled += 1
+                continue
+            # 2) Messaggi: devono arrivare tutti, in ordine e identici
+            for message in messages:
+                client.send(message)
+            received = [event.data for event in _deliver(rng, client, server, tamper)
+                        if isinstance(event, MessageReceived)]
+        except PROTOCOL_ERRORS:
+            if not tamper:
+                raise
+            rejected += 1
+            continue
+        if received != messages and not tamper:
+            raise AssertionError(f"Messaggi alterati con input valido (iterazione {i})")
+    print(f"[*] {iterations} iterazioni (seme {seed}): {rejected} scambi manomessi rifiutati, "
+          f"{stalled} in attesa di altri dati, nessun errore inatteso")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark e fuzzing in memoria di protocol.Connection")
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('bench', help="Handshake e messaggi al secondo senza socket")
+    p.add_argument('--handshakes', type=int, default=200)
+    p.add_argument('--messages', type=int, default=100000)
+    p.add_argument('--size', type=int, default=256)
+    p.add_argument('--mode', choices=HANDSHAKE_MODES, default='x25519')
+    p.add_argument('--suite', choices=SUPPORTED_SUITES)
+    p.add_argument('--compression', choices=SUPPORTED_COMPRESSION, help="Compressione negoziata dal client")
+    p = sub.add_parser('fuzz', help="Input spezzati e manomessi")
+    p.add_argument('--iterations', type=int, default=2000)
+    p.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if args.command == 'bench':
+        bench(args.handshakes, args.messages, args.size, args.mode, args.suite,
+              (args.compression,) if args.compression else ())
+    else:
+        fuzz(args.iterations, args.seed)
+
+
+# Punto di ingresso dello script
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+import argparse
+import socket
+import threading
+import time
+from capture import (CaptureReader, decode_session_keys, REC_SESSION, REC_FRAME, REC_END, REC_KEY_UPDATE,
+                     CLIENT_TO_SERVER, SERVER_TO_CLIENT, DIRECTION_NAMES)
+from client import handshake
+from common import FrameReader, send_encrypted, recv_decrypted, open_frame, FRAME_KEY_UPDATE
+from mitm_proxy import session_ciphers
+
+# Attesa massima delle risposte del server dopo l'ultimo messaggio ri-iniettato (secondi)
+DRAIN_TIMEOUT = 2.0
+
+
+def list_sessions(reader: CaptureReader) -> None:
+    """
+    Riepilogo delle sessioni: modalità, frame e byte per direzione, durata, presenza delle chiavi.
+    """
+    summary = {}
+    for record in reader.records():
+        info = summary.setdefault(record.session, {
+            'modes': '?', 'keys': False, 'frames': [0, 0], 'bytes': [0, 0],
+            'first': record.timestamp_ns, 'last': record.timestamp_ns, 'closed': False})
+        info['last'] = record.timestamp_ns
+        if record.type == REC_SESSION:
+            client_mode, client_shared, server_mode, _, client_suite, server_suite = decode_session_keys(record.payload)
+            info['modes'] = f"{client_mode}/{server_mode} suite={client_suite}/{server_suite}"
+            info['keys'] = bool(client_shared)
+        elif record.type == REC_FRAME:
+            info['frames'][record.direction] += 1
+            info['bytes'][record.direction] += len(record.payload)
+        elif record.type == REC_END:
+            info['closed'] = True
+    for session, info in sorted(summary.items()):
+        print(f"[{session}] modalità={info['modes']} chiavi={'sì' if info['keys'] else 'no'} "
+              f"c->s={info['frames'][0]} frame/{info['bytes'][0]} B "
+              f"s->c={info['frames'][1]} frame/{info['bytes'][1]} B "
+              f"durata={(info['last'] - info['first']) / 1e9:.3f}s{'' if info['closed'] else ' (aperta)'}")
+
+
+def decrypted_frames(reader: CaptureReader, session: int, keys):
+    """
+    Produce (record, messaggio in chiaro) per tutti i frame di una sessione, in ordine.
+    """
+    if not keys[1]:
+        raise ValueError(f"La sessione {session} è stata catturata senza chiavi")
+    _, from_client, _, from_server = session_ciphers(*keys)
+    ciphers = {CLIENT_TO_SERVER: from_client, SERVER_TO_CLIENT: from_server}
+    for record in reader.records({session}):
+        if record.type == REC_FRAME:
+            # I nonce sono contatori: ogni direzione va decifrata per intero e in ordine,
+            # anche quando i frame vengono poi filtrati
+            yield record, ciphers[record.direction].open(record.payload)
+        elif record.type == REC_KEY_UPDATE:
+            # Da qui in poi la direzione usa la generazione di chiavi successiva
+            open_frame(ciphers[record.direction], FRAME_KEY_UPDATE, record.payload)
+
+
+def decrypt(reader: CaptureReader, sessions, direction=None, grep=None) -> None:
+    """
+    Stampa i messaggi decifrati, filtrati per direzione e contenuto.
+    """
+    for session, keys in sorted(reader.sessions().items()):
+        if sessions is not None and session not in sessions:
+            continue
+        if not keys[1]:
+            # Cattura fatta con CAPTURE_KEYS = False: i frame ci sono ma non sono decifrabili
+            print(f"[!] [{session}] Nessuna chiave catturata per la sessione {session}, saltata")
+            continue
+        start = None
+        for record, msg in decrypted_frames(reader, session, keys):
+            start = record.timestamp_ns if start is None else start
+            if direction is not None and record.direction != direction:
+                continue
+            if grep is not None and grep not in msg:
+                continue
+            print(f"[{session}] +{(record.timestamp_ns - start) / 1e9:.6f}s "
+                  f"[{DIRECTION_NAMES[record.direction]}] {msg.decode(errors='replace')!r}")
+
+
+def inject_session(reader: CaptureReader, session: int, keys, host: str, port: int, speed: float, results: dict):
+    """
+    Ri-invia al server i messaggi client->server di una sessione su una connessione nuova.
+    speed è il fattore di velocità rispetto ai tempi registrati (0 = massima velocità).
+    """
+    expected = sum(1 for record in reader.records({session})
+                   if record.type == REC_FRAME and record.direction == SERVER_TO_CLIENT)
+    received = 0
+    done = threading.Event()
+
+    with socket.create_connection((host, port)) as sock:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        send_cipher, recv_cipher = handshake(sock, ticket_file=None, verbose=False)
+
+        def drain():
+            # Le risposte vengono lette in parallelo: l'invio segue i tempi della cattura,
+            # non quelli del server
+            nonlocal received
+            frames = FrameReader(sock)
+            try:
+                while True:
+                    recv_decrypted(frames, recv_cipher)
+                    received += 1
+                    if received >= expected:
+                        done.set()
+            except (EOFError, OSError, ValueError):
+                pass
+            finally:
+                done.set()
+
+        threading.Thread(target=drain, daemon=True).start()
+
+        sent = 0
+        first = None
+        start = time.perf_counter()
+        for record, msg in decrypted_frames(reader, session, keys):
+            if record.direction != CLIENT_TO_SERVER:
+                continue
+            first = record.timestamp_ns if first is None else first
+            if speed:
+                # Riproduce gli intervalli registrati (scalati) tra un messaggio e l'altro
+                delay = (record.timestamp_ns - first) / 1e9 / speed - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            send_encrypted(sock, send_cipher, msg)
+            sent += 1
+        if expected:
+            done.wait(DRAIN_TIMEOUT)
+        elapsed = time.perf_counter() - start
+        sock.shutdown(socket.SHUT_RDWR)
+
+    results[session] = (sent, received, elapsed)
+
+
+def inject(reader: CaptureReader, sessions, host: str, port: int, speed: float) -> None:
+    """
+    Ri-inietta le sessioni selezionate in parallelo, una connessione per sessione.
+    Il server deve accettare connessioni contemporanee (async_server.py): server.py ne serve una sola.
+    """
+    selected = {}
+    for session, keys in sorted(reader.sessions().items()):
+        if sessions is not None and session not in sessions:
+            continue
+        if not keys[1]:
+            # Senza chiavi non si possono ricavare i messaggi da ri-inviare
+            print(f"[!] [{session}] Nessuna chiave catturata per la sessione {session}, saltata")
+            continue
+        selected[session] = keys
+    results = {}
+    errors = {}
+
+    def run(session, keys):
+        try:
+            inject_session(reader, session, keys, host, port, speed, results)
+        except Exception as e:
+            errors[session] = e
+
+    threads = [threading.Thread(target=run, args=item) for item in sorted(selected.items())]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    for session, (sent, received, duration) in sorted(results.items()):
+        print(f"[{session}] inviati={sent} risposte={received} in {duration:.3f}s")
+    for session, error in sorted(errors.items()):
+        print(f"[!] [{session}] {error!r}")
+    total = sum(sent for sent, _, _ in results.values())
+    print(f"[*] {len(results)} sessioni, {total} messaggi in {elapsed:.3f}s "
+          f"({total / elapsed if elapsed else 0:.1f} msg/s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analisi e ri-iniezione di una cattura di mitm_proxy.py")
+    parser.add_argument('capture', help="File di cattura (CAPTURE_FILE di mitm_proxy.py)")
+    parser.add_argument('--decrypt', action='store_true', help="Stampa i messaggi decifrati")
+    parser.add_argument('--inject', metavar='HOST:PORT', help="Ri-invia i messaggi del client a un server che accetta più "
+                             "connessioni insieme (async_server.py, non server.py)")
+    parser.add_argument('--session', help="Elenco di sessioni da considerare (es. 1,3)")
+    parser.add_argument('--direction', choices=('c2s', 's2c'), help="Solo una direzione (con --decrypt)")
+    parser.add_argument('--grep', help="Solo i messaggi che contengono questo testo (con --decrypt)")
+    parser.add_argument('--speed', default='recorded',
+                        help="'recorded' (tempi originali), 'max' oppure un fattore di accelerazione")
+    args = parser.parse_args()
+
+    sessions = {int(x) for x in args.session.split(',')} if args.session else None
+    try:
+        reader = CaptureReader(args.capture)
+    except (OSError, ValueError) as e:
+        parser.error(f"{args.capture}: {e}")
+    with reader:
+        if args.inject:
+            host, port = args.inject.rsplit(':', 1)
+            speed = {'recorded': 1.0, 'max': 0.0}.get(args.speed)
+            inject(reader, sessions, host, int(port), float(args.speed) if speed is None else speed)
+        elif args.decrypt:
+            direction = {'c2s': CLIENT_TO_SERVER, 's2c': SERVER_TO_CLIENT}.get(args.direction)
+            grep = args.grep.encode() if args.grep else None
+            decrypt(reader, sessions, direction, grep)
+        else:
+            list_sessions(reader)
+
+
+# Punto di ingresso dello script
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from common import derive_key, derive_session, DEFAULT_SUITE
+
+# Durata di validità di un ticket (secondi)
+TICKET_LIFETIME = 3600
+# Numero massimo di ticket validi ricordati dal server (i più vecchi vengono scartati)
+MAX_TICKETS = 10000
+# Dimensione dei valori casuali freschi scambiati ad ogni ripresa
+RANDOM_SIZE = 32
+
+
+def resumption_secret(shared_key: bytes, mode: str) -> bytes:
+    """
+    Deriva dal segreto di sessione il segreto di ripresa da associare al ticket.
+    """
+    # Etichetta distinta: il segreto di ripresa non coincide con nessuna chiave di traffico
+    return derive_key(shared_key, f"{mode}|resumption")
+
+
+def resume_session(secret: bytes, client_random: bytes, server_random: bytes, server_side: bool,
+                   suite: str = DEFAULT_SUITE):
+    """
+    Chiavi di traffico fresche per una sessione ripresa, senza scambio DH.
+    La suite AEAD viene rinegoziata a ogni ripresa e non dipende dal ticket.
+    Restituisce (send_state, recv_state, next_secret) dove next_secret va nel nuovo ticket.
+    """
+    # I due valori casuali rendono le chiavi di ogni ripresa diverse anche a parità di ticket
+    material = secret + client_random + server_random
+    send_state, recv_state = derive_session(material, 'resume', server_side, suite)
+    return send_state, recv_state, resumption_secret(material, 'resume')
+
+
+class TicketStore:
+    """
+    Emissione e verifica dei ticket di ripresa lato server.
+    Il ticket è cifrato con una chiave nota solo al server; l'indice dei ticket validi
+    ha dimensione limitata (LRU + scadenza) e ogni ticket è utilizzabile una sola volta.
+    """
+
+    def __init__(self, lifetime: int = TICKET_LIFETIME, max_tickets: int = MAX_TICKETS):
+        self.lifetime = lifetime
+        self.max_tickets = max_tickets
+        # Chiave dei ticket: generata all'avvio, quindi un riavvio invalida i ticket emessi
+        self._aead = AESGCM(AESGCM.generate_key(bit_length=256))
+        self._valid = OrderedDict()
+        self._lock = threading.Lock()
+
+    def issue(self, secret: bytes) -> bytes:
+        """
+        Restituisce un ticket opaco che incapsula secret.
+        """
+        ticket_id = os.urandom(16)
+        expiry = int(time.time()) + self.lifetime
+        nonce = os.urandom(12)
+        plaintext = ticket_id + struct.pack('>Q', expiry) + secret
+        ticket = nonce + self._aead.encrypt(nonce, plaintext, b'ticket')
+
+        with self._lock:
+            self._purge_locked()
+            self._valid[ticket_id] = expiry
+            # Limite di memoria: si scartano i ticket meno recenti
+            while len(self._valid) > self.max_tickets:
+                self._valid.popitem(last=False)
+        return ticket
+
+    def redeem(self, ticket: bytes):
+        """
+        Verifica il ticket e restituisce il segreto di ripresa, oppure None.
+        """
+        if len(ticket) < 12 + 16:
+            return None
+        try:
+            plaintext = self._aead.decrypt(ticket[:12], ticket[12:], b'ticket')
+        except InvalidTag:
+            return None
+        ticket_id = plaintext[:16]
+        (expiry,) = struct.unpack('>Q', plaintext[16:24])
+
+        with self._lock:
+            # pop: un ticket già usato (replay), scaduto o scartato non è più valido
+            if self._valid.pop(ticket_id, None) is None or expiry < time.time():
+                return None
+        return plaintext[24:]
+
+    def _purge_locked(self) -> None:
+        # I ticket sono in ordine di emissione, quindi anche di scadenza
+        now = time.time()
+        while self._valid:
+            ticket_id, expiry = next(iter(self._valid.items()))
+            if expiry >= now:
+                break
+            del self._valid[ticket_id]
+
+
+class ClientTicket:
+    """
+    Ticket e segreto di ripresa conservati dal client tra una connessione e l'altra.
+    """
+
+    def __init__(self, ticket: bytes, secret: bytes):
+        self.ticket = ticket
+        self.secret = secret
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        Carica il ticket salvato, oppure None se assente o illeggibile.
+        """
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        if len(data) < 32:
+            return None
+        return cls(data[32:], data[:32])
+
+    def save(self, path: str) -> None:
+        """
+        Salva ticket e segreto leggibili solo dall'utente corrente.
+        """
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.secret + self.ticket)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from common import CipherState, encrypt_segments
+import metrics
+
+# Messaggi in attesa di cifratura per ciascun membro: oltre si applica ROOM_POLICY
+ROOM_QUEUE_SIZE = 256
+# Cosa fare quando la coda di un membro è piena:
+#   'backpressure' il mittente attende (al massimo ROOM_SEND_TIMEOUT, poi il membro lento viene espulso)
+#   'drop_oldest'  si scarta il messaggio più vecchio in coda
+#   'drop_newest'  si scarta il messaggio nuovo
+#   'disconnect'   il membro lento viene espulso subito
+ROOM_POLICY = 'backpressure'
+ROOM_POLICIES = ('backpressure', 'drop_oldest', 'drop_newest', 'disconnect')
+ROOM_SEND_TIMEOUT = 5.0
+# Thread per la cifratura del fan-out: cryptography rilascia il GIL durante AES-GCM/ChaCha20,
+# quindi membri diversi vengono cifrati in parallelo su core diversi
+FANOUT_WORKERS = os.cpu_count() or 4
+# Messaggi cifrati al massimo in un singolo passaggio sul thread pool
+FANOUT_BATCH = 64
+# Compressione dei messaggi inoltrati (se negoziata con il membro). Disattivata: nel contesto di
+# compressione verso un membro finiscono i messaggi di tutti gli altri, quindi chi scrive nella stanza
+# potrebbe ricavare il testo altrui dalla dimensione dei frame (CRIME)
+ROOM_COMPRESSION = False
+
+
+def _encrypt_batch(cipher: CipherState, batch) -> list:
+    # Gira su un thread del pool: un solo lotto alla volta per membro,
+    # quindi i numeri di sequenza seguono l'ordine dei messaggi in coda
+    segments = []
+    for plaintext in batch:
+        segments.extend(encrypt_segments(cipher, plaintext, ROOM_COMPRESSION))
+    return segments
+
+
+class Member:
+    """
+    Membro della stanza: chiave di invio propria, coda limitata e task di invio dedicato.
+    """
+
+    def __init__(self, name: str, writer: asyncio.StreamWriter, cipher: CipherState, queue_size: int):
+        self.name = name
+        self.writer = writer
+        self.cipher = cipher
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.task = None
+        self.kicked = False
+
+
+class Room:
+    """
+    Chat di gruppo: ogni messaggio ricevuto viene cifrato e inoltrato a tutti i membri.
+    """
+
+    def __init__(self, policy: str = None, queue_size: int = None, send_timeout: float = None, workers: int = None):
+        # None: valori di configurazione del modulo (ROOM_POLICY, ROOM_QUEUE_SIZE, ...)
+        self.policy = ROOM_POLICY if policy is None else policy
+        if self.policy not in ROOM_POLICIES:
+            raise ValueError(f"Politica della stanza sconosciuta: {self.policy!r}")
+        self.queue_size = ROOM_QUEUE_SIZE if queue_size is None else queue_size
+        self.send_timeout = ROOM_SEND_TIMEOUT if send_timeout is None else send_timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers or FANOUT_WORKERS, thread_name_prefix='fanout')
+        self.members = {}
+        self.dropped = 0
+        self.kicked = 0
+
+    def join(self, name: str, writer: asyncio.StreamWriter, cipher: CipherState) -> Member:
+        """
+        Aggiunge un membro con il suo cifrario di invio; da qui in poi solo la stanza lo usa.
+        """
+        member = Member(name, writer, cipher, self.queue_size)
+        member.task = asyncio.create_task(self._sender(member))
+        self.members[id(member)] = member
+        return member
+
+    def leave(self, member: Member) -> None:
+        if self.members.pop(id(member), None) is not None:
+            member.task.cancel()
+
+    def kick(self, member: Member, reason: str) -> None:
+        """
+        Espelle un membro che non riesce a tenere il passo: la sua connessione viene chiusa.
+        """
+        if member.kicked:
+            return
+        member.kicked = True
+        self.kicked += 1
+        print(f"[!] {member.name} espulso dalla stanza: {reason}")
+        self.leave(member)
+        member.writer.close()
+
+    async def broadcast(self, sender: Member, msg: bytes) -> None:
+        """
+        Accoda il messaggio (con il nome del mittente) per tutti i membri, mittente compreso.
+        """
+        # Il testo in chiaro è lo stesso per tutti: viene costruito una sola volta
+        payload = sender.name.encode() + b': ' + msg
+        waiting = []
+        for member in list(self.members.values()):
+            # 1) Caso comune: c'è posto in coda e non si attende nulla
+            try:
+                member.queue.put_nowait(payload)
+                continue
+            except asyncio.QueueFull:
+                pass
+            # 2) Coda piena: il membro è più lento del ritmo della stanza
+            if self.policy == 'drop_oldest':
+                member.queue.get_nowait()
+                member.queue.put_nowait(payload)
+                self._drop(member)
+            elif self.policy == 'drop_newest':
+                self._drop(member)
+            elif self.policy == 'disconnect':
+                self.kick(member, "coda piena")
+            else:
+                waiting.append(member)
+        if waiting:
+            # 3) Contropressione: il mittente attende i membri lenti tutti insieme, non uno alla volta;
+            # chi resta pieno oltre send_timeout viene espulso per non fermare la stanza
+            results = await asyncio.gather(
+                *(asyncio.wait_for(member.queue.put(payload), self.send_timeout) for member in waiting),
+                return_exceptions=True)
+            for member, result in zip(waiting, results):
+                if isinstance(result, asyncio.TimeoutError):
+                    self.kick(member, f"coda piena da oltre {self.send_timeout}s")
+
+    def _drop(self, member: Member) -> None:
+        member.dropped += 1
+        self.dropped += 1
+
+    async def _sender(self, member: Member) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                # 4) Si prende tutto quello che è in coda (fino a FANOUT_BATCH): un solo passaggio
+                # sul thread pool e una sola scrittura per molti messaggi
+                batch = [await member.queue.get()]
+                while len(batch) < FANOUT_BATCH and not member.queue.empty():
+                    batch.append(member.queue.get_nowait())
+                with metrics.timed('fanout_encrypt'):
+                    segments = await loop.run_in_executor(self.executor, _encrypt_batch, member.cipher, batch)
+                member.writer.writelines(segments)
+                # Solo questo membro attende il proprio client lento; la sua coda intanto si riempie
+                await member.writer.drain()
+        except (ConnectionError, RuntimeError):
+            # Connessione chiusa durante l'invio: il gestore della sessione se ne accorgerà
+            self.leave(member)
+
+    def close(self) -> None:
+        for member in list(self.members.values()):
+            self.leave(member)
+        self.executor.shutdown(wait=False)
@@ -1,32 +1,74 @@
 #!/usr/bin/env python3
 import socket
-from cryptography.hazmat.primitives.asymmetric import dh
-from common import derive_key, send_encrypted, recv_decrypted
-from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+import time
+from cryptography.exceptions import InvalidTag
+from common import send_encrypted, recv_decrypted, FrameReader, server_suites, SUPPORTED_SUITES, SUPPORTED_COMPRESSION
+from dh_params import get_parameters
+import metrics
+from protocol import Connection, BlockingConnection
+from resumption import TicketStore
 
 # Configurazione dell'indirizzo e porta del server
 HOST = '127.0.0.1'
 # Utilizziamo una porta non privilegiata (>1024) che non richiede permessi elevati
 PORT = 65432
+# Origine dei parametri DH: gruppo standard ('ffdhe2048', 'modp2048'),
+# 'cache' (generati una volta e salvati su disco) o 'generate' (nuovi ad ogni avvio)
+DH_SOURCE = 'ffdhe2048'
+# Suite AEAD in ordine di preferenza: 'auto' le ordina con un micro-benchmark all'avvio,
+# altrimenti un elenco come ('chacha20poly1305', 'aes256gcm')
+CIPHER_SUITES = 'auto'
+# Algoritmi di compressione accettati se il client li chiede (vuoto per rifiutarla sempre)
+COMPRESSION = SUPPORTED_COMPRESSION
+# Porta dell'endpoint delle metriche, avviato solo con SECURE_CHAT_METRICS=1
+METRICS_PORT = metrics.METRICS_PORT
+
+def handshake(conn: socket.socket, parameters, tickets: TicketStore, stats=None, verbose: bool = True,
+              suites=SUPPORTED_SUITES, compression=SUPPORTED_COMPRESSION):
+    """
+    Esegue l'handshake lato server su un socket connesso e restituisce (send_cipher, recv_cipher).
+    parameters sono i parametri DH di ripiego, tickets l'archivio dei ticket di ripresa,
+    suites le suite AEAD in ordine di preferenza, compression gli algoritmi di compressione accettati;
+    con verbose=False non stampa nulla.
+    """
+    log = print if verbose else (lambda *args: None)
+    handshake_start = time.perf_counter()
+
+    # 3-7) Il client apre con un ClientHello binario (versione, modalità e suite in ordine
+    # di preferenza, eventuale ticket di ripresa); il server sceglie la prima modalità che
+    # supporta (X25519 prima di DH) e la suite che preferisce, scambia le chiavi pubbliche
+    # (o riprende la sessione dal ticket), deriva le chiavi ed emette un nuovo ticket.
+    # Tutta la logica è nella macchina a stati protocol.Connection, qui eseguita sul socket
+    session = Connection(server_side=True, suites=suites, parameters=parameters, tickets=tickets, stats=stats,
+                         compression=compression)
+    result = BlockingConnection(conn, session).handshake()
+    log(f"[*] Suite AEAD: {result.suite}" + (f", compressione {result.compression}" if result.compression else ''))
+    if result.resumed:
+        log("[*] Sessione ripresa dal ticket (nessuno scambio DH)")
+    else:
+        log(f"[*] Modalità negoziata: {result.mode}")
+        log("[*] Shared key derivata")
+    metrics.observe('handshake', time.perf_counter() - handshake_start, stats)
+    return session.send_cipher, session.recv_cipher
 
 def main():
-    # 1) Generazione parametri Diffie-Hellman
+    # 1) Parametri Diffie-Hellman (usati solo se il client non supporta X25519)
     # DH permette a due parti di stabilire una chiave segreta condivisa
     # attraverso un canale insicuro, senza mai trasmettere la chiave stessa
-    # Usiamo generator=2 (valore standard sicuro) e key_size=2048 (raccomandato da NIST)
-    # La dimensione di 2048 bit offre un livello di sicurezza adeguato
-    parameters = dh.generate_parameters(generator=2, key_size=2048)
-    
-    # Generiamo la chiave privata del server (b)
-    server_priv = parameters.generate_private_key()
-    
-    # Calcoliamo la chiave pubblica del server (g^b mod p)
-    server_pub = server_priv.public_key().public_numbers().y
-    
-    # Estraiamo p (modulo primo) e g (generatore) dai parametri DH
-    # Questi valori saranno condivisi con il client
-    params = parameters.parameter_numbers()
-    p, g = params.p, params.g
+    # Usiamo un gruppo standard da 2048 bit con generator=2 (raccomandato da NIST):
+    # l'avvio è immediato invece di attendere la generazione di un primo sicuro
+    parameters = get_parameters(DH_SOURCE)
+
+    # Ordine di preferenza delle suite AEAD (eventualmente misurato su questa CPU)
+    suites = server_suites(CIPHER_SUITES)
+
+    # Archivio dei ticket di ripresa emessi da questo processo
+    tickets = TicketStore()
+
+    # Endpoint testuale delle metriche (http://HOST:METRICS_PORT/metrics), solo se attivate
+    if metrics.ENABLED:
+        metrics.serve(HOST, METRICS_PORT)
+        print(f"[+] Metriche su http://{HOST}:{METRICS_PORT}/metrics")
 
     # 2) Configurazione della connessione TCP
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
@@ -50,62 +92,43 @@ def main():
             # Imposta timeout sulla connessione per le operazioni di ricezione
             conn.settimeout(300)
             print(f"[+] Connessione da {addr}")
+            # Contatori e latenze di questa connessione (None se le metriche sono spente)
+            stats = metrics.connection(addr)
 
-            # 3) Scambio Diffie-Hellman: inviamo p, g e la chiave pubblica del server
-            # il client ha bisogno di questi valori per generare la sua chiave
-            # e calcolare lo stesso segreto condiviso
-            conn.sendall(f"{p},{g},{server_pub}".encode())
-
-            # 4) Ricezione della chiave pubblica del client (g^a mod p)
-            # Utilizziamo un buffer sufficientemente grande per ospitare numeri DH di 2048 bit
-            data = conn.recv(8192)
-            
-            # Convertiamo la stringa ricevuta in un intero (la chiave pubblica del client)
-            client_pub_int = int(data.decode())
+            # 3-7) Handshake: negoziazione, scambio di chiavi (o ripresa) e ticket
+            send_cipher, recv_cipher = handshake(conn, parameters, tickets, stats, suites=suites, compression=COMPRESSION)
 
-            # 5) Calcolo del segreto condiviso
-            # DH permette che entrambe le parti possono 
-            # calcolare lo stesso segreto g^(ab) mod p senza mai trasmettere tale valore
-            
-            # Ricostruiamo l'oggetto chiave pubblica del client
-            client_pub_nums = dh.DHPublicNumbers(client_pub_int, params)
-            client_pub_key = client_pub_nums.public_key()
-            
-            # Calcoliamo il segreto condiviso: (g^a)^b mod p = g^(ab) mod p
-            shared_key = server_priv.exchange(client_pub_key)
-            print("[*] Shared key derivata")
-
-            # 6) Derivazione della chiave AES e setup del cifrario
-            # la shared_key DH non è utilizzabile direttamente,
-            # quindi deriviamo una chiave adatta per AES usando una KDF
-            key = derive_key(shared_key)
-        
-            # Inizializziamo AES-GCM con la chiave derivata
-            # AES-GCM è un cifrario AEAD che fornisce sia
-            # confidenzialità che autenticità dei messaggi
-            aesgcm = AESGCM(key)
+            # Da qui in poi i frame vengono letti con un buffer riutilizzabile
+            # per connessione (recv_into, nessuna copia intermedia)
+            reader = FrameReader(conn)
+            reader.stats = stats
 
-            # 7) Loop di chat cifrata (echo server)
+            # 8) Loop di chat cifrata (echo server)
             # Il server riceve messaggi cifrati, li decifra, li mostra e li rimanda al client
             try:
                 while True:
                     # Ricezione e decifratura del messaggio dal client
-                    # La funzione recv_decrypted gestisce anche il nonce e la verifica dell'integrità
-                    msg = recv_decrypted(conn, aesgcm)
+                    # La funzione recv_decrypted verifica integrità e numero di sequenza
+                    msg = recv_decrypted(reader, recv_cipher)
                     
                     # Mostra il messaggio ricevuto (decodificato in stringa)
                     print(f"[Client] {msg.decode()!r}")
                     
                     # Cifra e invia lo stesso messaggio al client (echo)
                     # La funzione send_encrypted gestisce la generazione del nonce e la cifratura
-                    send_encrypted(conn, aesgcm, msg)
+                    send_encrypted(conn, send_cipher, msg)
                     
             except (EOFError, socket.timeout):
                 # Gestione della terminazione della connessione o timeout
                 print("[!] Connessione terminata")
+            except (ValueError, InvalidTag) as e:
+                # Frame oltre MAX_FRAME_SIZE, nonce fuori sequenza o tag non valido:
+                # il messaggio è malformato o manomesso, chiudiamo solo questa connessione
+                print(f"[!] Connessione chiusa per errore di protocollo: {e!r}")
             finally:
                 # Garantisce la chiusura della connessione in ogni caso
                 conn.close()
+                metrics.close(stats)
 
 # Punto di ingresso dello script
 if __name__ == '__main__':
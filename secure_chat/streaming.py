@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+import argparse
+import mmap
+import os
+import socket
+import struct
+import time
+from client import handshake as client_handshake
+from common import (CipherState, FrameReader, read_frame_flags, send_segments, key_update_segments, open_frame,
+                    send_encrypted, recv_decrypted, FRAME_KEY_UPDATE)
+from dh_params import get_parameters
+from resumption import TicketStore
+from server import handshake as server_handshake, DH_SOURCE
+
+# Dimensione di ciascun blocco cifrato: la memoria usata non dipende dalla dimensione del payload
+CHUNK_SIZE = 64 * 1024
+# Flag del blocco finale: senza di esso il ricevitore considera il flusso troncato
+FLAG_FINAL = 0x01
+
+
+def _chunk_aad(index: int, flags: int) -> bytes:
+    # Indice del blocco e flag vengono legati al tag AEAD come dati associati:
+    # un blocco spostato, rimosso o marcato come finale da un attaccante non si decifra
+    return struct.pack('>QB', index, flags)
+
+
+def _iter_chunks(source, chunk_size: int):
+    """
+    Produce coppie (blocco, finale) da un percorso, un file o un iterabile di bytes.
+    Ogni blocco ha al massimo chunk_size byte ed è valido solo fino al passo successivo.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            yield from _iter_chunks(f, chunk_size)
+        return
+
+    if hasattr(source, 'fileno'):
+        # 1) File su disco: mmap evita di copiare i dati in buffer Python,
+        # ogni blocco è una vista sulle pagine del file mappate in memoria
+        try:
+            size = os.fstat(source.fileno()).st_size
+        except OSError:
+            size = 0
+        if size:
+            with mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                with memoryview(mapped) as view:
+                    for offset in range(0, size, chunk_size):
+                        with view[offset:offset + chunk_size] as chunk:
+                            yield chunk, offset + chunk_size >= size
+                        # Rilasciata la vista, la mmap può essere chiusa senza puntatori esportati
+            return
+        # File vuoto o non mappabile (pipe): lettura a blocchi
+        f = source
+        source = iter(lambda: f.read(chunk_size), b'')
+
+    # 2) Iterabile generico: i pezzi troppo grandi vengono spezzati e si tiene
+    # un blocco di anticipo per sapere quale sarà l'ultimo
+    pending = None
+    for piece in source:
+        piece = memoryview(piece)
+        for offset in range(0, len(piece), chunk_size):
+            if pending is not None:
+                yield pending, False
+            pending = piece[offset:offset + chunk_size]
+    # Anche un payload vuoto produce un blocco finale (vuoto) che chiude il flusso
+    yield (pending if pending is not None else b''), True
+
+
+def send_stream(conn, cipher: CipherState, source, chunk_size: int = CHUNK_SIZE) -> int:
+    """
+    Invia source come sequenza di frame [flags:1][ciphertext] cifrati blocco per blocco.
+    Restituisce il numero di byte in chiaro inviati.
+    """
+    # 3) Il blocco finale è marcato FLAG_FINAL: un flusso troncato viene riconosciuto
+    total = 0
+    for index, (chunk, final) in enumerate(_iter_chunks(source, chunk_size)):
+        _send_chunk(conn, cipher, index, FLAG_FINAL if final else 0, chunk)
+        total += len(chunk)
+    return total
+
+
+def _send_chunk(conn, cipher: CipherState, index: int, flags: int, chunk) -> None:
+    body = cipher.seal(chunk, _chunk_aad(index, flags))
+    size = 1 + sum(len(seg) for seg in body)
+    segments = [struct.pack('>IB', size, flags)] + body
+    if cipher.needs_rekey():
+        # Anche un trasferimento lunghissimo resta entro i limiti d'uso della chiave
+        segments += key_update_segments(cipher)
+    send_segments(conn, segments)
+
+
+def recv_stream(conn, cipher: CipherState, dest) -> int:
+    """
+    Riceve un flusso inviato con send_stream e lo scrive su dest (percorso o file aperto).
+    Restituisce il numero di byte in chiaro ricevuti.
+    """
+    if isinstance(dest, (str, os.PathLike)):
+        # 4) Scrittura su file temporaneo e rinomina solo a flusso completo e autentico:
+        # un trasferimento interrotto o manomesso non lascia un file parziale
+        tmp_path = f"{os.fspath(dest)}.part"
+        try:
+            with open(tmp_path, 'wb') as f:
+                total = recv_stream(conn, cipher, f)
+            os.replace(tmp_path, dest)
+            return total
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    total = 0
+    index = 0
+    while True:
+        frame_flags, frame = read_frame_flags(conn)
+        if frame_flags == FRAME_KEY_UPDATE:
+            # Aggiornamento delle chiavi tra due blocchi: non conta come blocco
+            open_frame(cipher, frame_flags, frame)
+            continue
+        if frame_flags:
+            # I blocchi non sono mai compressi: qualunque altro flag è un frame estraneo al flusso
+            raise ValueError(f"Frame con flag {frame_flags:#x} inatteso in un flusso")
+        frame = memoryview(frame)
+        if len(frame) < 1:
+            raise ValueError("Blocco di flusso vuoto")
+        flags = frame[0]
+        chunk = cipher.open(frame[1:], _chunk_aad(index, flags))
+        dest.write(chunk)
+        total += len(chunk)
+        index += 1
+        if flags & FLAG_FINAL:
+            return total
+
+
+def stream_reader(conn, chunk_size: int = CHUNK_SIZE) -> FrameReader:
+    """
+    FrameReader con un buffer dimensionato per contenere un blocco intero senza riallocazioni.
+    """
+    # Blocco + flag + tag GCM + header, con margine per qualche frame accodato
+    return FrameReader(conn, buffer_size=2 * (chunk_size + 64))
+
+
+# Porta della demo di trasferimento file (diversa da quelle di server.py, async_server.py e mux.py)
+HOST = '127.0.0.1'
+PORT = 65436
+# Conferma del ricevitore a fine trasferimento: byte in chiaro scritti su disco
+ACK = struct.Struct('>Q')
+
+
+def receive_file(dest: str, host: str = HOST, port: int = PORT) -> None:
+    """
+    Attende un mittente, esegue l'handshake lato server e salva il flusso ricevuto in dest.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((host, port))
+        s.listen(1)
+        print(f"[+] In attesa di un file su {host}:{port}", flush=True)
+        conn, addr = s.accept()
+    with conn:
+        send_cipher, recv_cipher = server_handshake(conn, get_parameters(DH_SOURCE), TicketStore(), verbose=False)
+        start = time.perf_counter()
+        total = recv_stream(stream_reader(conn), recv_cipher, dest)
+        elapsed = time.perf_counter() - start
+        # Il mittente considera il trasferimento riuscito solo dopo questa conferma
+        send_encrypted(conn, send_cipher, ACK.pack(total))
+    print(f"[*] {total} byte da {addr} salvati in {dest} in {elapsed:.3f}s "
+          f"({total / elapsed / 1e6 if elapsed else 0:.1f} MB/s)")
+
+
+def send_file(path: str, host: str = HOST, port: int = PORT, chunk_size: int = CHUNK_SIZE) -> None:
+    """
+    Si collega al ricevitore e gli invia il file path in streaming.
+    """
+    with socket.create_connection((host, port)) as sock:
+        send_cipher, recv_cipher = client_handshake(sock, ticket_file=None, verbose=False)
+        start = time.perf_counter()
+        total = send_stream(sock, send_cipher, path, chunk_size)
+        (written,) = ACK.unpack(recv_decrypted(sock, recv_cipher))
+        elapsed = time.perf_counter() - start
+    if written != total:
+        raise ValueError(f"Il ricevitore ha scritto {written} byte su {total}")
+    print(f"[*] {total} byte inviati in {elapsed:.3f}s ({total / elapsed / 1e6 if elapsed else 0:.1f} MB/s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Trasferimento di un file in streaming su un canale cifrato")
+    parser.add_argument('role', choices=('receive', 'send'))
+    parser.add_argument('path', help="File da inviare (send) o in cui salvare i dati ricevuti (receive)")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help="Byte in chiaro per blocco (send)")
+    args = parser.parse_args()
+    if args.role == 'receive':
+        receive_file(args.path, args.host, args.port)
+    else:
+        send_file(args.path, args.host, args.port, args.chunk_size)
+
+
+# Punto di ingresso dello script
+if __name__ == '__main__':
+    main()